@@ -0,0 +1,165 @@
+import csv
+import datetime
+import glob
+import json
+import os
+import re
+import zlib
+
+from log_usage import LOG_HEADER, active_day
+
+INDEX_VERSION = 1
+COUNT_FIELDS = ("username", "role", "action")
+# Rows logged before the Patient_ID column existed carry the ID in the action text.
+_LEGACY_PATIENT = re.compile(r"(?:visit for|patient)\s+(\S+)$")
+# Trailing IDs/dates are stripped so "Added visit for 123" counts as "Added visit".
+_ACTION_ARGUMENT = re.compile(r"(?:\s+(?:for|on))?\s+\S*\d\S*$")
+
+
+def action_type(action, patient_id=""):
+    if patient_id and action.endswith(" " + patient_id):
+        action = action[:-len(patient_id) - 1]
+        return action[:-4] if action.endswith(" for") else action
+    return _ACTION_ARGUMENT.sub("", action) or action
+
+
+def index_path(partition):
+    return partition + ".idx.json"
+
+
+def _tail_crc(file, end):
+    # Fingerprint of the indexed prefix; it changes when the active log is rotated away.
+    start = max(end - 4096, 0)
+    file.seek(start)
+    return zlib.crc32(file.read(end - start))
+
+
+def _parse_row(line, header):
+    values = next(csv.reader([line.decode('utf-8')]), [])
+    row = dict(zip(header, values))
+    if not row.get("Patient_ID"):
+        match = _LEGACY_PATIENT.search(row.get("Action", ""))
+        row["Patient_ID"] = match.group(1) if match else ""
+    return row
+
+
+class AuditLog:
+    # Queries over the usage log partitions written by log_usage.UsageLogger: one file per
+    # day (usage_log.YYYY-MM-DD[.N].csv, plus the active usage_log.csv), each with a small
+    # JSON sidecar holding action counts and the byte offsets of rows per patient ID.
+    def __init__(self, log_file="usage_log.csv"):
+        self.log_file = log_file
+        self._indexes = {}
+
+    def partitions(self, start=None, end=None):
+        # Returns (day, path) pairs in date order, restricted to [start, end] when given.
+        base, ext = os.path.splitext(self.log_file)
+        found = []
+        for path in glob.glob(f"{glob.escape(base)}.*{ext}"):
+            day = path[len(base) + 1:len(base) + 11]
+            try:
+                datetime.datetime.strptime(day, '%Y-%m-%d')
+            except ValueError:
+                continue
+            found.append((day, path))
+        if os.path.exists(self.log_file):
+            found.append((active_day(self.log_file), self.log_file))
+
+        start = str(start)[:10] if start else None
+        end = str(end)[:10] if end else None
+        return sorted((day, path) for day, path in found
+                      if (start is None or day >= start) and (end is None or day <= end))
+
+    def index(self, partition):
+        # Partitions are append-only, so an index that covers a prefix of the file is
+        # extended from where it stopped instead of being rebuilt.
+        size = os.path.getsize(partition)
+        index = self._indexes.get(partition) or self._read_index(partition)
+        with open(partition, 'rb') as file:
+            if index is not None and (index["size"] > size or _tail_crc(file, index["size"]) != index["crc"]):
+                index = None
+            if index is not None and index["size"] == size:
+                self._indexes[partition] = index
+                return index
+            if index is None:
+                index = {"version": INDEX_VERSION, "size": 0, "crc": 0, "header": LOG_HEADER,
+                         "counts": {field: {} for field in COUNT_FIELDS}, "patients": {}}
+
+            file.seek(index["size"])
+            offset = index["size"]
+            for line in iter(file.readline, b''):
+                if not line.endswith(b'\n'):
+                    # The logger is mid-write; leave the partial row for the next call.
+                    break
+                if offset == 0:
+                    index["header"] = next(csv.reader([line.decode('utf-8')]), LOG_HEADER)
+                elif line.strip():
+                    row = _parse_row(line, index["header"])
+                    self._count(index, row)
+                    if row["Patient_ID"]:
+                        index["patients"].setdefault(row["Patient_ID"], []).append(offset)
+                offset += len(line)
+            index["size"] = offset
+            index["crc"] = _tail_crc(file, offset)
+
+        self._write_index(partition, index)
+        self._indexes[partition] = index
+        return index
+
+    def count_actions(self, by="action", start=None, end=None):
+        # Counts events per username, role or action type over the partitions in range.
+        if by not in COUNT_FIELDS:
+            raise ValueError(f"Can only count by one of {', '.join(COUNT_FIELDS)}")
+        totals = {}
+        for _, partition in self.partitions(start, end):
+            for key, count in self.index(partition)["counts"][by].items():
+                totals[key] = totals.get(key, 0) + count
+        return dict(sorted(totals.items(), key=lambda item: (-item[1], item[0])))
+
+    def find_patient_events(self, patient_id, start=None, end=None):
+        # Reads only the rows the partition indexes point at for this patient.
+        patient_id = str(patient_id)
+        events = []
+        for _, partition in self.partitions(start, end):
+            index = self.index(partition)
+            offsets = index["patients"].get(patient_id)
+            if not offsets:
+                continue
+            with open(partition, 'rb') as file:
+                for offset in offsets:
+                    file.seek(offset)
+                    events.append(_parse_row(file.readline(), index["header"]))
+        return events
+
+    def _count(self, index, row):
+        values = (row.get("Username", ""), row.get("Role", ""),
+                  action_type(row.get("Action", ""), row["Patient_ID"]))
+        for field, value in zip(COUNT_FIELDS, values):
+            counts = index["counts"][field]
+            counts[value] = counts.get(value, 0) + 1
+
+    def _read_index(self, partition):
+        try:
+            with open(index_path(partition), encoding='utf-8') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return index if index.get("version") == INDEX_VERSION else None
+
+    def _write_index(self, partition, index):
+        path = index_path(partition)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(index, file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write audit index {path}: {e}")
+
+
+def count_actions(by="action", start=None, end=None, log_file="usage_log.csv"):
+    return AuditLog(log_file).count_actions(by, start, end)
+
+
+def find_patient_events(patient_id, start=None, end=None, log_file="usage_log.csv"):
+    return AuditLog(log_file).find_patient_events(patient_id, start, end)
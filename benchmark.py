@@ -0,0 +1,475 @@
+import argparse
+import contextlib
+import csv
+import datetime
+import gc
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from patients import FIELDNAMES, Department, NotesDatabase, Patient, Visit
+from snapshot import snapshot_path
+from stats import generate_all_statistics
+from users import HASH_ITERATIONS, CredentialStore, authenticate_user, migrate_credentials
+
+DEPARTMENTS = ['Cardiology', 'Emergency department', 'Head and Neck', 'Neorology',
+               'Obstetrics and gynaecology', 'Pediatrics', 'Psychiatry', 'Radiology', 'Surgery']
+RACES = ['Asian', 'Black', 'Native Americans', 'Pacific Islanders', 'Unknown', 'White']
+GENDERS = ['Female', 'Male', 'Non-binary']
+ETHNICITIES = ['Hispanic', 'Non-Hispanic', 'Other', 'Unknown']
+INSURANCES = ['Blueshield', 'Medicaid', 'Medicare', 'Not Available', 'Unknown']
+COMPLAINTS = ['Unknown', 'back pain', 'bleeding', 'chest pain', 'fatigue', 'infection', 'injury']
+NOTE_WORDS = ['patient', 'admitted', 'fever', 'CSF', 'culture', 'meningitis', 'Ps. aeruginosa', 'ceftazidime',
+              'ventricular', 'drain', 'antibiotic', 'therapy', 'infection', 'day', 'mg/day', 'resolved',
+              'pain', 'chest', 'surgery', 'follow-up', 'discharged', 'normal', 'white', 'blood', 'count']
+NOTE_TYPES = ['admission note', 'discharge note', 'oncology note', 'progress note', 'social work note']
+
+
+def synthetic_rows(n_visits, visits_per_patient=5, seed=0):
+    rng = random.Random(seed)
+    start = datetime.date(2000, 1, 1).toordinal()
+    patient = None
+    for i in range(n_visits):
+        if i % visits_per_patient == 0:
+            patient = {
+                'Patient_ID': str(10000 + i // visits_per_patient),
+                'Race': rng.choice(RACES),
+                'Gender': rng.choice(GENDERS),
+                'Ethnicity': rng.choice(ETHNICITIES),
+                'Age': str(rng.randint(1, 100)),
+                'Zip_code': str(rng.randint(10000, 99999)),
+                'Insurance': rng.choice(INSURANCES),
+            }
+        row = dict(patient)
+        row.update({
+            'Visit_ID': str(100000 + i),
+            'Visit_time': datetime.date.fromordinal(start + rng.randint(0, 9000)).strftime('%Y-%m-%d'),
+            'Visit_department': rng.choice(DEPARTMENTS),
+            'Chief_complaint': rng.choice(COMPLAINTS),
+            'Note_ID': str(500000 + i),
+            'Note_type': rng.choice(NOTE_TYPES),
+        })
+        yield {name: row[name] for name in FIELDNAMES}
+
+
+# Replicas of the original dict-backed model, kept as the baseline for comparisons.
+class LegacyVisit:
+    def __init__(self, visit_id, visit_time, visit_department, chief_complaint, note_id, note_type):
+        self.visit_id = visit_id
+        try:
+            self.visit_time = datetime.datetime.strptime(visit_time, '%Y-%m-%d')
+        except ValueError:
+            self.visit_time = datetime.datetime.strptime(visit_time, '%m/%d/%Y')
+        self.visit_department = visit_department
+        self.chief_complaint = chief_complaint
+        self.note_id = note_id
+        self.note_type = note_type
+
+
+class LegacyPatient:
+    def __init__(self, patient_id, gender, race, age, ethnicity, insurance, zip_code):
+        self.patient_id = patient_id
+        self.gender = gender
+        self.race = race
+        self.age = age
+        self.ethnicity = ethnicity
+        self.insurance = insurance
+        self.zip_code = zip_code
+        self.visits = []
+
+    def add_visit(self, visit):
+        self.visits.append(visit)
+
+
+def build_model(rows, patient_cls, visit_cls):
+    patients = {}
+    for row in rows:
+        pid = row['Patient_ID']
+        if pid not in patients:
+            patients[pid] = patient_cls(pid, row['Gender'], row['Race'], int(row['Age']),
+                                        row['Ethnicity'], row['Insurance'], row['Zip_code'])
+        patients[pid].add_visit(visit_cls(row['Visit_ID'], row['Visit_time'], row['Visit_department'],
+                                          row['Chief_complaint'], row['Note_ID'], row['Note_type']))
+    return patients
+
+
+def write_patient_csv(path, n_visits, seed=0):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDNAMES, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(synthetic_rows(n_visits, seed=seed))
+
+
+def synthetic_notes(n_notes, words_per_note=400, seed=0):
+    rng = random.Random(seed)
+    for i in range(n_notes):
+        lines = []
+        for _ in range(rng.randint(1, 6)):
+            lines.append(' '.join(rng.choice(NOTE_WORDS) for _ in range(words_per_note // 4)) + '.')
+        # Every fifth note quotes something, exercising escaped quotes inside the field.
+        if i % 5 == 0:
+            lines.append('Family reported "no change" overnight.')
+        yield [i, str(10000 + i // 5), str(100000 + i), str(500000 + i), '\n'.join(lines)]
+
+
+def write_notes_csv(path, n_notes, seed=0):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(['', 'Patient_ID', 'Visit_ID', 'Note_ID', 'Note_text'])
+        writer.writerows(synthetic_notes(n_notes, seed=seed))
+
+
+def synthetic_credentials(n_users, seed=0):
+    rng = random.Random(seed)
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    roles = ['admin', 'nurse', 'clinician', 'management']
+    for i in range(n_users):
+        yield [i, f"U{i:06d}", ''.join(rng.choice(alphabet) for _ in range(7)), rng.choice(roles)]
+
+
+def write_credentials_csv(path, n_users, seed=0):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(['', 'username', 'password', 'role'])
+        writer.writerows(synthetic_credentials(n_users, seed=seed))
+
+
+def legacy_authenticate(credentials_file, username, password):
+    # The original linear scan over Credentials.csv.
+    with open(credentials_file, newline='', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            if row['username'].strip() == username and row['password'].strip() == password:
+                return row['role'].strip()
+    return None
+
+
+def legacy_load(path):
+    # The original row-by-row Department.load_data.
+    patients = {}
+    with open(path, newline='', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            pid = str(row['Patient_ID'])
+            try:
+                age = int(row['Age'])
+            except ValueError:
+                age = 0
+            if pid not in patients:
+                patients[pid] = LegacyPatient(pid, row['Gender'], row['Race'], age,
+                                              row['Ethnicity'], row['Insurance'], row['Zip_code'])
+            patients[pid].add_visit(LegacyVisit(row['Visit_ID'], row['Visit_time'], row['Visit_department'],
+                                                row.get('Chief_complaint', ''), row.get('Note_ID', ''),
+                                                row.get('Note_type', '')))
+    return patients
+
+
+def timed(label, func, *args, repeat=1):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+        del result
+    print(f"{label:<32} {best:8.2f} s")
+    return best
+
+
+def measure(label, func, *args):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<32} {elapsed:8.2f} s  {current / 2 ** 20:9.1f} MiB retained  {peak / 2 ** 20:9.1f} MiB peak")
+    return result
+
+
+def bench_memory(args):
+    print(f"Building {args.visits:,} synthetic visits")
+    # Fresh string objects for every row, as csv.DictReader would produce.
+    rows = [{key: ''.join(value) for key, value in row.items()} for row in synthetic_rows(args.visits)]
+    for label, patient_cls, visit_cls in (("dict-backed (original)", LegacyPatient, LegacyVisit),
+                                          ("__slots__ + interned", Patient, Visit)):
+        model = measure(label, build_model, rows, patient_cls, visit_cls)
+        del model
+
+
+def bench_load(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'Patient_data.csv')
+        print(f"Writing {args.visits:,} synthetic visits to {path}")
+        write_patient_csv(path, args.visits)
+        legacy = timed("row-by-row (original)", legacy_load, path, repeat=args.repeat)
+        # Tokenizing alone, without building anything: the floor for a CSV parse.
+        timed("pd.read_csv only", pd.read_csv, path, repeat=args.repeat)
+        # The first open parses the CSV (and writes the snapshot); later opens read the snapshot.
+        parse = timed("bulk loader, CSV parse", lambda: Department("General", path, use_snapshot=False),
+                      repeat=args.repeat)
+        Department("General", path)
+        reopen = timed("bulk loader, reopen", Department, "General", path, repeat=args.repeat)
+        print(f"speed-up: {legacy / parse:.1f}x parsing the CSV, {legacy / reopen:.1f}x reopening")
+
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        patients_path = os.path.join(tmp, 'Patient_data.csv')
+        notes_path = os.path.join(tmp, 'Notes.csv')
+        print(f"Writing {args.visits:,} synthetic visits and {args.notes:,} notes to {tmp}")
+        write_patient_csv(patients_path, args.visits)
+        write_notes_csv(notes_path, args.notes)
+
+        for label, path, load in (("Department", patients_path, lambda: Department("General", patients_path)),
+                                  ("NotesDatabase", notes_path, lambda: NotesDatabase(notes_path))):
+            if os.path.exists(snapshot_path(path)):
+                os.remove(snapshot_path(path))
+            cold = timed(f"{label} cold (CSV)", load)
+            warm = timed(f"{label} warm (snapshot)", load, repeat=args.repeat)
+            print(f"{label} warm start: {cold / warm:.1f}x faster, snapshot "
+                  f"{os.path.getsize(snapshot_path(path)) / 2 ** 20:.1f} MiB")
+
+
+def bench_parallel(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        patients_path = os.path.join(tmp, 'Patient_data.csv')
+        notes_path = os.path.join(tmp, 'Notes.csv')
+        print(f"Writing {args.visits:,} synthetic visits and {args.notes:,} notes to {tmp} "
+              f"({os.cpu_count()} CPUs available)")
+        write_patient_csv(patients_path, args.visits)
+        write_notes_csv(notes_path, args.notes)
+
+        def load_notes_index(workers):
+            if os.path.exists(notes_path + ".idx"):
+                os.remove(notes_path + ".idx")
+            return NotesDatabase(notes_path, lazy=True, workers=workers)
+
+        for label, load in (
+                ("Department", lambda workers: Department("General", patients_path, use_snapshot=False,
+                                                          workers=workers)),
+                ("Notes", lambda workers: NotesDatabase(notes_path, use_snapshot=False, workers=workers)),
+                ("Notes lazy index", load_notes_index)):
+            baseline = None
+            for workers in args.workers:
+                elapsed = timed(f"{label}, {workers} worker(s)", load, workers, repeat=args.repeat)
+                if baseline is None:
+                    baseline = elapsed
+                else:
+                    print(f"{'':<32} {baseline / elapsed:8.1f}x vs {args.workers[0]} worker(s)")
+
+
+def bench_login(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'Credentials.csv')
+        write_credentials_csv(path, args.users)
+        credentials = [(row[1], row[2]) for row in synthetic_credentials(args.users)]
+        rng = random.Random(1)
+        attempts = [rng.choice(credentials) for _ in range(args.logins)]
+
+        def run(label, check):
+            with ThreadPoolExecutor(max_workers=args.threads) as pool:
+                started = time.perf_counter()
+                results = list(pool.map(lambda attempt: check(*attempt), attempts))
+                elapsed = time.perf_counter() - started
+            assert all(results), label
+            print(f"{label:<32} {args.logins / elapsed:10.0f} logins/s  ({args.threads} threads)")
+
+        run("linear CSV scan (original)", lambda u, p: legacy_authenticate(path, u, p))
+        store = CredentialStore(path)
+        run("indexed store, plaintext", store.authenticate)
+        print(f"Hashing {args.users:,} passwords ({args.iterations:,} PBKDF2 iterations)")
+        migrate_credentials(path, iterations=args.iterations)
+        run("indexed store, salted hashes", store.authenticate)
+
+
+def profile(func, *args, repeat=1, calls=1, memory=True):
+    # Best wall time per call over `repeat` runs, then one run under tracemalloc for the
+    # peak. Output printed by the measured code is discarded.
+    best = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            gc.collect()
+            started = time.perf_counter()
+            result = func(*args)
+            elapsed = (time.perf_counter() - started) / calls
+            best = elapsed if best is None else min(best, elapsed)
+            del result
+        peak = None
+        if memory:
+            gc.collect()
+            tracemalloc.start()
+            try:
+                func(*args)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    return best, peak
+
+
+def git_commit():
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def suite_cases(tmp, n_visits, args):
+    # Yields (name, func, args, calls) for one scale; files are written up front and each
+    # case runs against state left by the ones before it, as the application would.
+    patients_path = os.path.join(tmp, 'Patient_data.csv')
+    notes_path = os.path.join(tmp, 'Notes.csv')
+    credentials_path = os.path.join(tmp, 'Credentials.csv')
+    n_notes = max(int(n_visits * args.notes_ratio), 1)
+    write_patient_csv(patients_path, n_visits)
+    write_notes_csv(notes_path, n_notes)
+    write_credentials_csv(credentials_path, args.users)
+
+    rng = random.Random(1)
+    dates = [datetime.date(2000, 1, 1) + datetime.timedelta(days=rng.randint(0, 9000)) for _ in range(args.lookups)]
+    note_ids = [rng.randrange(n_notes) for _ in range(args.lookups)]
+    credentials = [(row[1], row[2]) for row in synthetic_credentials(args.users)]
+    logins = [rng.choice(credentials) for _ in range(args.lookups)]
+
+    yield "Department.load_data", lambda: Department("General", patients_path, use_snapshot=False), 1
+    Department("General", patients_path)
+    yield "Department.load_data (snapshot)", lambda: Department("General", patients_path), 1
+    department = Department("General", patients_path)
+    yield "Department.save_data", department.save_data, 1
+    yield "Department.review_visits (first)", lambda: Department("General", patients_path).review_visits(
+        dates[0].isoformat()), 1
+    yield "Department.review_visits", lambda: [department.review_visits(date.isoformat()) for date in dates], len(dates)
+    yield "Department.export_statistics_report", department.export_statistics_report, 1, \
+        os.path.join(tmp, 'summary_report.csv')
+
+    yield "NotesDatabase load", lambda: NotesDatabase(notes_path, use_snapshot=False), 1
+    notes = NotesDatabase(notes_path)
+
+    # Each synthetic note belongs to visit 100000 + i of patient 10000 + i // 5.
+    lookups = []
+    for i in note_ids:
+        patient_id, visit_id = str(10000 + i // 5), str(100000 + i)
+        day = next(v.visit_time.date() for v in department.patients[patient_id].visits if v.visit_id == visit_id)
+        lookups.append((patient_id, day.isoformat()))
+    yield "NotesDatabase.get_notes_by_patient_and_date", lambda: [
+        notes.get_notes_by_patient_and_date(patient_id, day, department) for patient_id, day in lookups], len(lookups)
+
+    yield "authenticate_user (first)", lambda: CredentialStore(credentials_path).authenticate(*logins[0]), 1
+    yield "authenticate_user", lambda: [authenticate_user(credentials_path, *login) for login in logins], len(logins)
+
+    yield "generate_all_statistics", generate_all_statistics, 1, patients_path
+    yield "generate_all_statistics (chunked)", generate_all_statistics, 1, patients_path, args.memory_limit
+
+
+def bench_suite(args):
+    commit, dirty = git_commit()
+    record = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': [],
+    }
+    previous = {}
+    if args.compare and os.path.exists(args.output):
+        with open(args.output, encoding='utf-8') as file:
+            lines = [line for line in file if line.strip()]
+        if lines:
+            baseline = json.loads(lines[-1])
+            previous = {(r['scale'], r['name']): r['seconds'] for r in baseline['results']}
+            print(f"Comparing against {baseline.get('commit') or 'unknown commit'} ({baseline['timestamp']})")
+
+    for n_visits in args.scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            print(f"\n{n_visits:,} visits")
+            for name, func, calls, *func_args in suite_cases(tmp, n_visits, args):
+                seconds, peak = profile(func, *func_args, repeat=args.repeat, calls=calls,
+                                        memory=not args.no_memory)
+                record['results'].append({'scale': n_visits, 'name': name, 'seconds': seconds,
+                                          'calls': calls, 'peak_bytes': peak})
+                line = f"{name:<46} {seconds * 1000:12.3f} ms"
+                if peak is not None:
+                    line += f"  {peak / 2 ** 20:9.1f} MiB peak"
+                if (n_visits, name) in previous and previous[(n_visits, name)]:
+                    line += f"  {seconds / previous[(n_visits, name)]:6.2f}x previous"
+                print(line)
+
+    # One JSON record per run, appended, so the file is a history to diff across commits.
+    with open(args.output, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record) + "\n")
+    print(f"\nResults appended to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clinical data warehouse benchmarks")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    memory = commands.add_parser('memory', help="memory footprint of the Patient/Visit model")
+    memory.add_argument('--visits', type=int, default=1000000)
+    memory.set_defaults(func=bench_memory)
+
+    load = commands.add_parser('load', help="Department.load_data against the original row loader")
+    load.add_argument('--visits', type=int, default=1000000)
+    load.add_argument('--repeat', type=int, default=1)
+    load.set_defaults(func=bench_load)
+
+    startup = commands.add_parser('startup', help="cold CSV load against warm snapshot load")
+    startup.add_argument('--visits', type=int, default=1000000)
+    startup.add_argument('--notes', type=int, default=100000)
+    startup.add_argument('--repeat', type=int, default=3)
+    startup.set_defaults(func=bench_startup)
+
+    parallel = commands.add_parser('parallel', help="CSV loading across worker process counts")
+    parallel.add_argument('--visits', type=int, default=2000000)
+    parallel.add_argument('--notes', type=int, default=100000)
+    parallel.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parallel.add_argument('--repeat', type=int, default=1)
+    parallel.set_defaults(func=bench_parallel)
+
+    login = commands.add_parser('login', help="concurrent authenticate_user throughput")
+    login.add_argument('--users', type=int, default=5000)
+    login.add_argument('--logins', type=int, default=500)
+    login.add_argument('--threads', type=int, default=8)
+    login.add_argument('--iterations', type=int, default=HASH_ITERATIONS)
+    login.set_defaults(func=bench_login)
+
+    suite = commands.add_parser('suite', help="time and peak memory of the data layer, recorded as JSON")
+    suite.add_argument('--scales', type=int, nargs='+', default=[10000, 100000, 1000000],
+                       help="visit counts to run at (10K to 10M)")
+    suite.add_argument('--notes-ratio', type=float, default=0.1, help="notes per visit")
+    suite.add_argument('--users', type=int, default=10000)
+    suite.add_argument('--lookups', type=int, default=200, help="calls per point-query benchmark")
+    suite.add_argument('--memory-limit', type=int, default=64 * 2 ** 20,
+                       help="memory_limit for chunked generate_all_statistics")
+    suite.add_argument('--repeat', type=int, default=1)
+    suite.add_argument('--no-memory', action='store_true', help="skip the tracemalloc peak-memory runs")
+    suite.add_argument('--output', default='benchmark_results.jsonl')
+    suite.add_argument('--compare', action='store_true', help="show timings relative to the last recorded run")
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
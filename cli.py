@@ -0,0 +1,245 @@
+import argparse
+import contextlib
+import csv
+import getpass
+import json
+import sys
+import time
+
+from indexes import parse_date
+from log_usage import log_event
+from patients import FIELDNAMES
+from stats import by_age_group, by_count
+from storage import open_department, open_notes
+
+# Non-interactive entry point for batch jobs, alongside the Tk application in main.py:
+#   python cli.py ingest-visits nightly_visits.csv
+#   python cli.py --format json count --from 2024-01-01 --to 2024-01-31 --by-department
+# Results go to stdout (or --output) as CSV, JSON or JSON lines; progress goes to stderr.
+NOTE_FIELDS = ['Patient_ID', 'Visit_ID', 'Note_ID', 'Note_text']
+PATIENT_FIELDS = ['Patient_ID', 'Gender', 'Race', 'Age', 'Ethnicity', 'Insurance', 'Zip_code', 'Visits']
+ROLE = 'batch'
+
+
+class CliError(Exception):
+    pass
+
+
+def read_records(path):
+    # Row dicts from a CSV file, a JSON array or JSON lines (.jsonl).
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as file:
+            return [json.loads(line) for line in file if line.strip()]
+    if path.endswith('.json'):
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    with open(path, newline='', encoding='utf-8') as file:
+        return list(csv.DictReader(file))
+
+
+def write_records(records, fieldnames, args):
+    file = open(args.output, 'w', newline='', encoding='utf-8') if args.output else args.stdout
+    try:
+        if args.format == 'csv':
+            writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction='ignore', lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(records)
+        elif args.format == 'jsonl':
+            for record in records:
+                file.write(json.dumps(record, default=str) + "\n")
+        else:
+            json.dump(list(records), file, indent=2, default=str)
+            file.write("\n")
+    finally:
+        if file is not args.stdout:
+            file.close()
+
+
+def _rate(count, started):
+    elapsed = time.perf_counter() - started
+    return elapsed, count / elapsed if elapsed else 0.0
+
+
+def ingest_visits(args):
+    department = open_department(args.data, compact_threshold=0, workers=args.workers)
+    results = []
+    for path in args.files:
+        rows = read_records(path)
+        started = time.perf_counter()
+        try:
+            count = department.add_visits(rows)
+        except ValueError as e:
+            raise CliError(f"{path}: {str(e).rstrip('.')}; nothing was ingested from it")
+        elapsed, rate = _rate(count, started)
+        print(f"{path}: {count} visits in {elapsed:.2f} s ({rate:,.0f} rows/s)", file=sys.stderr)
+        log_event(args.user, ROLE, f"Ingested {count} visits from {path}")
+        results.append({'file': path, 'visits': count, 'seconds': round(elapsed, 3)})
+    if args.compact:
+        department.compact()
+    write_records(results, ['file', 'visits', 'seconds'], args)
+
+
+def ingest_notes(args):
+    notes_db = open_notes(args.notes, lazy=True)
+    results = []
+    for path in args.files:
+        records = read_records(path)
+        missing = [name for name in NOTE_FIELDS if records and name not in records[0]]
+        if missing:
+            raise CliError(f"{path}: missing columns {', '.join(missing)}")
+        started = time.perf_counter()
+        try:
+            count = len(notes_db.add_notes([record[name] for name in NOTE_FIELDS] for record in records))
+        except ValueError as e:
+            raise CliError(f"{path}: {str(e).rstrip('.')}; nothing was ingested from it")
+        elapsed, rate = _rate(count, started)
+        print(f"{path}: {count} notes in {elapsed:.2f} s ({rate:,.0f} rows/s)", file=sys.stderr)
+        log_event(args.user, ROLE, f"Ingested {count} notes from {path}")
+        results.append({'file': path, 'notes': count, 'seconds': round(elapsed, 3)})
+    write_records(results, ['file', 'notes', 'seconds'], args)
+
+
+def count(args):
+    department = open_department(args.data, workers=args.workers)
+    if args.date is not None:
+        start = end = args.date
+    elif args.start is not None and args.end is not None:
+        start, end = args.start, args.end
+    else:
+        raise CliError("give --date, or both --from and --to")
+    try:
+        parse_date(start), parse_date(end)
+    except ValueError:
+        raise CliError("dates must be YYYY-MM-DD")
+
+    if args.by_department:
+        records = [{'Visit_department': name, 'Visits': visits}
+                   for name, visits in sorted(department.count_visits_by_department(start, end).items())]
+    else:
+        records = [{'Visit_department': args.department or '',
+                    'Visits': department.count_visits_between(start, end, args.department)}]
+    log_event(args.user, ROLE, f"Counted visits from {start} to {end}")
+    write_records(records, ['Visit_department', 'Visits'], args)
+
+
+def retrieve(args):
+    department = open_department(args.data, workers=args.workers)
+    if args.patient_id not in department.patients:
+        raise CliError(f"patient {args.patient_id} not found")
+    log_event(args.user, ROLE, f"Retrieved patient {args.patient_id}", args.patient_id)
+    if args.page is not None:
+        if args.page < 1 or args.per_page < 1:
+            raise CliError("--page and --per-page must be at least 1")
+        patient, visits, total = department.visit_history(args.patient_id, args.page - 1, args.per_page)
+        print(f"Page {args.page} of {max((total + args.per_page - 1) // args.per_page, 1)} ({total} visits)",
+              file=sys.stderr)
+        write_records((department._row(patient, visit) for visit in visits), FIELDNAMES, args)
+        return
+    write_records(department.iter_rows(args.start, args.end, patient_ids=[args.patient_id]), FIELDNAMES, args)
+
+
+def notes(args):
+    department = open_department(args.data, workers=args.workers)
+    notes_db = open_notes(args.notes, lazy=True)
+    patient = department.patients.get(args.patient_id)
+    if patient is None:
+        raise CliError(f"patient {args.patient_id} not found")
+    day = parse_date(args.date) if args.date is not None else None
+    found = [note for visit in patient.visits if day is None or visit.visit_time.date() == day
+             for note in notes_db.get_notes_for_visit(args.patient_id, visit.visit_id)]
+    log_event(args.user, ROLE, f"Viewed notes for {args.patient_id}", args.patient_id)
+    write_records(({'Patient_ID': note.patient_id, 'Visit_ID': note.visit_id, 'Note_ID': note.note_id,
+                    'Note_text': note.note_text} for note in found), NOTE_FIELDS, args)
+
+
+def cohort(args):
+    department = open_department(args.data, workers=args.workers)
+    log_event(args.user, ROLE, f"Cohort query: {args.query}")
+    if args.count:
+        write_records([{'Query': args.query, 'Patients': department.count_cohort(args.query)}],
+                      ['Query', 'Patients'], args)
+        return
+    write_records(({'Patient_ID': patient.patient_id, 'Gender': patient.gender, 'Race': patient.race,
+                    'Age': patient.age, 'Ethnicity': patient.ethnicity, 'Insurance': patient.insurance,
+                    'Zip_code': patient.zip_code, 'Visits': patient.visit_count()}
+                   for patient in department.cohort(args.query)), PATIENT_FIELDS, args)
+
+
+def stats(args):
+    department = open_department(args.data, workers=args.workers)
+    aggregates = department.aggregates
+    sections = [('monthly_visits', aggregates.monthly_visits()),
+                ('insurance', by_count(aggregates.insurance)),
+                ('gender', by_count(aggregates.gender)),
+                ('race', by_count(aggregates.race)),
+                ('age_group', by_age_group(aggregates.age_groups)),
+                ('patients_by_insurance', list(aggregates.patient_insurance.items()))]
+    log_event(args.user, ROLE, "Generated key statistics")
+    write_records(({'Statistic': name, 'Key': key, 'Count': value} for name, counts in sections
+                   for key, value in counts), ['Statistic', 'Key', 'Count'], args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clinical data warehouse batch commands")
+    parser.add_argument('--data', default="Patient_data.csv", help="patient data CSV or SQLite database")
+    parser.add_argument('--notes', default="Notes.csv", help="notes CSV or SQLite database")
+    parser.add_argument('--format', choices=['csv', 'json', 'jsonl'], default='csv')
+    parser.add_argument('--output', help="write results here instead of stdout")
+    parser.add_argument('--user', default=getpass.getuser(), help="name recorded in the usage log")
+    parser.add_argument('--workers', type=int, default=1, help="processes used to parse large CSVs")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    visits = commands.add_parser('ingest-visits', help="append visits from Patient_data.csv-shaped files")
+    visits.add_argument('files', nargs='+')
+    visits.add_argument('--compact', action='store_true', help="fold the journal into the data file afterwards")
+    visits.set_defaults(func=ingest_visits)
+
+    note_files = commands.add_parser('ingest-notes', help="append notes from Notes.csv-shaped files")
+    note_files.add_argument('files', nargs='+')
+    note_files.set_defaults(func=ingest_notes)
+
+    counts = commands.add_parser('count', help="count visits on a date or over a date range")
+    counts.add_argument('--date')
+    counts.add_argument('--from', dest='start')
+    counts.add_argument('--to', dest='end')
+    counts.add_argument('--department')
+    counts.add_argument('--by-department', action='store_true')
+    counts.set_defaults(func=count)
+
+    patient = commands.add_parser('retrieve', help="a patient's visits")
+    patient.add_argument('patient_id')
+    patient.add_argument('--from', dest='start')
+    patient.add_argument('--to', dest='end')
+    patient.add_argument('--page', type=int, help="one page of visits, newest first (1 is the latest)")
+    patient.add_argument('--per-page', type=int, default=20)
+    patient.set_defaults(func=retrieve)
+
+    patient_notes = commands.add_parser('notes', help="a patient's notes, optionally for one visit date")
+    patient_notes.add_argument('patient_id')
+    patient_notes.add_argument('--date')
+    patient_notes.set_defaults(func=notes)
+
+    patients = commands.add_parser('cohort', help="patients matching filters such as "
+                                   "'age:51..65 insurance:Medicaid department:\"Emergency department\" year:2016'")
+    patients.add_argument('query')
+    patients.add_argument('--count', action='store_true', help="print only the number of patients")
+    patients.set_defaults(func=cohort)
+
+    statistics = commands.add_parser('stats', help="visit trends and demographics")
+    statistics.set_defaults(func=stats)
+
+    args = parser.parse_args(argv)
+    # The data layer reports problems with print(); keep that off the result stream.
+    args.stdout = sys.stdout
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            args.func(args)
+    except (CliError, OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+import datetime
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from indexes import parse_date
+
+# Cohort queries are space-separated field:value filters that must all hold, e.g.
+#   age:51..65 insurance:Medicaid department:"Emergency department" year:2016 complaint:"back pain"
+# A value may list alternatives (insurance:Medicaid|Medicare), age and date fields take
+# inclusive ranges with open ends allowed (age:65.., date:2016-01-01..2016-03-31), and a
+# leading "-" excludes (-race:Unknown). Text values match case-insensitively. All visit
+# filters must hold on the same visit: the cohort above is patients with at least one
+# Emergency department visit in 2016 for back pain.
+PATIENT_FIELDS = ('gender', 'race', 'ethnicity', 'insurance', 'zip_code', 'age')
+VISIT_FIELDS = ('visit_department', 'chief_complaint', 'note_type', 'visit_time')
+ALIASES = {'zip': 'zip_code', 'department': 'visit_department', 'complaint': 'chief_complaint',
+           'date': 'visit_time', 'year': 'visit_time', 'month': 'visit_time'}
+RANGE_FIELDS = ('age', 'visit_time')
+
+_FILTER = re.compile(r'(-?)(\w+):(?:"([^"]*)"|(\S+))')
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+class Predicate:
+    __slots__ = ('field', 'values', 'low', 'high', 'negate')
+
+    def __init__(self, field, values=None, low=None, high=None, negate=False):
+        self.field = field
+        # Case-folded alternatives for text fields; an inclusive low..high range otherwise.
+        self.values = values
+        self.low = low
+        self.high = high
+        self.negate = negate
+
+    @property
+    def on_visits(self):
+        return self.field in VISIT_FIELDS
+
+
+def _date_bounds(key, value):
+    # The first and last day of a year:, month: or date: value.
+    if key == 'year':
+        year = int(value)
+        return datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+    if key == 'month':
+        month = datetime.datetime.strptime(value, '%Y-%m').date()
+        following = (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        return month, following - datetime.timedelta(days=1)
+    day = parse_date(value)
+    return day, day
+
+
+def _parse_range(key, value):
+    low, sep, high = value.partition('..')
+    if key == 'age':
+        if not sep:
+            return int(value), int(value)
+        return int(low) if low else None, int(high) if high else None
+    if not sep:
+        return _date_bounds(key, value)
+    return (_date_bounds(key, low)[0] if low else None), (_date_bounds(key, high)[1] if high else None)
+
+
+def parse_cohort_query(query):
+    # Predicates for a cohort query; raises ValueError naming the part it could not read.
+    predicates = []
+    position = 0
+    for match in _FILTER.finditer(query):
+        if query[position:match.start()].strip():
+            break
+        position = match.end()
+        negate, key, quoted, bare = match.groups()
+        key = key.lower()
+        value = quoted if quoted is not None else bare
+        field = ALIASES.get(key, key)
+        if field not in PATIENT_FIELDS and field not in VISIT_FIELDS:
+            raise ValueError(f"Unknown cohort field: {key}")
+        if field in RANGE_FIELDS:
+            try:
+                low, high = _parse_range(key, value)
+            except ValueError:
+                raise ValueError(f"Invalid {key} value: {value}") from None
+            predicates.append(Predicate(field, low=low, high=high, negate=bool(negate)))
+        else:
+            values = {alternative.strip().casefold() for alternative in value.split('|')}
+            predicates.append(Predicate(field, values=values, negate=bool(negate)))
+    rest = query[position:].strip()
+    if rest:
+        raise ValueError(f"Cannot parse cohort query at: {rest}")
+    if not predicates:
+        raise ValueError("Empty cohort query")
+    return predicates
+
+
+class _Column:
+    # One categorical column of the index: a code per row plus a packed bitmap per value,
+    # each built the first time a query asks for it.
+    def __init__(self, codes, values, size):
+        self.codes = codes
+        self.values = values
+        self.size = size
+        self.codes_by_value = {}
+        for code, value in enumerate(values):
+            self.codes_by_value.setdefault(str(value).casefold(), []).append(code)
+        self._bitmaps = {}
+
+    @classmethod
+    def from_values(cls, values):
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+        return cls(codes.astype(np.int32), uniques.tolist(), len(codes))
+
+    def bitmap(self, code):
+        bitmap = self._bitmaps.get(code)
+        if bitmap is None:
+            bitmap = self._bitmaps[code] = np.packbits(self.codes == code)
+        return bitmap
+
+    def union(self, codes):
+        result = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        for code in codes:
+            result |= self.bitmap(code)
+        return result
+
+    def matching(self, folded_values):
+        return self.union(code for value in folded_values for code in self.codes_by_value.get(value, ()))
+
+
+class CohortIndex:
+    # Bitmap indexes over a Department's patients and visits, answering conjunctive cohort
+    # queries with bitwise ANDs. Patient rows are indexed by gender, race, ethnicity,
+    # insurance, zip code and age (one bitmap per year of age); visit rows by department,
+    # complaint, note type and month, with a day-sorted permutation to trim date ranges
+    # that start or end mid-month. The index is a snapshot of the Department at `version`.
+    def __init__(self, version, patient_ids, patient_columns, visit_patients, visit_columns, days):
+        self.version = version
+        self.patient_ids = patient_ids
+        self.patient_columns = patient_columns
+        self.visit_patients = visit_patients
+        self.visit_columns = visit_columns
+        self.days = days
+        self.day_order = np.argsort(days, kind='stable')
+        self.sorted_days = days[self.day_order]
+
+    @classmethod
+    def build(cls, patients, version):
+        with metrics.span("CohortIndex.build") as span:
+            patients = list(patients)
+            patient_ids = [patient.patient_id for patient in patients]
+            patient_columns = {name: _Column.from_values([getattr(patient, name) for patient in patients])
+                               for name in PATIENT_FIELDS}
+
+            # Visits still held in VisitColumns are read column-wise, one gather per store,
+            # without creating Visit objects; visits added since loading come from the
+            # Visit objects themselves.
+            stores = {}
+            loose = ([], [], [], [], [])
+            for ordinal, patient in enumerate(patients):
+                visits, parts = patient.visit_parts()
+                for visit in visits:
+                    loose[0].append(ordinal)
+                    loose[1].append(visit.visit_department)
+                    loose[2].append(visit.chief_complaint)
+                    loose[3].append(visit.note_type)
+                    loose[4].append(visit.visit_time.toordinal() - _EPOCH_ORDINAL)
+                for store, positions in parts:
+                    entry = stores.get(id(store))
+                    if entry is None:
+                        entry = stores[id(store)] = (store, [], [])
+                    entry[1].append(ordinal)
+                    entry[2].append(positions)
+
+            dictionaries = ({}, {}, {})
+            owners, days, codes = [], [], ([], [], [])
+
+            def encode(dictionary, values):
+                return np.array([dictionary.setdefault(value, len(dictionary)) for value in values], dtype=np.int32)
+
+            for store, ordinals, positions in stores.values():
+                lengths = [len(rows) for rows in positions]
+                positions = np.concatenate(positions)
+                owners.append(np.repeat(np.asarray(ordinals, dtype=np.int32), lengths))
+                days.append(store.days[positions])
+                for dictionary, target, (store_codes, values) in zip(
+                        dictionaries, codes, (store.departments, store.complaints, store.note_types)):
+                    target.append(encode(dictionary, values)[store_codes[positions]])
+            owners.append(np.asarray(loose[0], dtype=np.int32))
+            days.append(np.asarray(loose[4], dtype=np.int64))
+            for dictionary, target, values in zip(dictionaries, codes, loose[1:4]):
+                target.append(encode(dictionary, values))
+
+            visit_patients = np.concatenate(owners)
+            days = np.concatenate(days).astype(np.int64)
+            months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+            size = len(days)
+            visit_columns = {name: _Column(np.concatenate(target), list(dictionary), size)
+                             for name, dictionary, target in zip(VISIT_FIELDS, dictionaries, codes)}
+            visit_columns['month'] = _Column.from_values(months)
+            span.add(rows=len(visit_patients))
+        return cls(version, patient_ids, patient_columns, visit_patients, visit_columns, days)
+
+    def _age_bitmap(self, predicate):
+        column = self.patient_columns['age']
+        low = -np.inf if predicate.low is None else predicate.low
+        high = np.inf if predicate.high is None else predicate.high
+        return column.union(code for code, age in enumerate(column.values) if low <= age <= high)
+
+    def _date_bitmap(self, predicate):
+        # Whole months in the range come from the month bitmaps; the days of a partly
+        # covered first or last month are looked up in the day-sorted permutation.
+        column = self.visit_columns['month']
+        size = len(self.days)
+        if not size:
+            return np.zeros(0, dtype=np.uint8)
+        low = int(self.sorted_days[0]) if predicate.low is None else predicate.low.toordinal() - _EPOCH_ORDINAL
+        high = int(self.sorted_days[-1]) if predicate.high is None else predicate.high.toordinal() - _EPOCH_ORDINAL
+        if low > high:
+            return np.zeros((size + 7) // 8, dtype=np.uint8)
+
+        def month_of(day):
+            return int(np.int64(day).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64))
+
+        def first_day(month):
+            return int(np.int64(month).astype('datetime64[M]').astype('datetime64[D]').astype(np.int64))
+
+        first_month, last_month = month_of(low), month_of(high)
+        full_low = first_month if first_day(first_month) == low else first_month + 1
+        full_high = last_month if first_day(last_month + 1) - 1 == high else last_month - 1
+        result = column.union(code for code, month in enumerate(column.values) if full_low <= month <= full_high)
+
+        edges = []
+        if full_low > first_month:
+            edges.append((low, min(high, first_day(first_month + 1) - 1)))
+        if full_high < last_month and (last_month != first_month or not edges):
+            edges.append((max(low, first_day(last_month)), high))
+        if edges:
+            mask = np.zeros(size, dtype=bool)
+            for edge_low, edge_high in edges:
+                start, stop = np.searchsorted(self.sorted_days, [edge_low, edge_high + 1])
+                mask[self.day_order[start:stop]] = True
+            result |= np.packbits(mask)
+        return result
+
+    def _bitmap(self, predicate):
+        if predicate.field == 'age':
+            return self._age_bitmap(predicate)
+        if predicate.field == 'visit_time':
+            return self._date_bitmap(predicate)
+        columns = self.visit_columns if predicate.on_visits else self.patient_columns
+        return columns[predicate.field].matching(predicate.values)
+
+    @staticmethod
+    def _intersect(size, bitmaps):
+        result = np.packbits(np.ones(size, dtype=bool))
+        for bitmap, negate in bitmaps:
+            result &= ~bitmap if negate else bitmap
+        return result
+
+    def match_ordinals(self, predicates):
+        patients = [(self._bitmap(p), p.negate) for p in predicates if not p.on_visits]
+        visits = [(self._bitmap(p), p.negate) for p in predicates if p.on_visits]
+        result = self._intersect(len(self.patient_ids), patients)
+        if visits:
+            matched = self._intersect(len(self.days), visits)
+            owners = self.visit_patients[np.flatnonzero(np.unpackbits(matched, count=len(self.days)))]
+            seen = np.zeros(len(self.patient_ids), dtype=bool)
+            seen[owners] = True
+            result &= np.packbits(seen)
+        return np.flatnonzero(np.unpackbits(result, count=len(self.patient_ids)))
+
+    def match(self, predicates):
+        # IDs of the matching patients, in Department.patients order.
+        return [self.patient_ids[ordinal] for ordinal in self.match_ordinals(predicates).tolist()]
+
+    def count(self, predicates):
+        return len(self.match_ordinals(predicates))
+
+
+class CohortIndexCache:
+    # The CohortIndex for a Department, rebuilt on the first query after the Department's
+    # version changes. Queries hold the Department's read lock; concurrent first queries
+    # build the index once.
+    def __init__(self):
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self, department):
+        index = self._index
+        if index is None or index.version != department.version:
+            with self._lock:
+                index = self._index
+                if index is None or index.version != department.version:
+                    index = self._index = CohortIndex.build(department.patients.values(), department.version)
+        return index
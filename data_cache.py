@@ -0,0 +1,18 @@
+import threading
+
+from storage import open_department
+
+_lock = threading.Lock()
+_departments = {}
+
+
+def get_department(file_path, name="General"):
+    # One Department per data file and department name for the whole process, reloaded
+    # only when the file or its journal was changed from outside. The name only selects
+    # data in a shard directory, where each department opens its own shards.
+    with _lock:
+        key = (file_path, name)
+        department = _departments.get(key)
+        if department is None or department.is_stale():
+            department = _departments[key] = open_department(file_path, name)
+        return department
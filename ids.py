@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+# The IDs already in Patient_data.csv and Notes.csv are six-digit numbers.
+FIRST_ID = 100000
+STATE_FILE = "ids.json"
+# Numeric IDs below this are tracked in a bitmap (one bit each, 32 MiB at most);
+# larger or non-numeric IDs go to a set.
+BITMAP_LIMIT = 1 << 28
+
+
+class IdAllocator:
+    # Unique IDs for one column (Visit_ID or Note_ID). Every ID loaded or added is recorded,
+    # so membership is O(1), and new IDs come from a high-water mark above every numeric ID
+    # seen or handed out, so allocation never collides and never searches. IDs are compared
+    # by numeric value ("00123" and "123" are the same), which can only err on the side of
+    # treating an ID as taken. The mark is persisted in ids.json next to the data files and
+    # re-read before every allocation, so IDs are not reused across restarts or processes.
+    # Columns handed to defer() are only recorded on the allocator's first use, which keeps
+    # their conversion off the load path.
+    def __init__(self, name, state_path, first=FIRST_ID):
+        self.name = name
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._bitmap = np.zeros(0, dtype=np.uint8)
+        self._other = set()
+        self._next = max(first, self._persisted())
+        self._deferred = []
+        self._settle_lock = threading.Lock()
+
+    def _persisted(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as file:
+                return int(json.load(file).get(self.name, 0))
+        except (OSError, ValueError, AttributeError):
+            return 0
+
+    def _save(self, high_water):
+        try:
+            with open(self.state_path, encoding='utf-8') as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            state = {}
+        state[self.name] = max(int(state.get(self.name, 0)), high_water)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self.state_path)
+
+    def _grow(self, number):
+        if number >> 3 >= len(self._bitmap):
+            bitmap = np.zeros(max((number >> 3) + 1, 2 * len(self._bitmap)), dtype=np.uint8)
+            bitmap[:len(self._bitmap)] = self._bitmap
+            self._bitmap = bitmap
+
+    @staticmethod
+    def _number(value):
+        # Parsed the way pd.to_numeric parses a column in add_many().
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        return int(number) if number % 1 == 0 and 0 <= number < BITMAP_LIMIT else None
+
+    def add(self, value):
+        if value is None or value == '':
+            return
+        number = self._number(value)
+        with self._lock:
+            if number is None:
+                self._other.add(str(value).strip())
+                return
+            self._grow(number)
+            self._bitmap[number >> 3] |= 1 << (number & 7)
+            if number >= self._next:
+                self._next = number + 1
+
+    def add_many(self, values):
+        # Vectorized add() for a whole column of a loaded chunk.
+        values = np.asarray(values, dtype=object)
+        try:
+            # Fast path for the usual all-integer column.
+            numbers = np.array(values, dtype=np.int64)
+            numeric = (numbers >= 0) & (numbers < BITMAP_LIMIT)
+        except (ValueError, OverflowError):
+            numbers = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy()
+            with np.errstate(invalid='ignore'):
+                numeric = (numbers % 1 == 0) & (numbers >= 0) & (numbers < BITMAP_LIMIT)
+        others = values[~numeric & (values != '')].tolist() if not numeric.all() else []
+        numbers = numbers[numeric].astype(np.int64)
+        with self._lock:
+            self._other.update(str(value).strip() for value in others)
+            if len(numbers):
+                high = int(numbers.max())
+                self._grow(high)
+                np.bitwise_or.at(self._bitmap, numbers >> 3, (1 << (numbers & 7)).astype(np.uint8))
+                if high >= self._next:
+                    self._next = high + 1
+
+    def defer(self, values):
+        # add_many(values) on first use; the caller must not change `values` meanwhile.
+        with self._settle_lock:
+            self._deferred.append(values)
+
+    def _settle(self):
+        # A column is dropped from _deferred only once added, so a thread that finds the list
+        # empty never misses an ID another thread is still adding.
+        if self._deferred:
+            with self._settle_lock:
+                while self._deferred:
+                    self.add_many(self._deferred[-1])
+                    self._deferred.pop()
+
+    def __contains__(self, value):
+        self._settle()
+        number = self._number(value)
+        if number is None:
+            return str(value).strip() in self._other
+        index = number >> 3
+        return index < len(self._bitmap) and bool(self._bitmap[index] & (1 << (number & 7)))
+
+    def checkpoint(self):
+        # Persists the mark, e.g. after adding IDs that were not allocated here, so that
+        # allocators that never load those IDs still number above them.
+        self._settle()
+        with self._lock:
+            self._save(self._next)
+
+    def allocate(self):
+        return self.reserve(1)[0]
+
+    def reserve(self, count):
+        # A block of `count` consecutive unused IDs, e.g. for a bulk ingest. The new mark is
+        # persisted before the IDs are handed out.
+        self._settle()
+        with self._lock:
+            start = max(self._next, self._persisted())
+            self._next = start + count
+            self._save(self._next)
+        ids = [str(number) for number in range(start, start + count)]
+        for value in ids:
+            self.add(value)
+        return ids
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_allocator(name, data_path):
+    # One allocator per column and data directory for the whole process, shared by the
+    # Department and NotesDatabase working on files there.
+    state_path = os.path.join(os.path.dirname(os.path.abspath(data_path)), STATE_FILE)
+    with _allocators_lock:
+        allocator = _allocators.get((state_path, name))
+        if allocator is None:
+            allocator = _allocators[(state_path, name)] = IdAllocator(name, state_path)
+        return allocator
@@ -0,0 +1,177 @@
+import datetime
+import threading
+
+import metrics
+
+
+class _Fenwick:
+    def __init__(self, size):
+        self.tree = [0] * (size + 1)
+
+    @classmethod
+    def from_counts(cls, size, counts):
+        fenwick = cls(size)
+        tree = fenwick.tree
+        for i, count in counts.items():
+            tree[i + 1] += count
+        # Linear-time construction: push each node's total into its parent.
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        return fenwick
+
+    def add(self, i, delta):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        # Sum of positions 0..i inclusive.
+        if i < 0:
+            return 0
+        i = min(i + 1, len(self.tree) - 1)
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+
+class VisitDateIndex:
+    def __init__(self, source=None):
+        # With a source, the date -> visits lists are only built on the first visits_on call;
+        # until then only the counts are maintained.
+        self._source = source
+        self.visits = None if source is not None else {}
+        self.counts = {}
+        self.department_counts = {}
+        self._origin = None
+        self._size = 0
+        self._trees = None
+        # Lazy structures may be first needed by several concurrent readers at once.
+        self._build_lock = threading.Lock()
+
+    def add(self, patient_id, visit):
+        date = visit.visit_time.date()
+        if self.visits is not None:
+            self.visits.setdefault(date, []).append((patient_id, visit))
+        self._bump(date, visit.visit_department, 1)
+
+    def add_counts(self, counts):
+        # Bulk load path: ((date, department), count) pairs for visits the source already holds.
+        self._trees = None
+        totals = self.counts
+        for (date, department), count in counts:
+            totals[date] = totals.get(date, 0) + count
+            department_counts = self.department_counts.get(department)
+            if department_counts is None:
+                department_counts = self.department_counts[department] = {}
+            department_counts[date] = department_counts.get(date, 0) + count
+
+    def remove(self, patient_id, visit):
+        date = visit.visit_time.date()
+        if self.visits is not None:
+            entries = self.visits.get(date)
+            if not entries:
+                return
+            try:
+                entries.remove((patient_id, visit))
+            except ValueError:
+                return
+            if not entries:
+                del self.visits[date]
+        self._bump(date, visit.visit_department, -1)
+
+    def _ensure_visits(self):
+        if self.visits is not None:
+            return
+        with self._build_lock:
+            if self.visits is not None:
+                return
+            with metrics.span("VisitDateIndex.build_visits") as span:
+                visits = {}
+                for patient_id, visit in self._source():
+                    visits.setdefault(visit.visit_time.date(), []).append((patient_id, visit))
+                span.add(rows=sum(len(entries) for entries in visits.values()))
+            self.visits = visits
+
+    def _bump(self, date, department, delta):
+        for counts in (self.counts, self.department_counts.setdefault(department, {})):
+            counts[date] = counts.get(date, 0) + delta
+            if not counts[date]:
+                del counts[date]
+        if self._trees is None:
+            return
+        ordinal = date.toordinal()
+        if self._origin is None or not self._origin <= ordinal < self._origin + self._size:
+            # Out of the covered day range: rebuild lazily on the next range query.
+            self._trees = None
+            return
+        for key in (None, department):
+            tree = self._trees.get(key)
+            if tree is None:
+                tree = self._trees[key] = _Fenwick(self._size)
+            tree.add(ordinal - self._origin, delta)
+
+    def _ensure_trees(self):
+        if self._trees is not None:
+            return
+        with self._build_lock:
+            if self._trees is not None:
+                return
+            if not self.counts:
+                self._origin, self._size, self._trees = None, 0, {}
+                return
+            low = min(self.counts).toordinal()
+            high = max(self.counts).toordinal()
+            # Leave headroom on both sides so new visits rarely force a rebuild.
+            margin = max((high - low) // 2, 366)
+            self._origin = low - margin
+            self._size = high - low + 1 + 2 * margin
+            with metrics.span("VisitDateIndex.build_trees"):
+                trees = {None: self._build(self.counts)}
+                for department, counts in self.department_counts.items():
+                    trees[department] = self._build(counts)
+            # Published last, so other readers never see a half-built set of trees.
+            self._trees = trees
+
+    def _build(self, counts):
+        return _Fenwick.from_counts(
+            self._size, {date.toordinal() - self._origin: count for date, count in counts.items()})
+
+    def count_on(self, date, department=None):
+        counts = self.counts if department is None else self.department_counts.get(department, {})
+        return counts.get(date, 0)
+
+    def visits_on(self, date, department=None):
+        self._ensure_visits()
+        entries = self.visits.get(date, [])
+        if department is None:
+            return list(entries)
+        return [(pid, visit) for pid, visit in entries if visit.visit_department == department]
+
+    def count_between(self, start, end, department=None):
+        self._ensure_trees()
+        tree = self._trees.get(department)
+        if tree is None or start > end:
+            return 0
+        low = start.toordinal() - self._origin
+        high = end.toordinal() - self._origin
+        return tree.prefix(high) - tree.prefix(low - 1)
+
+    def count_by_department(self, start, end):
+        return {department: self.count_between(start, end, department)
+                for department in self.department_counts}
+
+    def departments(self):
+        return [department for department, counts in self.department_counts.items() if counts]
+
+
+def parse_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
@@ -1,18 +1,162 @@
+import atexit
 import csv
 import datetime
+import itertools
 import os
+import queue
+import threading
+import time
 
-def log_event(username, role, action):
-    log_file = "usage_log.csv"
-    file_exists = os.path.exists(log_file)
+import metrics
 
-    with open(log_file, mode='a', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        if not file_exists:
-            writer.writerow(["Timestamp", "Username", "Role", "Action"])
-        writer.writerow([
+LOG_HEADER = ["Timestamp", "Username", "Role", "Action", "Patient_ID"]
+_TICK = object()
+
+
+def active_day(log_file):
+    # The day of the events in the active log file, from its first row; the file's
+    # modification day if it has no readable row.
+    try:
+        with open(log_file, newline='', encoding='utf-8') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            row = next(reader, None)
+        if row:
+            return datetime.datetime.strptime(row[0][:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        pass
+    return datetime.datetime.fromtimestamp(os.path.getmtime(log_file)).strftime('%Y-%m-%d')
+
+
+class UsageLogger:
+    # Events are queued by the caller and written by a background thread in batches, so
+    # logging never does file I/O on the Tk thread.
+    def __init__(self, log_file="usage_log.csv", batch_size=100, flush_interval=1.0,
+                 max_bytes=10 * 1024 * 1024):
+        self.log_file = log_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="usage-logger", daemon=True)
+        self._thread.start()
+
+    def log(self, username, role, action, patient_id=""):
+        if self._closed:
+            return
+        self._queue.put([
             datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             username,
             role,
-            action
+            action,
+            patient_id
         ])
+
+    def flush(self, timeout=None):
+        # Blocks until everything queued so far has been written. Returns False without
+        # waiting once the logger is closed, and False if the writer thread stops or
+        # `timeout` seconds pass first.
+        if self._closed or not self._thread.is_alive():
+            return False
+        done = threading.Event()
+        self._queue.put(done)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not done.wait(0.1):
+            if not self._thread.is_alive() or (deadline is not None and time.monotonic() >= deadline):
+                return False
+        return True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = _TICK
+
+            if item is None:
+                if batch:
+                    self._write(batch)
+                return
+            if isinstance(item, threading.Event):
+                if batch:
+                    self._write(batch)
+                    batch, deadline = [], None
+                item.set()
+                continue
+            if item is not _TICK:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch, deadline = [], None
+
+    def _rotate_if_needed(self, day):
+        # Every file holds a single day's events, which is what lets audit.py pick the
+        # partitions for a date range from their names alone.
+        if not os.path.exists(self.log_file):
+            return
+        file_day = active_day(self.log_file)
+        if file_day == day and os.path.getsize(self.log_file) < self.max_bytes and self._has_current_header():
+            return
+        base, ext = os.path.splitext(self.log_file)
+        target = f"{base}.{file_day}{ext}"
+        suffix = 1
+        while os.path.exists(target):
+            target = f"{base}.{file_day}.{suffix}{ext}"
+            suffix += 1
+        os.replace(self.log_file, target)
+
+    def _has_current_header(self):
+        # Logs written before the Patient_ID column was added are rotated out rather than
+        # appended to under the old header.
+        with open(self.log_file, newline='', encoding='utf-8') as file:
+            return next(csv.reader(file), LOG_HEADER) == LOG_HEADER
+
+    def _write(self, rows):
+        # A batch that spans midnight goes to one partition per day, by each event's timestamp.
+        try:
+            for day, day_rows in itertools.groupby(rows, key=lambda row: row[0][:10]):
+                day_rows = list(day_rows)
+                self._rotate_if_needed(day)
+                file_exists = os.path.exists(self.log_file)
+                with open(self.log_file, mode='a', newline='', encoding='utf-8') as file, \
+                        metrics.span("UsageLogger.write") as span:
+                    start = file.tell()
+                    writer = csv.writer(file)
+                    if not file_exists:
+                        writer.writerow(LOG_HEADER)
+                    writer.writerows(day_rows)
+                    span.add(rows=len(day_rows), bytes_written=file.tell() - start)
+        except OSError as e:
+            print(f"Could not write usage log: {e}")
+
+
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_logger():
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            _logger = UsageLogger()
+            atexit.register(_logger.close)
+        return _logger
+
+
+@metrics.timed("log_usage.log_event")
+def log_event(username, role, action, patient_id=""):
+    get_logger().log(username, role, action, patient_id)
@@ -0,0 +1,218 @@
+import atexit
+import bisect
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+
+# Opt-in timing and counters for the data layer. Nothing is recorded unless CDW_METRICS
+# is set (or enable() is called); disabled spans and decorators cost a flag check.
+# With CDW_METRICS_FILE set, the collected metrics are written there at exit.
+ENABLE_VARIABLE = 'CDW_METRICS'
+FILE_VARIABLE = 'CDW_METRICS_FILE'
+DEFAULT_DUMP_FILE = 'metrics.json'
+# Upper bounds, in seconds, of the latency histogram buckets; the last bucket is open.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+_enabled = os.environ.get(ENABLE_VARIABLE, '') not in ('', '0')
+_metrics = {}
+_lock = threading.Lock()
+
+
+class Metric:
+    __slots__ = ('name', 'calls', 'total', 'min', 'max', 'buckets', 'rows', 'bytes_read', 'bytes_written')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def record(self, elapsed, rows=0, bytes_read=0, bytes_written=0):
+        self.calls += 1
+        self.total += elapsed
+        self.min = elapsed if self.min is None else min(self.min, elapsed)
+        self.max = max(self.max, elapsed)
+        self.buckets[bisect.bisect_left(BUCKETS, elapsed)] += 1
+        self.rows += rows
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the given fraction of calls, capped at the
+        # slowest call seen.
+        if not self.calls:
+            return 0.0
+        target = fraction * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS + (self.max,), self.buckets):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'total_seconds': self.total,
+            'mean_seconds': self.total / self.calls if self.calls else 0.0,
+            'min_seconds': self.min or 0.0,
+            'max_seconds': self.max,
+            'p50_seconds': self.percentile(0.5),
+            'p95_seconds': self.percentile(0.95),
+            'histogram': {(f"<={bound}" if i < len(BUCKETS) else f">{BUCKETS[-1]}"): count
+                          for i, (bound, count) in enumerate(zip(BUCKETS + (None,), self.buckets))},
+            'rows': self.rows,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+        }
+
+
+class Span:
+    # One timed call; counts can be added while it runs and are recorded with it.
+    __slots__ = ('name', 'rows', 'bytes_read', 'bytes_written', '_started')
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._started = None
+
+    def add(self, rows=0, bytes_read=0, bytes_written=0):
+        self.rows += rows
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        elapsed = time.perf_counter() - self._started
+        with _lock:
+            metric = _metrics.get(self.name)
+            if metric is None:
+                metric = _metrics[self.name] = Metric(self.name)
+            metric.record(elapsed, self.rows, self.bytes_read, self.bytes_written)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def add(self, rows=0, bytes_read=0, bytes_written=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name):
+    # with metrics.span("Department.load_data") as s: ...; s.add(rows=n)
+    return Span(name) if _enabled else _NULL_SPAN
+
+
+def timed(name=None, rows=None):
+    # Decorator timing every call; `rows`, if given, maps the return value to a row count.
+    def decorate(func):
+        metric_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(metric_name) as current:
+                result = func(*args, **kwargs)
+                if rows is not None and result is not None:
+                    current.add(rows=rows(result))
+                return result
+        return wrapper
+    return decorate
+
+
+def iterate(name, iterable, rows=len):
+    # Times each step of an iterator separately from the caller's work on the items,
+    # e.g. pulling chunks out of pd.read_csv(..., chunksize=...).
+    if not _enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with Span(name) as current:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            if rows is not None:
+                current.add(rows=rows(item))
+        yield item
+
+
+def snapshot():
+    with _lock:
+        return {name: metric.to_dict() for name, metric in sorted(_metrics.items())}
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+
+
+def report():
+    metrics = snapshot()
+    if not metrics:
+        return "No metrics recorded." if _enabled else f"Instrumentation is off (set {ENABLE_VARIABLE}=1)."
+    width = max(len(name) for name in metrics)
+    lines = [f"{'Operation':<{width}} {'Calls':>7} {'Total s':>9} {'Mean ms':>9} {'p95 ms':>9} "
+             f"{'Max ms':>9} {'Rows':>10} {'MiB read':>9} {'MiB written':>11}"]
+    for name, m in metrics.items():
+        lines.append(f"{name:<{width}} {m['calls']:>7} {m['total_seconds']:>9.3f} "
+                     f"{m['mean_seconds'] * 1000:>9.2f} {m['p95_seconds'] * 1000:>9.2f} "
+                     f"{m['max_seconds'] * 1000:>9.2f} {m['rows']:>10} {m['bytes_read'] / 2 ** 20:>9.1f} "
+                     f"{m['bytes_written'] / 2 ** 20:>11.1f}")
+    return "\n".join(lines)
+
+
+def dump(path=None):
+    path = path or os.environ.get(FILE_VARIABLE) or DEFAULT_DUMP_FILE
+    data = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'buckets': list(BUCKETS), 'metrics': snapshot()}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _dump_at_exit():
+    if _enabled and os.environ.get(FILE_VARIABLE) and _metrics:
+        try:
+            dump()
+        except OSError as e:
+            print(f"Could not write metrics: {e}")
+
+
+atexit.register(_dump_at_exit)
@@ -0,0 +1,133 @@
+import collections
+import csv
+import io
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+# Below this size starting worker processes costs more than it saves.
+MIN_PARALLEL_BYTES = 16 * 1024 * 1024
+# Ranges per worker; a few more than one keeps workers busy when rows vary in length.
+RANGES_PER_WORKER = 4
+_BLOCK = 1 << 20
+
+
+def should_parallelize(path, workers, start=0):
+    return workers > 1 and os.path.exists(path) and os.path.getsize(path) - start >= MIN_PARALLEL_BYTES
+
+
+def _count_quotes(mm, start, end):
+    return sum(mm[i:min(i + _BLOCK, end)].count(b'"') for i in range(start, end, _BLOCK))
+
+
+def _next_boundary(mm, pos, odd):
+    # First newline at or after pos that is outside quotes. `odd` is the quote parity of
+    # everything between the last known record boundary and pos: a newline is only a
+    # record boundary when the quotes before it are balanced, since "" escapes come in pairs.
+    while True:
+        newline = mm.find(b'\n', pos)
+        if newline < 0:
+            return len(mm)
+        odd ^= mm[pos:newline].count(b'"') & 1
+        pos = newline + 1
+        if not odd:
+            return pos
+
+
+def split_records(path, parts, start=None):
+    # Splits a CSV file into up to `parts` byte ranges that each hold whole records, so
+    # quoted multi-line fields (e.g. Note_text) never straddle two ranges. Returns the
+    # header record and the ranges; `start` skips an already processed prefix.
+    with open(path, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            return b'', []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header_end = _next_boundary(mm, 0, 0)
+            header = mm[:header_end]
+            begin = max(start or 0, header_end)
+            size = len(mm)
+            bounds = [begin]
+            for i in range(1, parts):
+                target = begin + (size - begin) * i // parts
+                if target <= bounds[-1]:
+                    continue
+                odd = _count_quotes(mm, bounds[-1], target) & 1
+                bounds.append(_next_boundary(mm, target, odd))
+            bounds.append(size)
+    return header, [(low, high) for low, high in zip(bounds, bounds[1:]) if low < high]
+
+
+def _read_range(path, start, end):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        return file.read(end - start)
+
+
+def _parse_frame(path, start, end, header, options):
+    return pd.read_csv(io.BytesIO(header + _read_range(path, start, end)), **options)
+
+
+def _parse_notes(path, start, end, columns):
+    pid_col, vid_col, nid_col, text_col = (columns.index(name) for name in
+                                           ('Patient_ID', 'Visit_ID', 'Note_ID', 'Note_text'))
+    reader = csv.reader(io.StringIO(_read_range(path, start, end).decode('utf-8'), newline=''))
+    return [(row[pid_col], row[vid_col], row[nid_col], row[text_col])
+            for row in reader if len(row) >= len(columns)]
+
+
+def _scan_note_offsets(path, start, end, columns):
+    pid_col, vid_col, nid_col = (columns.index(name) for name in ('Patient_ID', 'Visit_ID', 'Note_ID'))
+    data = _read_range(path, start, end)
+    offsets = []
+    pos = 0
+    while pos < len(data):
+        # Same record walk as NotesDatabase._scan_records: extend a line until its quotes balance.
+        stop = data.find(b'\n', pos) + 1 or len(data)
+        quotes = data.count(b'"', pos, stop)
+        while quotes % 2 and stop < len(data):
+            next_stop = data.find(b'\n', stop) + 1 or len(data)
+            quotes += data.count(b'"', stop, next_stop)
+            stop = next_stop
+        row = next(csv.reader(io.StringIO(data[pos:stop].decode('utf-8'), newline='')), [])
+        if len(row) >= len(columns):
+            offsets.append((row[pid_col], row[vid_col], row[nid_col], start + pos, start + stop))
+        pos = stop
+    return offsets
+
+
+def _map_ranges(func, path, workers, ranges, *args):
+    # Results come back in file order, so merging them reproduces a sequential load. Only
+    # a couple of ranges per worker are in flight, bounding memory on multi-GB files.
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for start, end in ranges:
+            pending.append(pool.submit(func, path, start, end, *args))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_csv_frames(path, workers, **options):
+    # Parallel replacement for pd.read_csv(path, chunksize=...): yields one DataFrame per
+    # record-aligned range, parsed in a process pool.
+    header, ranges = split_records(path, workers * RANGES_PER_WORKER)
+    return _map_ranges(_parse_frame, path, workers, ranges, header, options)
+
+
+def _columns(header):
+    return next(csv.reader(io.StringIO(header.decode('utf-8'), newline='')), [])
+
+
+def read_notes(path, workers):
+    # Yields lists of (Patient_ID, Visit_ID, Note_ID, Note_text) tuples in file order.
+    header, ranges = split_records(path, workers * RANGES_PER_WORKER)
+    return _map_ranges(_parse_notes, path, workers, ranges, _columns(header))
+
+
+def scan_note_offsets(path, workers, start=None):
+    # Yields lists of (Patient_ID, Visit_ID, Note_ID, record start, record end) in file order.
+    header, ranges = split_records(path, workers * RANGES_PER_WORKER, start)
+    return _map_ranges(_scan_note_offsets, path, workers, ranges, _columns(header))
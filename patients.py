@@ -1,142 +1,820 @@
+import bisect
 import csv
 import datetime
+import functools
+import gc
+import io
+import itertools
+import mmap
 import os
-import random
+import sys
+import threading
+import zlib
+import numpy as np
 import pandas as pd
+from cohort import CohortIndexCache, parse_cohort_query
+from ids import get_allocator
+from indexes import VisitDateIndex, parse_date
+from locks import ReadWriteLock
+import metrics
+from parallel import read_csv_frames, read_notes, scan_note_offsets, should_parallelize
+from snapshot import SnapshotWriter, read_snapshot
+from stats import VisitAggregates, parse_visit_times
+
+CATEGORICAL_FIELDS = ['Visit_time', 'Visit_department', 'Race', 'Gender', 'Ethnicity', 'Insurance',
+                      'Chief_complaint', 'Note_type']
+FIELDNAMES = ['Patient_ID', 'Visit_ID', 'Visit_time', 'Visit_department', 'Race',
+              'Gender', 'Ethnicity', 'Age', 'Zip_code', 'Insurance',
+              'Chief_complaint', 'Note_ID', 'Note_type']
+JOURNAL_FIELDNAMES = ['Op'] + FIELDNAMES
+
+def file_signature(file_path):
+    # (mtime, size) of the base file and its journal; changes whenever either is written.
+    signature = []
+    for path in (file_path, file_path + ".journal"):
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+@functools.lru_cache(maxsize=65536)
+def _parse_visit_time(visit_time):
+    # Visits on the same day share one datetime object.
+    try:
+        return datetime.datetime.strptime(visit_time, '%Y-%m-%d')
+    except ValueError:
+        try:
+            return datetime.datetime.strptime(visit_time, '%m/%d/%Y')
+        except ValueError:
+            raise ValueError(f"Invalid visit_time format: {visit_time}")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _parse_visit_time_column(values, shared_times):
+    # Parse each distinct date string once, detecting the format for the whole chunk
+    # instead of per row. Returns day numbers since 1970-01-01.
+    codes, uniques = _categorical(values)
+    uniques = pd.Series(uniques, dtype=object)
+    parsed = parse_visit_times(uniques)
+    missing = parsed.isna()
+    if missing.any():
+        raise ValueError(f"Invalid visit_time format: {uniques[missing].iloc[0]}")
+
+    unique_days = parsed.to_numpy().astype('datetime64[D]').astype(np.int64)
+    for day in unique_days.tolist():
+        if day not in shared_times:
+            shared_times[day] = _EPOCH + datetime.timedelta(days=day)
+    return unique_days[codes]
+
+def _categorical(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+        dtype = np.int8 if len(uniques) < 2 ** 7 else np.int16 if len(uniques) < 2 ** 15 else np.int32
+        codes = codes.astype(dtype)
+    return codes, [_intern(value) for value in uniques.tolist()]
+
+def _frame_from_snapshot(columns):
+    frame = {}
+    for name, (codes, uniques) in columns.items():
+        if name in CATEGORICAL_FIELDS:
+            frame[name] = pd.Categorical.from_codes(codes, categories=pd.Index(uniques, dtype=object))
+        else:
+            frame[name] = np.array(uniques, dtype=object)[codes]
+    return pd.DataFrame(frame)
+
+def _write_parquet(output_file, rows, batch_size):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("Parquet export requires pyarrow (pip install pyarrow).")
+        return None
+
+    schema = pa.schema([(name, pa.int64() if name == 'Age' else pa.string()) for name in FIELDNAMES])
+    count = 0
+    with pq.ParquetWriter(output_file, schema) as writer:
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+def _write_journal(journal_path, records):
+    # Appends records to a journal file and syncs it; returns the number of bytes written.
+    new_file = not os.path.exists(journal_path) or os.path.getsize(journal_path) == 0
+    with open(journal_path, 'a', newline='', encoding='utf-8') as file:
+        start = file.tell()
+        writer = csv.DictWriter(file, fieldnames=JOURNAL_FIELDNAMES, restval='')
+        if new_file:
+            writer.writeheader()
+        writer.writerows(records)
+        file.flush()
+        os.fsync(file.fileno())
+        return file.tell() - start
+
+_materialize_lock = threading.Lock()
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
 
 class Visit:
+    __slots__ = ('visit_id', 'visit_time', 'visit_department', 'chief_complaint', 'note_id', 'note_type')
+
     def __init__(self, visit_id, visit_time, visit_department, chief_complaint, note_id, note_type):
         self.visit_id = visit_id
         if isinstance(visit_time, datetime.datetime):
             self.visit_time = visit_time
         else:
-            try:
-                self.visit_time = datetime.datetime.strptime(visit_time, '%Y-%m-%d')
-            except ValueError:
-                try:
-                    self.visit_time = datetime.datetime.strptime(visit_time, '%m/%d/%Y')
-                except ValueError:
-                    raise ValueError(f"Invalid visit_time format: {visit_time}")
+            self.visit_time = _parse_visit_time(visit_time)
 
-        self.visit_department = visit_department
-        self.chief_complaint = chief_complaint
+        self.visit_department = _intern(visit_department)
+        self.chief_complaint = _intern(chief_complaint)
         self.note_id = note_id
-        self.note_type = note_type
+        self.note_type = _intern(note_type)
+
+class VisitColumns:
+    # Column-oriented storage for one bulk-loaded chunk of visits. Rows are grouped by
+    # patient through `order`; Visit objects are only created when a patient's visits
+    # are first accessed.
+    __slots__ = ('visit_ids', 'days', 'departments', 'complaints', 'note_ids', 'note_types',
+                 'order', 'times')
+
+    def __init__(self, visit_ids, days, departments, complaints, note_ids, note_types, order, times):
+        self.visit_ids = visit_ids
+        self.days = days
+        self.departments = departments
+        self.complaints = complaints
+        self.note_ids = note_ids
+        self.note_types = note_types
+        self.order = order
+        self.times = times
+
+    def visits(self, start, stop):
+        positions = self.order[start:stop]
+        department_codes, departments = self.departments
+        complaint_codes, complaints = self.complaints
+        note_type_codes, note_types = self.note_types
+        return [
+            Visit(visit_id, self.times[day], departments[department], complaints[complaint],
+                  note_id, note_types[note_type])
+            for visit_id, day, department, complaint, note_id, note_type in zip(
+                self.visit_ids[positions].tolist(), self.days[positions].tolist(),
+                department_codes[positions].tolist(), complaint_codes[positions].tolist(),
+                self.note_ids[positions].tolist(), note_type_codes[positions].tolist())
+        ]
+
+def _visit_time(visit):
+    return visit.visit_time
+
+def _last_day(pending):
+    store, start, stop = pending
+    return store.days[store.order[stop - 1]]
 
 class Patient:
+    # Visits are kept in time order (equal times in the order added), with their times in
+    # the parallel list _times for bisect. Each VisitColumns range is already in time order,
+    # so the latest visit is known without materializing the rows.
+    __slots__ = ('patient_id', 'gender', 'race', 'age', 'ethnicity', 'insurance', 'zip_code',
+                 '_visits', '_times', '_pending', '_latest')
+
     def __init__(self, patient_id, gender, race, age, ethnicity, insurance, zip_code):
         self.patient_id = patient_id
-        self.gender = gender
-        self.race = race
+        self.gender = _intern(gender)
+        self.race = _intern(race)
         self.age = age
-        self.ethnicity = ethnicity
-        self.insurance = insurance
+        self.ethnicity = _intern(ethnicity)
+        self.insurance = _intern(insurance)
         self.zip_code = zip_code
-        self.visits = []
+        self._visits = []
+        self._times = []
+        self._pending = None
+        self._latest = None
+
+    @property
+    def visits(self):
+        if self._pending is not None:
+            # Concurrent readers may reach this together; only one may materialize.
+            with _materialize_lock:
+                if self._pending is not None:
+                    for store, start, stop in self._pending:
+                        self._visits.extend(store.visits(start, stop))
+                    if len(self._pending) > 1:
+                        self._visits.sort(key=_visit_time)
+                    self._times = [visit.visit_time for visit in self._visits]
+                    self._pending = None
+        return self._visits
+
+    @visits.setter
+    def visits(self, visits):
+        self._visits = sorted(visits, key=_visit_time)
+        self._times = [visit.visit_time for visit in self._visits]
+        self._pending = None
+        self._latest = None
 
     def add_visit(self, visit):
-        self.visits.append(visit)
+        visits = self.visits
+        position = bisect.bisect_right(self._times, visit.visit_time)
+        visits.insert(position, visit)
+        self._times.insert(position, visit.visit_time)
+        if self._latest is not None and position == len(visits) - 1:
+            self._latest = visit
+
+    def add_visit_rows(self, store, start, stop):
+        self._latest = None
+        if self._pending is None:
+            if self._visits:
+                self._visits.extend(store.visits(start, stop))
+                self._visits.sort(key=_visit_time)
+                self._times = [visit.visit_time for visit in self._visits]
+                return
+            self._pending = []
+        self._pending.append((store, start, stop))
+
+    def latest_visit(self):
+        latest = self._latest
+        if latest is None:
+            with _materialize_lock:
+                if self._pending is None:
+                    latest = self._visits[-1] if self._visits else None
+                else:
+                    # The last row of each range is that range's latest; on a tie the later
+                    # range wins, as it sorts after the earlier one.
+                    store, start, stop = max(reversed(self._pending), key=_last_day)
+                    latest = store.visits(stop - 1, stop)[0]
+            self._latest = latest
+        return latest
+
+    def visit_page(self, page, per_page=20):
+        # Visits newest first, per_page at a time; page 0 holds the most recent. A patient
+        # whose visits all sit in one VisitColumns range is paged without materializing them.
+        pending = self._pending
+        if pending is not None and len(pending) == 1:
+            store, start, stop = pending[0]
+            stop -= page * per_page
+            return store.visits(max(stop - per_page, start), stop)[::-1] if stop > start else []
+        visits = self.visits
+        stop = len(visits) - page * per_page
+        if stop <= 0:
+            return []
+        return visits[max(stop - per_page, 0):stop][::-1]
+
+    def visit_count(self):
+        if self._pending is not None:
+            return len(self._visits) + sum(stop - start for store, start, stop in self._pending)
+        return len(self._visits)
+
+    def snapshot_visits(self):
+        # Visits as of now, without materializing column-backed rows on the patient.
+        if self._pending is not None:
+            pending = list(self._pending)
+            visits = itertools.chain.from_iterable(store.visits(start, stop) for store, start, stop in pending)
+            return visits if len(pending) == 1 else sorted(visits, key=_visit_time)
+        return list(self._visits)
+
+    def visit_parts(self):
+        # (materialized visits, [(VisitColumns, row positions)]), without materializing anything.
+        with _materialize_lock:
+            pending = self._pending or []
+            return list(self._visits), [(store, store.order[start:stop]) for store, start, stop in pending]
 
 class Department:
-    def __init__(self, name, file_path):
+    def __init__(self, name, file_path, compact_threshold=10000, use_snapshot=True, workers=1):
         self.name = name
         self.file_path = file_path
+        self.use_snapshot = use_snapshot
+        # Worker processes used to parse a large CSV; 1 keeps loading in-process.
+        self.workers = workers
+        self.journal_path = file_path + ".journal"
+        self.compact_threshold = compact_threshold
+        self.journal_entries = 0
+        # Queries share the read side; edits, journal appends and compaction take the write side.
+        self._lock = ReadWriteLock()
+        self._compact_lock = threading.Lock()
+        self._init_storage()
+        self.load_data()
+
+    def _init_storage(self):
+        # The in-memory state load_data() fills; other backends replace it with their own.
         self.patients = {}
         self.columns = []
-        self.load_data()
+        # The VisitColumns of the base file, kept only until the journal has been replayed.
+        self._stores = []
+        self.version = 0
+        self.signature = None
+        self.date_index = VisitDateIndex(self._iter_visits)
+        # Built on first use, then kept current by the edit hooks.
+        self._aggregates = None
+        self._aggregates_lock = threading.Lock()
+        self.cohort_index = CohortIndexCache()
+        # Every Visit_ID and Note_ID in the data, for collision-free allocation of new ones.
+        self.visit_ids = get_allocator('Visit_ID', self.file_path)
+        self.note_ids = get_allocator('Note_ID', self.file_path)
+
+    def load_data(self, chunksize=250000):
+        # The bulk load only creates acyclic objects; pausing the cyclic GC avoids
+        # repeated full-heap scans while hundreds of thousands of them are allocated.
+        with metrics.span("Department.load_data") as span:
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                self._load_base(chunksize)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
 
-    def load_data(self):
+            # The bulk loader skips per-visit bookkeeping; the base file is counted into the
+            # date index once here, and the index kept current incrementally from then on.
+            self._count_dates()
+            self.replay_journal()
+            self._stores = []
+            self.signature = file_signature(self.file_path)
+            span.add(rows=sum(self.date_index.counts.values()),
+                     bytes_read=sum(entry[1] for entry in self.signature if entry is not None))
+
+    def _load_base(self, chunksize):
         if not os.path.exists(self.file_path):
             print("File not found. Starting with empty department.")
+        else:
+            shared_times = {}
+            snapshot = None
+            if self.use_snapshot:
+                with metrics.span("Department.read_snapshot"):
+                    snapshot = read_snapshot(self.file_path)
+            if snapshot is not None:
+                for columns in snapshot:
+                    self.columns = list(columns)
+                    self._load_chunk(_frame_from_snapshot(columns), shared_times)
+            else:
+                writer = SnapshotWriter(self.file_path) if self.use_snapshot else None
+                try:
+                    header = pd.read_csv(self.file_path, nrows=0, encoding='utf-8').columns
+                    dtypes = {name: 'category' if name in CATEGORICAL_FIELDS else object for name in header}
+                    options = dict(dtype=dtypes, keep_default_na=False, na_filter=False, encoding='utf-8')
+                    if should_parallelize(self.file_path, self.workers):
+                        chunks = read_csv_frames(self.file_path, self.workers, **options)
+                    else:
+                        chunks = pd.read_csv(self.file_path, chunksize=chunksize, **options)
+                    for chunk in metrics.iterate("Department.parse_csv", chunks):
+                        self.columns = list(chunk.columns)
+                        self._load_chunk(chunk, shared_times)
+                        if writer is not None:
+                            writer.add_chunk({name: chunk[name] for name in chunk.columns})
+                except pd.errors.EmptyDataError:
+                    pass
+                if writer is not None:
+                    writer.write()
+
+    def _count_dates(self):
+        # Visits per (date, department) over all loaded chunks, as one vectorized count.
+        if not self._stores:
+            return
+        names = {}
+        mappings = [np.array([names.setdefault(name, len(names)) for name in store.departments[1]], dtype=np.int64)
+                    for store in self._stores]
+        keys = np.concatenate([store.days * len(names) + mapping[store.departments[0]]
+                               for store, mapping in zip(self._stores, mappings)])
+        keys, counts = np.unique(keys, return_counts=True)
+        names, times = list(names), self._stores[0].times
+        dates = {day: times[day].date() for day in np.unique(keys // len(names)).tolist()}
+        self.date_index.add_counts(((dates[key // len(names)], names[key % len(names)]), count)
+                                   for key, count in zip(keys.tolist(), counts.tolist()))
+
+    @property
+    def aggregates(self):
+        # The statistics are folded from the patients and the date index on first use rather
+        # than while loading; from then on the edit hooks keep them current.
+        aggregates = self._aggregates
+        if aggregates is None:
+            with self._lock.read(), self._aggregates_lock, metrics.span("Department.aggregate"):
+                aggregates = self._aggregates
+                if aggregates is None:
+                    aggregates = VisitAggregates()
+                    for patient in self.patients.values():
+                        aggregates.add_patient(patient, patient.visit_count())
+                    aggregates.add_date_counts(self.date_index.counts)
+                    self._aggregates = aggregates
+        return aggregates
+
+    def reading(self):
+        # Holds off edits for the duration of a with block, so that several reads (e.g. notes
+        # joined against visits) see one consistent state.
+        return self._lock.read()
+
+    def is_stale(self):
+        # True when the files were changed by something other than this Department.
+        if self._compact_lock.locked():
+            return False
+        with self._lock.read():
+            return self.signature != file_signature(self.file_path)
+
+    def _load_chunk(self, chunk, shared_times):
+        size = len(chunk)
+
+        def column(name):
+            if name not in chunk:
+                return np.full(size, '', dtype=object)
+            return np.asarray(chunk[name], dtype=object)
+
+        def categorical(name):
+            return _categorical(chunk[name]) if name in chunk else (np.zeros(size, dtype=np.int8), [''])
+
+        with metrics.span("Department.parse_dates") as span:
+            days = _parse_visit_time_column(chunk['Visit_time'], shared_times)
+            span.add(rows=size)
+        departments = categorical('Visit_department')
+
+        # Group the chunk's rows by patient, in time order within each patient (file order for
+        # visits on the same day).
+        patient_codes, patient_ids = pd.factorize(column('Patient_ID'))
+        low = int(days.min()) if size else 0
+        span = int(days.max()) - low + 1 if size else 1
+        if len(patient_ids) * span * size < 2 ** 63:
+            # One distinct int64 key per row, with the row number breaking ties, sorts several
+            # times faster than lexsort.
+            order = np.argsort((patient_codes * span + (days - low)) * size + np.arange(size))
+        else:
+            order = np.lexsort((days, patient_codes))
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(patient_codes, minlength=len(patient_ids)))))
+        visit_ids, note_ids = column('Visit_ID'), column('Note_ID')
+        self.visit_ids.defer(visit_ids)
+        self.note_ids.defer(note_ids)
+        store = VisitColumns(visit_ids, days, departments, categorical('Chief_complaint'),
+                             note_ids, categorical('Note_type'), order, shared_times)
+        self._stores.append(store)
+
+        # Patient fields come from each patient's first row in the file.
+        first = np.unique(patient_codes, return_index=True)[1]
+        ages = pd.to_numeric(pd.Series(column('Age')[first]), errors='coerce')
+        ages = ages.where(ages % 1 == 0).fillna(0).astype('int64').tolist()
+        patients = self.patients
+        for pid, gender, race, age, ethnicity, insurance, zip_code, start, stop in zip(
+                patient_ids.tolist(), column('Gender')[first].tolist(), column('Race')[first].tolist(), ages,
+                column('Ethnicity')[first].tolist(), column('Insurance')[first].tolist(),
+                column('Zip_code')[first].tolist(), bounds[:-1].tolist(), bounds[1:].tolist()):
+            patient = patients.get(pid)
+            if patient is None:
+                patient = patients[pid] = Patient(pid, gender, race, age, ethnicity, insurance, zip_code)
+            patient.add_visit_rows(store, start, stop)
+
+    def _apply_row(self, row, update_patient=False, loaded=()):
+        # `loaded` holds Visit_IDs that may already be in the base file (see replay_journal).
+        pid = str(row['Patient_ID'])
+        try:
+            age = int(row['Age'])
+        except ValueError:
+            age = 0
+
+        if pid not in self.patients:
+            self._new_patient(Patient(
+                pid, row['Gender'], row['Race'], age,
+                row['Ethnicity'], row['Insurance'], row['Zip_code']
+            ))
+        elif update_patient:
+            self._update_patient(self.patients[pid], row['Gender'], row['Race'], age,
+                                 row['Ethnicity'], row['Insurance'], row['Zip_code'])
+
+        if row['Visit_ID'] in loaded and any(visit.visit_id == row['Visit_ID']
+                                             for visit in self.patients[pid].visits):
             return
 
-        with open(self.file_path, newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            self.columns = reader.fieldnames
+        visit = Visit(
+            row['Visit_ID'],
+            row['Visit_time'],
+            row['Visit_department'],
+            row.get('Chief_complaint', ''),
+            row.get('Note_ID', ''),
+            row.get('Note_type', '')
+        )
+        self._add_visit(self.patients[pid], visit)
+
+    def _apply_update(self, row):
+        # An 'update' journal record: new patient fields for a patient whose changing visit
+        # was journaled elsewhere (see shards.py). The visit fields of the record are unused.
+        patient = self.patients.get(str(row['Patient_ID']))
+        if patient is None:
+            return
+        try:
+            age = int(row['Age'])
+        except ValueError:
+            age = 0
+        self._update_patient(patient, row['Gender'], row['Race'], age,
+                             row['Ethnicity'], row['Insurance'], row['Zip_code'])
+
+    def _iter_visits(self):
+        for pid, patient in list(self.patients.items()):
+            for visit in patient.visits:
+                yield pid, visit
+
+    def _new_patient(self, patient):
+        self.patients[patient.patient_id] = patient
+        if self._aggregates is not None:
+            self._aggregates.add_patient(patient)
+        self.version += 1
+        return patient
+
+    def _add_visit(self, patient, visit):
+        self.visit_ids.add(visit.visit_id)
+        self.note_ids.add(visit.note_id)
+        patient.add_visit(visit)
+        self.date_index.add(patient.patient_id, visit)
+        if self._aggregates is not None:
+            self._aggregates.add_visit(patient, visit)
+        self.version += 1
+
+    def _update_patient(self, patient, gender, race, age, ethnicity, insurance, zip_code):
+        aggregates = self._aggregates
+        if aggregates is not None:
+            aggregates.add_patient(patient, patient.visit_count(), delta=-1)
+        patient.gender = gender
+        patient.race = race
+        patient.age = age
+        patient.ethnicity = ethnicity
+        patient.insurance = insurance
+        patient.zip_code = zip_code
+        if aggregates is not None:
+            aggregates.add_patient(patient, patient.visit_count())
+        self.version += 1
+
+    def _drop_patient(self, patient_id):
+        patient = self.patients.pop(patient_id, None)
+        if patient is not None:
+            aggregates = self._aggregates
+            for visit in patient.visits:
+                self.date_index.remove(patient_id, visit)
+                if aggregates is not None:
+                    aggregates.add_visit(patient, visit, delta=-1)
+            if aggregates is not None:
+                aggregates.add_patient(patient, delta=-1)
+            self.version += 1
+        return patient
+
+    def _row(self, patient, visit):
+        return {
+            'Patient_ID': patient.patient_id,
+            'Visit_ID': visit.visit_id,
+            'Visit_time': visit.visit_time.strftime('%Y-%m-%d'),
+            'Visit_department': visit.visit_department,
+            'Race': patient.race,
+            'Gender': patient.gender,
+            'Ethnicity': patient.ethnicity,
+            'Age': patient.age,
+            'Zip_code': patient.zip_code,
+            'Insurance': patient.insurance,
+            'Chief_complaint': visit.chief_complaint,
+            'Note_ID': visit.note_id,
+            'Note_type': visit.note_type
+        }
+
+    def replay_journal(self):
+        # Journal records are applied on top of the base file in the order they were written.
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'rb+') as file:
+            data = file.read()
+            if data and not data.endswith(b'\n'):
+                # Drop a record torn by a crash in the middle of an append.
+                data = data[:data.rfind(b'\n') + 1]
+                file.truncate(len(data))
+
+        with metrics.span("Department.replay_journal") as span:
+            self.journal_entries = 0
+            lines = data.decode('utf-8').splitlines(keepends=True)
+            # A compaction interrupted after replacing the base file leaves records that are
+            # already in it; replaying an 'add' for a visit the patient already has only
+            # applies its patient fields, so replay is idempotent.
+            loaded = self._loaded_visit_ids({row['Visit_ID'] for row in csv.DictReader(lines)
+                                             if row.get('Op') == 'add' and row.get('Visit_ID')})
+            reader = csv.DictReader(lines)
+            # Records between 'begin' and 'commit' (written by add_visits) apply together.
+            batch = None
+            batch_line = 0
             for row in reader:
-                pid = str(row['Patient_ID'])
-                try:
-                    age = int(row['Age'])
-                except ValueError:
-                    age = 0
-
-                if pid not in self.patients:
-                    self.patients[pid] = Patient(
-                        pid, row['Gender'], row['Race'], age,
-                        row['Ethnicity'], row['Insurance'], row['Zip_code']
-                    )
+                op = row.get('Op')
+                if op == 'begin':
+                    batch, batch_line = [], reader.line_num - 1
+                    continue
+                if op == 'commit':
+                    rows, batch = batch or [], None
+                elif batch is not None:
+                    batch.append(row)
+                    continue
+                else:
+                    rows = [row]
+                for row in rows:
+                    op = row.get('Op')
+                    if op == 'add' and None not in row.values():
+                        self._apply_row(row, update_patient=True, loaded=loaded)
+                    elif op == 'remove':
+                        self._drop_patient(str(row['Patient_ID']))
+                    elif op == 'update' and None not in row.values():
+                        self._apply_update(row)
+                    else:
+                        continue
+                    self.journal_entries += 1
+            span.add(rows=self.journal_entries, bytes_read=len(data))
+
+        if batch is not None:
+            # A bulk insert cut off before its commit record is dropped as a whole.
+            with open(self.journal_path, 'rb+') as file:
+                file.truncate(len(''.join(lines[:batch_line]).encode('utf-8')))
+
+    def _loaded_visit_ids(self, visit_ids):
+        # Those of `visit_ids` that are in the base file as loaded.
+        if not visit_ids:
+            return set()
+        found = set()
+        for store in self._stores:
+            found.update(store.visit_ids[pd.Series(store.visit_ids).isin(visit_ids).to_numpy()].tolist())
+        return found
+
+    def add_visits(self, rows):
+        # Bulk insert of Patient_data.csv-shaped row dicts, journaled as one transaction:
+        # the records are framed by begin/commit markers and written with a single fsync.
+        # Every row is checked before any is applied. Returns the number of visits added.
+        records = self._visit_records(rows)
+        if not records:
+            return 0
+
+        with self._lock.write(), metrics.span("Department.add_visits") as span:
+            for record in records:
+                self._apply_row(record, update_patient=True)
+            self._append_journal([{'Op': 'begin'}] + records + [{'Op': 'commit'}])
+            span.add(rows=len(records))
+        return len(records)
 
-                visit = Visit(
-                    row['Visit_ID'],
-                    row['Visit_time'],
-                    row['Visit_department'],
-                    row.get('Chief_complaint', ''),
-                    row.get('Note_ID', ''),
-                    row.get('Note_type', '')
-                )
-                self.patients[pid].add_visit(visit)
+    def _visit_records(self, rows):
+        # Rows without a Visit_ID get one from a single reserved block; given IDs must be new.
+        records, missing, seen = [], [], set()
+        for number, row in enumerate(rows, 1):
+            record = {name: '' if row.get(name) is None else str(row.get(name)).strip() for name in FIELDNAMES}
+            if not record['Patient_ID']:
+                raise ValueError(f"Row {number}: Patient_ID is required")
+            visit_id = record['Visit_ID']
+            if not visit_id:
+                missing.append(record)
+            elif visit_id in self.visit_ids or visit_id in seen:
+                raise ValueError(f"Row {number}: Visit_ID {visit_id} already exists")
+            else:
+                seen.add(visit_id)
+            try:
+                _parse_visit_time(record['Visit_time'])
+            except ValueError as e:
+                raise ValueError(f"Row {number}: {e}") from None
+            record['Op'] = 'add'
+            records.append(record)
+        if missing:
+            for record, visit_id in zip(missing, self.visit_ids.reserve(len(missing))):
+                record['Visit_ID'] = visit_id
+        return records
+
+    def _append_journal(self, records):
+        with self._lock.write(), metrics.span("Department.append_journal") as span:
+            span.add(rows=len(records), bytes_written=_write_journal(self.journal_path, records))
+            self.journal_entries += len(records)
+            self.signature = file_signature(self.file_path)
+
+        if self.compact_threshold and self.journal_entries >= self.compact_threshold:
+            self.compact_in_background()
+
+    def _write_base(self, snapshot):
+        tmp_path = self.file_path + ".tmp"
+        with metrics.span("Department.write_base") as span:
+            with open(tmp_path, 'w', newline='', encoding='utf-8') as file:
+                writer = csv.DictWriter(file, fieldnames=FIELDNAMES)
+                writer.writeheader()
+                writer.writerows(self._row(patient, visit) for patient, visits in snapshot for visit in visits)
+                file.flush()
+                os.fsync(file.fileno())
+                span.add(bytes_written=file.tell())
+            os.replace(tmp_path, self.file_path)
+
+    def _truncate_journal(self, offset, entries):
+        # Keep only the records appended after the compaction snapshot was taken.
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as file:
+            header = file.readline()
+            file.seek(max(offset, len(header)))
+            tail = file.read()
+
+        if not tail:
+            os.remove(self.journal_path)
+        else:
+            tmp_path = self.journal_path + ".tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(header)
+                file.write(tail)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.journal_path)
+        self.journal_entries = max(self.journal_entries - entries, 0)
+
+    def compact(self):
+        with self._compact_lock:
+            with self._lock.read():
+                snapshot = self._snapshot()
+                offset = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+                entries = self.journal_entries
+
+            self._write_base(snapshot)
+
+            with self._lock.write():
+                self._truncate_journal(offset, entries)
+                self.signature = file_signature(self.file_path)
+
+    def compact_in_background(self):
+        if self._compact_lock.locked():
+            return None
+        thread = threading.Thread(target=self.compact, daemon=True)
+        thread.start()
+        return thread
 
     def save_data(self):
-        fieldnames = ['Patient_ID', 'Visit_ID', 'Visit_time', 'Visit_department', 'Race',
-                      'Gender', 'Ethnicity', 'Age', 'Zip_code', 'Insurance',
-                      'Chief_complaint', 'Note_ID', 'Note_type']
-        with open(self.file_path, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            for pid, patient in self.patients.items():
-                for visit in patient.visits:
-                    writer.writerow({
-                        'Patient_ID': pid,
-                        'Visit_ID': visit.visit_id,
-                        'Visit_time': visit.visit_time.strftime('%Y-%m-%d'),
-                        'Visit_department': visit.visit_department,
-                        'Race': patient.race,
-                        'Gender': patient.gender,
-                        'Ethnicity': patient.ethnicity,
-                        'Age': patient.age,
-                        'Zip_code': patient.zip_code,
-                        'Insurance': patient.insurance,
-                        'Chief_complaint': visit.chief_complaint,
-                        'Note_ID': visit.note_id,
-                        'Note_type': visit.note_type
-                    })
+        self.compact()
+
+    def _snapshot(self, patient_ids=None):
+        with self._lock.read():
+            if patient_ids is None:
+                patients = list(self.patients.values())
+            else:
+                patients = [self.patients[pid] for pid in patient_ids if pid in self.patients]
+            return [(patient, patient.snapshot_visits()) for patient in patients]
 
+    def iter_rows(self, start=None, end=None, department=None, insurance=None, patient_ids=None):
+        # Streams one Patient_data.csv row dict per visit matching the filters.
+        start = parse_date(start) if start is not None else None
+        end = parse_date(end) if end is not None else None
+        for patient, visits in self._snapshot(patient_ids):
+            if insurance is not None and patient.insurance != insurance:
+                continue
+            for visit in visits:
+                if department is not None and visit.visit_department != department:
+                    continue
+                if start is not None or end is not None:
+                    visit_date = visit.visit_time.date()
+                    if (start is not None and visit_date < start) or (end is not None and visit_date > end):
+                        continue
+                yield self._row(patient, visit)
+
+    @metrics.timed(rows=lambda count: count)
+    def export_slice(self, output_file, start=None, end=None, department=None, insurance=None,
+                     file_format=None, batch_size=50000):
+        if file_format is None:
+            file_format = 'parquet' if output_file.endswith('.parquet') else 'csv'
+        rows = self.iter_rows(start, end, department, insurance)
+        try:
+            if file_format == 'csv':
+                count = 0
+                with open(output_file, 'w', newline='', encoding='utf-8') as file:
+                    writer = csv.DictWriter(file, fieldnames=FIELDNAMES)
+                    writer.writeheader()
+                    for row in rows:
+                        writer.writerow(row)
+                        count += 1
+                return count
+            if file_format == 'parquet':
+                return _write_parquet(output_file, rows, batch_size)
+        except OSError as e:
+            print(f"Could not export to {output_file}: {e}")
+            return None
+        print(f"Unsupported export format: {file_format}")
+        return None
+
+    @metrics.timed()
     def export_statistics_report(self, output_file):
         if not self.patients:
             return False
 
-        import csv
-        import datetime
-
-        summary = []
-
-        # Monthly Visits
-        visits = []
-        for patient in self.patients.values():
-            for visit in patient.visits:
-                visits.append(visit.visit_time.strftime("%Y-%m"))
-
-        from collections import Counter
-        monthly_counts = Counter(visits)
-        summary.append(["Monthly Visit Summary"])
-        summary.append(["Month", "Number of Visits"])
-        for month, count in sorted(monthly_counts.items()):
-            summary.append([month, count])
-        summary.append([])
-
-        # Insurance Distribution
-        ins_counts = Counter([p.insurance for p in self.patients.values()])
-        summary.append(["Insurance Distribution"])
-        summary.append(["Insurance", "Count"])
-        for insurance, count in ins_counts.items():
-            summary.append([insurance, count])
-        summary.append([])
+        with self._lock.read():
+            monthly_visits = self.aggregates.monthly_visits()
+            ins_counts = list(self.aggregates.patient_insurance.items())
 
         # Save summary to CSV
         try:
             with open(output_file, "w", newline="", encoding="utf-8") as file:
                 writer = csv.writer(file)
-                writer.writerows(summary)
+
+                # Monthly Visits
+                writer.writerow(["Monthly Visit Summary"])
+                writer.writerow(["Month", "Number of Visits"])
+                for month, count in monthly_visits:
+                    writer.writerow([month, count])
+                writer.writerow([])
+
+                # Insurance Distribution
+                writer.writerow(["Insurance Distribution"])
+                writer.writerow(["Insurance", "Count"])
+                for insurance, count in ins_counts:
+                    writer.writerow([insurance, count])
+                writer.writerow([])
             return True
         except Exception:
             return False
@@ -150,11 +828,11 @@ class Department:
         except ValueError:
             return False
 
-        if patient_id not in self.patients:
-            # Use popup dialogs to ask for required fields
-            root = tk.Tk()
-            root.withdraw()  # Hide the root window
+        # Use popup dialogs to ask for the remaining fields
+        root = tk.Tk()
+        root.withdraw()  # Hide the root window
 
+        if patient_id not in self.patients:
             gender = simpledialog.askstring("Input", f"Enter gender for new patient {patient_id}:", parent=root)
             race = simpledialog.askstring("Input", f"Enter race for new patient {patient_id}:", parent=root)
             try:
@@ -165,56 +843,57 @@ class Department:
             insurance = simpledialog.askstring("Input", f"Enter insurance for new patient {patient_id}:", parent=root)
             zip_code = simpledialog.askstring("Input", f"Enter zip code for new patient {patient_id}:", parent=root)
 
-            self.patients[patient_id] = Patient(
-                patient_id,
-                gender or "Unknown",
-                race or "Unknown",
-                age,
-                ethnicity or "Unknown",
-                insurance or "Unknown",
-                zip_code or "00000"
-            )
-
-        visit_id = f"V{len(self.patients[patient_id].visits) + 1:03d}"
-        note_id = str(random.randint(100000, 999999))
+            with self._lock.write():
+                self._new_patient(Patient(
+                    patient_id,
+                    gender or "Unknown",
+                    race or "Unknown",
+                    age,
+                    ethnicity or "Unknown",
+                    insurance or "Unknown",
+                    zip_code or "00000"
+                ))
+
+        visit_id = self.visit_ids.allocate()
+        note_id = self.note_ids.allocate()
         note_type = simpledialog.askstring("Input", f"Enter note type for this visit (e.g., Discharge, Progress, Admission):", parent=root) or "Unspecified"
         root.destroy()
 
         visit = Visit(visit_id, visit_time, visit_dept, chief_complaint, note_id, note_type)
-        self.patients[patient_id].add_visit(visit)
-        self.save_data()
+        # The journal record is written under the same lock as the edit, so a compaction
+        # cannot fold the visit into the base file and still keep its record.
+        with self._lock.write():
+            self._add_visit(self.patients[patient_id], visit)
+            self._append_journal([dict(self._row(self.patients[patient_id], visit), Op='add')])
         messagebox.showinfo("Success", f"Patient {patient_id} and visit saved to CSV successfully.")
         return True
 
+    @metrics.timed()
     def retrieve_patient(self, patient_id, output_file):
         if patient_id not in self.patients:
             print("Patient not found.")
             return
-        fieldnames = ['Patient_ID', 'Visit_ID', 'Visit_time', 'Visit_department', 'Race',
-                      'Gender', 'Ethnicity', 'Age', 'Zip_code', 'Insurance',
-                      'Chief_complaint', 'Note_ID', 'Note_type']
         with open(output_file, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
             writer.writeheader()
-            patient = self.patients[patient_id]
-            for visit in patient.visits:
-                writer.writerow({
-                    'Patient_ID': patient.patient_id,
-                    'Visit_ID': visit.visit_id,
-                    'Visit_time': visit.visit_time.strftime('%Y-%m-%d'),
-                    'Visit_department': visit.visit_department,
-                    'Race': patient.race,
-                    'Gender': patient.gender,
-                    'Ethnicity': patient.ethnicity,
-                    'Age': patient.age,
-                    'Zip_code': patient.zip_code,
-                    'Insurance': patient.insurance,
-                    'Chief_complaint': visit.chief_complaint,
-                    'Note_ID': visit.note_id,
-                    'Note_type': visit.note_type
-                })
+            writer.writerows(self.iter_rows(patient_ids=[patient_id]))
         print(f"Patient data saved to {output_file}")
 
+    @metrics.timed()
+    def latest_visit(self, patient_id):
+        # The patient's most recent visit from its cached pointer, or None.
+        with self._lock.read():
+            patient = self.patients.get(patient_id)
+            return patient.latest_visit() if patient is not None else None
+
+    def visit_history(self, patient_id, page=0, per_page=20):
+        # (patient, one page of visits newest first, total visits), or None for an unknown patient.
+        with self._lock.read():
+            patient = self.patients.get(patient_id)
+            if patient is None:
+                return None
+            return patient, patient.visit_page(page, per_page), patient.visit_count()
+
     def add_visit(self, patient_id):
         print("\nPlease enter the following visit details:")
         department = input("Department: ")
@@ -229,73 +908,381 @@ class Department:
         zip_code = input("Zip Code: ")
         insurance = input("Insurance: ")
         note_type = input("Note Type (e.g., Discharge, Progress, Admission): ")
-        note_id = str(random.randint(100000, 999999))
-        visit_id = str(random.randint(100000, 999999))
+        note_id = self.note_ids.allocate()
+        visit_id = self.visit_ids.allocate()
         visit_time = datetime.datetime.now()
 
-        if patient_id not in self.patients:
-            self.patients[patient_id] = Patient(
-                patient_id, gender, race, age, ethnicity, insurance, zip_code
-            )
-        else:
-            patient = self.patients[patient_id]
-            patient.gender = gender
-            patient.race = race
-            patient.age = age
-            patient.ethnicity = ethnicity
-            patient.zip_code = zip_code
-            patient.insurance = insurance
-
-        visit = Visit(visit_id, visit_time, department, complaint, note_id, note_type)
-        self.patients[patient_id].add_visit(visit)
-        self.save_data()
+        with self._lock.write():
+            if patient_id not in self.patients:
+                self._new_patient(Patient(
+                    patient_id, gender, race, age, ethnicity, insurance, zip_code
+                ))
+            else:
+                self._update_patient(self.patients[patient_id], gender, race, age,
+                                     ethnicity, insurance, zip_code)
+
+            visit = Visit(visit_id, visit_time, department, complaint, note_id, note_type)
+            self._add_visit(self.patients[patient_id], visit)
+            self._append_journal([dict(self._row(self.patients[patient_id], visit), Op='add')])
         print("New patient visit added successfully.")
 
+    @metrics.timed()
     def remove_patient(self, patient_id):
         if patient_id not in self.patients:
             print("Patient not found.")
             return
-        del self.patients[patient_id]
-        self.save_data()
+        with self._lock.write():
+            self._drop_patient(patient_id)
+            self._append_journal([{'Op': 'remove', 'Patient_ID': patient_id}])
         print(f"Patient ID {patient_id} removed successfully.")
 
     def review_visits(self, date_str):
         try:
             date_obj = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
-            count = 0
-            for patient in self.patients.values():
-                for visit in patient.visits:
-                    if visit.visit_time.date() == date_obj:
-                        count += 1
+            count = self.count_visits_on(date_obj)
             print(f"Total visits on {date_str}: {count}")
         except ValueError:
             print("Invalid date format. Use YYYY-MM-DD.")
 
+    @metrics.timed()
+    def count_visits_on(self, date, department=None):
+        with self._lock.read():
+            return self.date_index.count_on(parse_date(date), department)
+
+    @metrics.timed(rows=len)
+    def visits_on(self, date, department=None):
+        with self._lock.read():
+            return self.date_index.visits_on(parse_date(date), department)
+
+    @metrics.timed()
+    def count_visits_between(self, start, end, department=None):
+        with self._lock.read():
+            return self.date_index.count_between(parse_date(start), parse_date(end), department)
+
+    @metrics.timed()
+    def count_visits_by_department(self, start, end):
+        with self._lock.read():
+            return self.date_index.count_by_department(parse_date(start), parse_date(end))
+
+    @metrics.timed(rows=len)
+    def cohort(self, query):
+        # Patients matching a cohort query (see cohort.py), e.g.
+        # 'age:51..65 insurance:Medicaid department:"Emergency department" year:2016'.
+        predicates = parse_cohort_query(query)
+        with self._lock.read():
+            return [self.patients[pid] for pid in self.cohort_index.get(self).match(predicates)]
+
+    @metrics.timed()
+    def count_cohort(self, query):
+        predicates = parse_cohort_query(query)
+        with self._lock.read():
+            return self.cohort_index.get(self).count(predicates)
+
+def _csv_field(value):
+    # csv.writer's minimal quoting, done with str methods: much faster on long note text.
+    if '"' in value or ',' in value or '\n' in value or '\r' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
 class Note:
+    __slots__ = ('patient_id', 'visit_id', 'note_id', 'note_text')
+
     def __init__(self, patient_id, visit_id, note_id, note_text):
         self.patient_id = str(patient_id)
         self.visit_id = str(visit_id)
         self.note_id = str(note_id)
         self.note_text = note_text
 
+class LazyNote:
+    __slots__ = ('patient_id', 'visit_id', 'note_id', '_db', '_start', '_end')
+
+    def __init__(self, db, patient_id, visit_id, note_id, start, end):
+        self._db = db
+        self.patient_id = str(patient_id)
+        self.visit_id = str(visit_id)
+        self.note_id = str(note_id)
+        self._start = start
+        self._end = end
+
+    @property
+    def note_text(self):
+        return self._db.read_note_text(self._start, self._end)
+
+def _new_notes(rows, note_ids, exists):
+    # Notes for a bulk append: rows with no Note_ID get IDs from one reserved block, and a
+    # given ID that `exists` or repeats in the batch rejects the whole batch.
+    notes, missing, seen = [], [], set()
+    for row in rows:
+        note = Note(*row)
+        if row[2] is None or row[2] == '':
+            missing.append(note)
+        elif note.note_id in seen or exists(note.note_id):
+            raise ValueError(f"Note ID {note.note_id} already exists.")
+        else:
+            seen.add(note.note_id)
+        notes.append(note)
+    if missing:
+        for note, note_id in zip(missing, note_ids.reserve(len(missing))):
+            note.note_id = note_id
+    return notes
+
+
 class NotesDatabase:
-    def __init__(self, notes_file_path):
+    INDEX_VERSION = '1'
+
+    def __init__(self, notes_file_path, lazy=False, use_snapshot=True, workers=1):
         self.notes_file_path = notes_file_path
+        self.index_path = notes_file_path + ".idx"
+        self.lazy = lazy
+        self.use_snapshot = use_snapshot
+        self.workers = workers
         self.notes = []
-        self.load_notes()
+        self.notes_by_visit = {}
+        self.notes_by_id = {}
+        self._file = None
+        self._mmap = None
+        self._columns = None
+        with metrics.span("NotesDatabase.load_notes") as span:
+            self.load_notes()
+            span.add(rows=len(self.notes), bytes_read=os.path.getsize(notes_file_path)
+                     if os.path.exists(notes_file_path) else 0)
+        # Shared with the Department whose data file is in the same directory.
+        self.note_ids = get_allocator('Note_ID', notes_file_path)
+        self.note_ids.add_many(list(self.notes_by_id))
 
     def load_notes(self):
-        with open(self.notes_file_path, newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                note = Note(
-                    row['Patient_ID'],
-                    row['Visit_ID'],
-                    row['Note_ID'],
-                    row['Note_text']
-                )
-                self.notes.append(note)
+        if self.lazy:
+            self._load_offset_index()
+            return
+
+        snapshot = read_snapshot(self.notes_file_path) if self.use_snapshot else None
+        if snapshot is not None:
+            for columns in snapshot:
+                decoded = [[uniques[code] for code in codes.tolist()] for codes, uniques in
+                           (columns[name] for name in ('Patient_ID', 'Visit_ID', 'Note_ID', 'Note_text'))]
+                for patient_id, visit_id, note_id, note_text in zip(*decoded):
+                    self._index_note(Note(patient_id, visit_id, note_id, note_text))
+            return
+
+        if should_parallelize(self.notes_file_path, self.workers):
+            for rows in read_notes(self.notes_file_path, self.workers):
+                for patient_id, visit_id, note_id, note_text in rows:
+                    self._index_note(Note(patient_id, visit_id, note_id, note_text))
+        else:
+            with open(self.notes_file_path, newline='', encoding='utf-8') as file:
+                reader = csv.DictReader(file)
+                for row in reader:
+                    note = Note(
+                        row['Patient_ID'],
+                        row['Visit_ID'],
+                        row['Note_ID'],
+                        row['Note_text']
+                    )
+                    self._index_note(note)
+
+        if self.use_snapshot:
+            writer = SnapshotWriter(self.notes_file_path)
+            writer.add_chunk({
+                'Patient_ID': [note.patient_id for note in self.notes],
+                'Visit_ID': [note.visit_id for note in self.notes],
+                'Note_ID': [note.note_id for note in self.notes],
+                'Note_text': [note.note_text for note in self.notes],
+            })
+            writer.write()
+
+    def _open_mmap(self):
+        self.close()
+        self._file = open(self.notes_file_path, 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _parse_record(self, data):
+        return next(csv.reader(io.StringIO(data.decode('utf-8'), newline='')))
+
+    def _tail_crc(self, end):
+        return zlib.crc32(self._mmap[max(end - 4096, 0):end]) if end else 0
+
+    def _scan_records(self, start):
+        # Yields (start, end) byte offsets of each CSV record, keeping quoted
+        # multi-line Note_text fields inside a single record.
+        mm = self._mmap
+        mm.seek(start)
+        while True:
+            record_start = mm.tell()
+            line = mm.readline()
+            if not line:
+                return
+            quotes = line.count(b'"')
+            while quotes % 2:
+                line = mm.readline()
+                if not line:
+                    break
+                quotes += line.count(b'"')
+            yield record_start, mm.tell()
+
+    def _read_offset_index(self, size):
+        # Returns the number of bytes of Notes.csv already covered by the sidecar.
+        if not os.path.exists(self.index_path):
+            return 0
+        with open(self.index_path, newline='', encoding='utf-8') as file:
+            reader = csv.reader(file)
+            try:
+                version, indexed_size, mtime_ns, crc = next(reader)
+                indexed_size, mtime_ns, crc = int(indexed_size), int(mtime_ns), int(crc)
+            except (StopIteration, ValueError):
+                return 0
+            current_mtime = os.stat(self.notes_file_path).st_mtime_ns
+            unchanged = indexed_size == size and mtime_ns == current_mtime
+            appended = indexed_size < size and self._tail_crc(indexed_size) == crc
+            if version != self.INDEX_VERSION or not (unchanged or appended):
+                return 0
+            self._columns = next(reader)
+            for patient_id, visit_id, note_id, start, end in reader:
+                self._index_note(LazyNote(self, patient_id, visit_id, note_id, int(start), int(end)))
+        return indexed_size
+
+    def _write_offset_index(self, size):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow([self.INDEX_VERSION, size, os.stat(self.notes_file_path).st_mtime_ns,
+                             self._tail_crc(size)])
+            writer.writerow(self._columns)
+            for note in self.notes:
+                writer.writerow([note.patient_id, note.visit_id, note.note_id, note._start, note._end])
+        os.replace(tmp_path, self.index_path)
+
+    def _load_offset_index(self):
+        self._open_mmap()
+        if self._mmap is None:
+            return
+        size = len(self._mmap)
+        indexed_size = self._read_offset_index(size)
+        if indexed_size == size:
+            return
+
+        if indexed_size == 0:
+            self.notes, self.notes_by_visit, self.notes_by_id = [], {}, {}
+            self._mmap.seek(0)
+            self._columns = self._parse_record(self._mmap.readline())
+            indexed_size = self._mmap.tell()
+
+        if should_parallelize(self.notes_file_path, self.workers, indexed_size):
+            for offsets in scan_note_offsets(self.notes_file_path, self.workers, indexed_size):
+                for patient_id, visit_id, note_id, start, end in offsets:
+                    self._index_note(LazyNote(self, patient_id, visit_id, note_id, start, end))
+            self._write_offset_index(size)
+            return
+
+        pid_col = self._columns.index('Patient_ID')
+        vid_col = self._columns.index('Visit_ID')
+        nid_col = self._columns.index('Note_ID')
+        for start, end in self._scan_records(indexed_size):
+            row = self._parse_record(self._mmap[start:end])
+            if len(row) < len(self._columns):
+                continue
+            self._index_note(LazyNote(self, row[pid_col], row[vid_col], row[nid_col], start, end))
+        self._write_offset_index(size)
+
+    def read_note_text(self, start, end):
+        with metrics.span("NotesDatabase.read_note_text") as span:
+            if self._mmap is None or end > len(self._mmap):
+                self._open_mmap()
+            row = self._parse_record(self._mmap[start:end])
+            span.add(rows=1, bytes_read=end - start)
+            return row[self._columns.index('Note_text')]
+
+    def _index_note(self, note):
+        self.notes.append(note)
+        self.notes_by_visit.setdefault((note.patient_id, note.visit_id), []).append(note)
+        self.notes_by_id.setdefault(note.note_id, note)
+
+    def get_note(self, note_id):
+        return self.notes_by_id.get(str(note_id))
+
+    def get_notes_for_visit(self, patient_id, visit_id):
+        return list(self.notes_by_visit.get((str(patient_id), str(visit_id)), []))
+
+    def add_note(self, patient_id, visit_id, note_id, note_text):
+        # A note without an ID gets a newly allocated one.
+        if note_id is None or note_id == '':
+            note_id = self.note_ids.allocate()
+        note = Note(patient_id, visit_id, note_id, note_text)
+        if note.note_id in self.notes_by_id:
+            print(f"Note ID {note.note_id} already exists.")
+            return None
+
+        new_file = not os.path.exists(self.notes_file_path) or os.path.getsize(self.notes_file_path) == 0
+        with open(self.notes_file_path, 'a', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            if new_file:
+                writer.writerow(['', 'Patient_ID', 'Visit_ID', 'Note_ID', 'Note_text'])
+            file.flush()
+            start = os.fstat(file.fileno()).st_size
+            with metrics.span("NotesDatabase.add_note") as span:
+                writer.writerow([len(self.notes), note.patient_id, note.visit_id, note.note_id, note.note_text])
+                file.flush()
+                end = os.fstat(file.fileno()).st_size
+                span.add(rows=1, bytes_written=end - start)
+
+        if self.lazy:
+            # The sidecar is brought up to date incrementally on the next load.
+            if self._columns is None:
+                self._columns = ['', 'Patient_ID', 'Visit_ID', 'Note_ID', 'Note_text']
+            note = LazyNote(self, note.patient_id, note.visit_id, note.note_id, start, end)
+        self._index_note(note)
+        self.note_ids.add(note.note_id)
+        return note
+
+    @metrics.timed(rows=len)
+    def add_notes(self, rows):
+        # Bulk append of (patient_id, visit_id, note_id, note_text) rows with one write and
+        # fsync; the file is cut back if the write fails. Duplicate note IDs, already stored
+        # or repeated in the batch, reject the whole batch. Returns the notes added.
+        notes = _new_notes(rows, self.note_ids, lambda note_id: note_id in self.notes_by_id)
+        if not notes:
+            return []
+
+        new_file = not os.path.exists(self.notes_file_path) or os.path.getsize(self.notes_file_path) == 0
+        records = [b',Patient_ID,Visit_ID,Note_ID,Note_text\n' if new_file else b'']
+        bounds, size = [], len(records[0])
+        for number, note in enumerate(notes, len(self.notes)):
+            record = (f"{number},{_csv_field(note.patient_id)},{_csv_field(note.visit_id)},"
+                      f"{_csv_field(note.note_id)},{_csv_field(note.note_text)}\n").encode('utf-8')
+            records.append(record)
+            bounds.append((size, size + len(record)))
+            size += len(record)
+
+        with open(self.notes_file_path, 'ab') as file:
+            start = os.fstat(file.fileno()).st_size
+            try:
+                file.write(b''.join(records))
+                file.flush()
+                os.fsync(file.fileno())
+            except OSError:
+                file.truncate(start)
+                raise
+
+        if self.lazy and self._columns is None:
+            self._columns = ['', 'Patient_ID', 'Visit_ID', 'Note_ID', 'Note_text']
+        added = []
+        for note, (low, high) in zip(notes, bounds):
+            if self.lazy:
+                note = LazyNote(self, note.patient_id, note.visit_id, note.note_id, start + low, start + high)
+            self._index_note(note)
+            added.append(note)
+        self.note_ids.add_many([note.note_id for note in added])
+        return added
 
+    @metrics.timed(rows=len)
     def get_notes_by_patient_and_date(self, patient_id, visit_date, patient_data):
         try:
             visit_date_obj = datetime.datetime.strptime(visit_date, '%Y-%m-%d').date()
@@ -310,8 +1297,6 @@ class NotesDatabase:
 
         for visit in patient_data.patients[patient_id].visits:
             if visit.visit_time.date() == visit_date_obj:
-                for note in self.notes:
-                    if note.visit_id == visit.visit_id and note.patient_id == patient_id:
-                        notes_found.append(note)
+                notes_found.extend(self.notes_by_visit.get((patient_id, visit.visit_id), []))
 
         return notes_found
@@ -0,0 +1,364 @@
+import functools
+import json
+import math
+import os
+import re
+import threading
+
+import numpy as np
+
+from indexes import parse_date
+
+INDEX_VERSION = 1
+# Terms longer than this are truncated, on indexing and querying alike, so the vocabulary
+# fits a fixed-width byte array that can be binary-searched without building a dict.
+MAX_TERM_BYTES = 32
+# Documents per segment on a full build; smaller segments come from incremental updates
+# and are merged once there are more than MAX_SMALL_SEGMENTS of them.
+SEGMENT_DOCS = 50000
+MAX_SMALL_SEGMENTS = 8
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN = re.compile(rb"[0-9a-z]+")
+_QUERY = re.compile(r'"([^"]*)"|(\S+)')
+_FILTERS = {'patient': 'patient_id', 'from': 'start', 'to': 'end'}
+
+
+def tokenize(text):
+    # Lower-cased runs of ASCII letters and digits: "Ps. aeruginosa" -> [b'ps', b'aeruginosa'].
+    return [token[:MAX_TERM_BYTES] for token in _TOKEN.findall(text.lower().encode('utf-8'))]
+
+
+def parse_query(query):
+    # Splits a query into free terms, quoted phrases and patient:/from:/to: filters.
+    terms, phrases, filters = [], [], {}
+    for phrase, word in _QUERY.findall(query):
+        if phrase:
+            tokens = tokenize(phrase)
+            if len(tokens) > 1:
+                phrases.append(tokens)
+            else:
+                terms.extend(tokens)
+            continue
+        key, sep, value = word.partition(':')
+        if sep and value and key.lower() in _FILTERS:
+            filters[_FILTERS[key.lower()]] = value
+        else:
+            terms.extend(tokenize(word))
+    return terms, phrases, filters
+
+
+def snippet(text, query, width=200):
+    # A window of the note around the first query term it contains.
+    terms, phrases, _ = parse_query(query)
+    lowered = text.lower()
+    hits = [lowered.find(term.decode('utf-8', 'ignore')) for term in terms + [p[0] for p in phrases]]
+    first = min([hit for hit in hits if hit >= 0], default=0)
+    start = max(first - width // 4, 0)
+    excerpt = " ".join(text[start:start + width].split())
+    return ("..." if start else "") + excerpt + ("..." if start + width < len(text) else "")
+
+
+class Segment:
+    # Immutable positional postings for a contiguous run of documents (global ids
+    # base .. base + len - 1), stored as flat numpy arrays:
+    #   terms[t]                              sorted vocabulary
+    #   term_offsets[t]:term_offsets[t + 1]   postings of term t, ordered by document
+    #   post_docs / post_tf                   document id and term frequency per posting
+    #   pos_offsets[p]:pos_offsets[p + 1]     token positions of posting p
+    ARRAYS = ('terms', 'term_offsets', 'post_docs', 'post_tf', 'pos_offsets', 'positions',
+              'doc_lengths', 'patient_ids', 'visit_ids', 'note_ids')
+
+    def __init__(self, base, arrays, path=None):
+        self.base = base
+        self.path = path
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, base, notes):
+        vocab = {}
+        term_ids = []
+        lengths = []
+        for note in notes:
+            tokens = tokenize(note.note_text)
+            lengths.append(len(tokens))
+            term_ids.extend([vocab.setdefault(token, len(vocab)) for token in tokens])
+
+        lengths = np.array(lengths, dtype=np.int64)
+        term_ids = np.array(term_ids, dtype=np.int64)
+        terms = np.array(list(vocab), dtype=f'S{MAX_TERM_BYTES}')
+        order = np.argsort(terms, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+
+        docs = np.repeat(np.arange(base, base + len(lengths)), lengths)
+        positions = np.arange(len(term_ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        meta = {
+            'doc_lengths': lengths.astype(np.int32),
+            'patient_ids': np.array([note.patient_id for note in notes], dtype=str),
+            'visit_ids': np.array([note.visit_id for note in notes], dtype=str),
+            'note_ids': np.array([note.note_id for note in notes], dtype=str),
+        }
+        return cls._from_occurrences(base, terms[order], rank[term_ids], docs, positions, meta)
+
+    @classmethod
+    def merge(cls, segments):
+        # Segments must be consecutive; their occurrences are re-derived and rebuilt as one.
+        terms, inverse = np.unique(np.concatenate([segment.terms for segment in segments]), return_inverse=True)
+        occurrences = {'terms': [], 'docs': [], 'positions': []}
+        offset = 0
+        for segment in segments:
+            local = inverse[offset:offset + len(segment.terms)]
+            offset += len(segment.terms)
+            counts = np.diff(segment.pos_offsets)
+            occurrences['terms'].append(np.repeat(np.repeat(local, np.diff(segment.term_offsets)), counts))
+            occurrences['docs'].append(np.repeat(segment.post_docs, counts))
+            occurrences['positions'].append(segment.positions)
+        meta = {name: np.concatenate([getattr(segment, name) for segment in segments])
+                for name in ('doc_lengths', 'patient_ids', 'visit_ids', 'note_ids')}
+        return cls._from_occurrences(segments[0].base, terms,
+                                     *(np.concatenate(occurrences[key]) for key in ('terms', 'docs', 'positions')),
+                                     meta)
+
+    @classmethod
+    def _from_occurrences(cls, base, terms, term_ids, docs, positions, meta):
+        order = np.lexsort((positions, docs, term_ids))
+        term_ids, docs, positions = term_ids[order], docs[order], positions[order]
+        starts = np.ones(len(term_ids), dtype=bool)
+        starts[1:] = (term_ids[1:] != term_ids[:-1]) | (docs[1:] != docs[:-1])
+        starts = np.flatnonzero(starts)
+        pos_offsets = np.append(starts, len(term_ids)).astype(np.int64)
+        arrays = dict(meta)
+        arrays.update({
+            'terms': terms,
+            'term_offsets': np.searchsorted(term_ids[starts], np.arange(len(terms) + 1)).astype(np.int64),
+            'post_docs': docs[starts].astype(np.int32),
+            'post_tf': np.diff(pos_offsets).astype(np.int32),
+            'pos_offsets': pos_offsets,
+            'positions': positions.astype(np.int32),
+        })
+        return cls(base, arrays)
+
+    @classmethod
+    def load(cls, path, base):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(base, {name: data[name] for name in cls.ARRAYS}, path)
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp_path, path)
+        self.path = path
+
+    def lookup(self, term):
+        # (first, last) posting positions of a term, or None when it does not occur.
+        i = int(np.searchsorted(self.terms, term))
+        if i < len(self.terms) and self.terms[i] == term:
+            return int(self.term_offsets[i]), int(self.term_offsets[i + 1])
+        return None
+
+    def phrase_docs(self, tokens):
+        spans = [self.lookup(token) for token in tokens]
+        if any(span is None for span in spans):
+            return np.empty(0, dtype=np.int32)
+        docs = functools.reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True),
+                                (self.post_docs[first:last] for first, last in spans))
+
+        # Each occurrence of the k-th phrase token becomes the key (doc, position - k); the
+        # phrase occurs wherever every token yields the same key.
+        keys = None
+        for k, (first, last) in enumerate(spans):
+            postings = first + np.flatnonzero(np.isin(self.post_docs[first:last], docs, assume_unique=True))
+            counts = self.pos_offsets[postings + 1] - self.pos_offsets[postings]
+            occurrences = np.repeat(self.pos_offsets[postings] - np.cumsum(counts) + counts, counts) + \
+                np.arange(counts.sum())
+            starts = self.positions[occurrences].astype(np.int64) - k
+            token_keys = (np.repeat(self.post_docs[postings].astype(np.int64), counts) << 32) | np.maximum(starts, 0)
+            token_keys = token_keys[starts >= 0]
+            keys = token_keys if keys is None else np.intersect1d(keys, token_keys, assume_unique=True)
+            if not len(keys):
+                break
+        return np.unique(keys >> 32).astype(np.int32)
+
+
+class NoteSearchIndex:
+    # Full-text index over a NotesDatabase, ranked with BM25. Document ids are positions in
+    # notes_db.notes. The index is persisted next to the notes file as numpy segments plus a
+    # JSON manifest, and catches up with notes added since it was written on every open
+    # or search, so only new notes are ever tokenized.
+    def __init__(self, notes_db, index_path=None):
+        self.notes_db = notes_db
+        self.index_path = index_path or notes_db.notes_file_path + ".search"
+        self.manifest_path = self.index_path + ".json"
+        self.segments = []
+        self._next_file = 0
+        self._lock = threading.Lock()
+        self._load()
+        self.update()
+
+    @property
+    def doc_count(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def _load(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as file:
+                manifest = json.load(file)
+            if manifest.get('version') != INDEX_VERSION:
+                return
+            segments, base = [], 0
+            for name in manifest['segments']:
+                segment = Segment.load(os.path.join(os.path.dirname(self.manifest_path), name), base)
+                segments.append(segment)
+                base += len(segment)
+        except (OSError, ValueError, KeyError) as e:
+            if os.path.exists(self.manifest_path):
+                print(f"Rebuilding unreadable search index {self.manifest_path}: {e}")
+            return
+
+        # The index is only reused if it still describes the start of the notes file.
+        notes = self.notes_db.notes
+        if base > len(notes) or (base and notes[base - 1].note_id != segments[-1].note_ids[-1]):
+            return
+        self.segments = segments
+        self._next_file = manifest.get('next_file', len(segments))
+        self._refresh()
+
+    def update(self):
+        # Indexes notes appended to notes_db since the last update.
+        with self._lock:
+            notes = self.notes_db.notes
+            start = indexed = self.doc_count
+            if start >= len(notes):
+                return 0
+            removed = []
+            while start < len(notes):
+                batch = notes[start:start + SEGMENT_DOCS]
+                self.segments.append(self._save(Segment.build(start, batch)))
+                start += len(batch)
+
+            small = 0
+            while small < len(self.segments) and len(self.segments[-small - 1]) < SEGMENT_DOCS:
+                small += 1
+            if small > MAX_SMALL_SEGMENTS:
+                removed = self.segments[-small:]
+                self.segments[-small:] = [self._save(Segment.merge(removed))]
+
+            self._write_manifest()
+            for segment in removed:
+                os.remove(segment.path)
+            self._refresh()
+            return len(notes) - indexed
+
+    def add_note(self, patient_id, visit_id, note_id, note_text):
+        note = self.notes_db.add_note(patient_id, visit_id, note_id, note_text)
+        if note is not None:
+            self.update()
+        return note
+
+    def _save(self, segment):
+        path = f"{self.index_path}.{self._next_file}.npz"
+        self._next_file += 1
+        segment.save(path)
+        return segment
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'version': INDEX_VERSION, 'next_file': self._next_file,
+                       'segments': [os.path.basename(segment.path) for segment in self.segments]}, file)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _refresh(self):
+        self.doc_lengths = np.concatenate([s.doc_lengths for s in self.segments] or [np.empty(0, np.int32)])
+        self.patient_ids = np.concatenate([s.patient_ids for s in self.segments] or [np.empty(0, str)])
+        self.visit_ids = np.concatenate([s.visit_ids for s in self.segments] or [np.empty(0, str)])
+        self.average_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+
+    def search(self, query, limit=20, patient_id=None, start=None, end=None, patient_data=None):
+        # Returns up to `limit` (note, score) pairs, best first. Quoted phrases must all
+        # occur; other terms are optional and only affect the ranking. Date filters use
+        # the visit dates held by patient_data (a Department).
+        terms, phrases, filters = parse_query(query)
+        patient_id = filters.get('patient_id', patient_id)
+        start = filters.get('start', start)
+        end = filters.get('end', end)
+        self.update()
+
+        query_terms = list(dict.fromkeys(terms + [token for phrase in phrases for token in phrase]))
+        if not query_terms:
+            return []
+        segments = list(self.segments)
+        spans = [{term: segment.lookup(term) for term in query_terms} for segment in segments]
+        total = sum(len(segment) for segment in segments)
+        idf = {term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in
+               ((term, sum(last - first for first, last in filter(None, (s[term] for s in spans))))
+                for term in query_terms)}
+
+        found_docs, found_scores = [], []
+        for segment, segment_spans in zip(segments, spans):
+            candidates = None
+            for phrase in phrases:
+                docs = segment.phrase_docs(phrase)
+                candidates = docs if candidates is None else np.intersect1d(candidates, docs, assume_unique=True)
+            if candidates is not None and not len(candidates):
+                continue
+
+            docs, scores = [], []
+            for term, span in segment_spans.items():
+                if span is None:
+                    continue
+                term_docs = segment.post_docs[span[0]:span[1]]
+                tf = segment.post_tf[span[0]:span[1]].astype(np.float64)
+                norm = 1 - BM25_B + BM25_B * self.doc_lengths[term_docs] / self.average_length
+                docs.append(term_docs)
+                scores.append(idf[term] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm))
+            if not docs:
+                continue
+            docs, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(scores))
+            if candidates is not None:
+                keep = np.isin(docs, candidates, assume_unique=True)
+                docs, scores = docs[keep], scores[keep]
+            found_docs.append(docs)
+            found_scores.append(scores)
+
+        if not found_docs:
+            return []
+        docs, scores = np.concatenate(found_docs), np.concatenate(found_scores)
+        if patient_id is not None:
+            keep = self.patient_ids[docs] == str(patient_id)
+            docs, scores = docs[keep], scores[keep]
+        if start is not None or end is not None:
+            keep = self._in_date_range(docs, start, end, patient_data)
+            docs, scores = docs[keep], scores[keep]
+
+        if len(docs) > limit:
+            best = np.argpartition(-scores, limit)[:limit]
+            docs, scores = docs[best], scores[best]
+        order = np.lexsort((docs, -scores))
+        notes = self.notes_db.notes
+        return [(notes[doc], score) for doc, score in zip(docs[order].tolist(), scores[order].tolist())]
+
+    def _in_date_range(self, docs, start, end, patient_data):
+        if patient_data is None:
+            raise ValueError("Filtering notes by date needs the Department holding their visits")
+        start = parse_date(start) if start is not None else None
+        end = parse_date(end) if end is not None else None
+        visit_dates = {}
+        keep = np.zeros(len(docs), dtype=bool)
+        for i, doc in enumerate(docs.tolist()):
+            patient_id, visit_id = str(self.patient_ids[doc]), str(self.visit_ids[doc])
+            if patient_id not in visit_dates:
+                patient = patient_data.patients.get(patient_id)
+                visit_dates[patient_id] = {} if patient is None else {
+                    visit.visit_id: visit.visit_time.date() for visit in patient.visits}
+            date = visit_dates[patient_id].get(visit_id)
+            keep[i] = date is not None and (start is None or date >= start) and (end is None or date <= end)
+        return keep
@@ -0,0 +1,458 @@
+import collections.abc
+import csv
+import gc
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from cohort import parse_cohort_query
+from ids import get_allocator
+from indexes import parse_date
+from patients import FIELDNAMES, Department, Patient, _parse_visit_time, _parse_visit_time_column, _write_journal
+from stats import VisitAggregates
+
+# A sharded warehouse is a directory of Patient_data.csv-shaped files, one per
+# Visit_department (or per department and year), each loaded as its own Department:
+#   python shards.py Patient_data.csv Patient_data.shards [--by-year]
+# shards.json lists the shards. A ShardedDepartment named after a department loads and
+# queries only that department's shards; one named "General" covers them all.
+MANIFEST_FILE = "shards.json"
+ALL_DEPARTMENTS = "General"
+
+
+def _available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def is_shard_dir(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(shard_dir):
+    with open(os.path.join(shard_dir, MANIFEST_FILE), encoding='utf-8') as file:
+        return json.load(file)
+
+
+def write_manifest(shard_dir, by_year, shard_files):
+    # shard_files maps (department, year or None) to the shard's file name.
+    manifest = {'by_year': by_year,
+                'shards': [{'department': department, 'year': year, 'file': name}
+                           for (department, year), name in shard_files.items()]}
+    path = os.path.join(shard_dir, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def shard_file_name(department, year, taken):
+    # "Emergency department", 2016 -> "emergency_department.2016.csv", made unique among `taken`.
+    slug = re.sub(r'[^0-9a-z]+', '_', str(department).lower()).strip('_') or 'unknown'
+    suffix = f".{year}" if year is not None else ""
+    name, number = f"{slug}{suffix}.csv", 1
+    while name in taken:
+        number += 1
+        name = f"{slug}_{number}{suffix}.csv"
+    return name
+
+
+def split_warehouse(file_path, shard_dir, by_year=False, chunksize=250000):
+    # Partitions a Patient_data.csv into a shard directory, streaming it in chunks. A pending
+    # journal is folded into the file first. Returns the number of visits written.
+    if os.path.exists(file_path + ".journal"):
+        Department(ALL_DEPARTMENTS, file_path, use_snapshot=False).compact()
+    os.makedirs(shard_dir, exist_ok=True)
+    if os.path.exists(os.path.join(shard_dir, MANIFEST_FILE)):
+        raise ValueError(f"{shard_dir} already holds a sharded warehouse")
+
+    files = {}
+    visit_ids = get_allocator('Visit_ID', os.path.join(shard_dir, MANIFEST_FILE))
+    note_ids = get_allocator('Note_ID', os.path.join(shard_dir, MANIFEST_FILE))
+    count = 0
+    with metrics.span("shards.split_warehouse") as span:
+        for chunk in pd.read_csv(file_path, dtype=str, keep_default_na=False, na_filter=False,
+                                 chunksize=chunksize, encoding='utf-8'):
+            chunk = chunk.reindex(columns=FIELDNAMES, fill_value='')
+            keys = [chunk['Visit_department']]
+            if by_year:
+                days = _parse_visit_time_column(chunk['Visit_time'], {})
+                keys.append(pd.Series(days.astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970,
+                                      index=chunk.index))
+            for key, rows in chunk.groupby(keys, sort=False):
+                key = (key[0], int(key[1])) if by_year else (key[0] if isinstance(key, tuple) else key, None)
+                if key not in files:
+                    files[key] = shard_file_name(key[0], key[1], set(files.values()))
+                path = os.path.join(shard_dir, files[key])
+                rows.to_csv(path, mode='a', header=not os.path.exists(path), index=False, encoding='utf-8')
+            visit_ids.add_many(chunk['Visit_ID'].to_numpy(dtype=object))
+            note_ids.add_many(chunk['Note_ID'].to_numpy(dtype=object))
+            count += len(chunk)
+        span.add(rows=count)
+
+    # IDs stay unique across shards: every allocator on the directory numbers above them.
+    visit_ids.checkpoint()
+    note_ids.checkpoint()
+    write_manifest(shard_dir, by_year, files)
+    return count
+
+
+class ShardedPatients(collections.abc.Mapping):
+    # Dict-like view of the patients across a ShardedDepartment's shards. A patient seen in
+    # several shards comes back as one Patient with all their visits, in time order.
+    def __init__(self, sharded):
+        self.sharded = sharded
+
+    def _parts(self, patient_id):
+        return [shard.patients[patient_id] for key, shard in self.sharded._loaded()
+                if patient_id in shard.patients]
+
+    def __getitem__(self, patient_id):
+        parts = self._parts(patient_id)
+        if not parts:
+            return self.sharded._new[patient_id]
+        if len(parts) == 1:
+            return parts[0]
+        first = parts[0]
+        patient = Patient(first.patient_id, first.gender, first.race, first.age, first.ethnicity,
+                          first.insurance, first.zip_code)
+        patient.visits = [visit for part in parts for visit in part.visits]
+        return patient
+
+    def __contains__(self, patient_id):
+        return patient_id in self.sharded._new or any(
+            patient_id in shard.patients for key, shard in self.sharded._loaded())
+
+    def __iter__(self):
+        seen = set()
+        for key, shard in self.sharded._loaded():
+            for patient_id in shard.patients:
+                if patient_id not in seen:
+                    seen.add(patient_id)
+                    yield patient_id
+        for patient_id in list(self.sharded._new):
+            if patient_id not in seen:
+                yield patient_id
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return bool(self.sharded._new) or any(shard.patients for key, shard in self.sharded._loaded())
+
+
+class ShardedDepartment(Department):
+    # Coordinator over a shard directory. Each shard is a CSV Department with its own file,
+    # journal and snapshot; shards in scope are loaded in parallel when the coordinator opens.
+    # Date queries go only to the shards of the department and years asked about, patient
+    # lookups to the shards holding the patient, and statistics are gathered from the shards
+    # in parallel and merged. Edits go through the Department hooks and are journaled in the
+    # shard they change; a bulk add_visits is committed per shard, so a crash midway can keep
+    # some shards' part of the batch. A coordinator named after a department reads and adds
+    # visits only in that department's shards, but patient fields and removals are
+    # patient-wide: they are also journaled in every shard it has not loaded, and applied
+    # there when the shard is next loaded.
+    def __init__(self, name, shard_dir, compact_threshold=10000, use_snapshot=True, workers=1):
+        self.shard_dir = shard_dir
+        super().__init__(name, shard_dir, compact_threshold, use_snapshot, workers)
+
+    def _init_storage(self):
+        manifest = read_manifest(self.shard_dir)
+        self.by_year = manifest['by_year']
+        self.shard_files = {(entry['department'], entry['year']): entry['file'] for entry in manifest['shards']}
+        self.departments = None if self.name == ALL_DEPARTMENTS else {self.name}
+        self.patients = ShardedPatients(self)
+        self.visit_ids = get_allocator('Visit_ID', os.path.join(self.shard_dir, MANIFEST_FILE))
+        self.note_ids = get_allocator('Note_ID', os.path.join(self.shard_dir, MANIFEST_FILE))
+        self._shards = {}
+        self._loading = {}
+        self._shard_lock = threading.Lock()
+        # Patients created without a visit yet, and the shards each pending edit touched,
+        # for routing its journal records.
+        self._new = {}
+        self._updated = {}
+        self._dropped = {}
+
+    def load_data(self, chunksize=250000):
+        # Each shard pauses the cyclic GC while it loads and restores it when done; pausing
+        # it around all of them keeps one finished shard from re-enabling it under the rest.
+        with metrics.span("ShardedDepartment.load_data"):
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                self._map(lambda key, shard: None, self._route())
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+
+    def _in_scope(self, department):
+        return self.departments is None or department in self.departments
+
+    def _route(self, department=None, start=None, end=None):
+        # Keys of the shards in scope that can hold visits of `department` between the dates.
+        keys = []
+        for key in self.shard_files:
+            shard_department, year = key
+            if not self._in_scope(shard_department) or (department is not None and shard_department != department):
+                continue
+            if year is not None and ((start is not None and year < start.year) or (end is not None and year > end.year)):
+                continue
+            keys.append(key)
+        return keys
+
+    def _shard(self, key):
+        shard = self._shards.get(key)
+        if shard is not None:
+            return shard
+        if not self._in_scope(key[0]):
+            raise ValueError(f"Visit_department {key[0]} is outside the {self.name} shards")
+        with self._shard_lock:
+            lock = self._loading.setdefault(key, threading.Lock())
+            if key not in self.shard_files:
+                self.shard_files[key] = shard_file_name(key[0], key[1], set(self.shard_files.values()))
+                write_manifest(self.shard_dir, self.by_year, self.shard_files)
+        with lock:
+            shard = self._shards.get(key)
+            if shard is None:
+                path = os.path.join(self.shard_dir, self.shard_files[key])
+                if not os.path.exists(path):
+                    with open(path, 'w', newline='', encoding='utf-8') as file:
+                        csv.writer(file).writerow(FIELDNAMES)
+                # Shards never compact themselves; see compact().
+                with metrics.span("ShardedDepartment.load_shard"):
+                    shard = self._shards[key] = Department(key[0], path, compact_threshold=0,
+                                                           use_snapshot=self.use_snapshot, workers=self.workers)
+        return shard
+
+    def _loaded(self, keys=None):
+        # (key, shard) for the given shards, or for every shard in scope, loading any not yet open.
+        return [(key, self._shard(key)) for key in (self._route() if keys is None else keys)]
+
+    def _map(self, func, keys):
+        # func(key, shard) for each shard, shards loaded and visited in parallel when more than
+        # one CPU is available; results in key order.
+        threads = min(len(keys), _available_cpus())
+        if threads <= 1:
+            return [func(key, self._shard(key)) for key in keys]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(lambda key: func(key, self._shard(key)), keys))
+
+    def _key(self, department, visit_time):
+        return department, (visit_time.year if self.by_year else None)
+
+    @property
+    def version(self):
+        return tuple((key, shard.version) for key, shard in sorted(self._shards.items())) + (len(self._new),)
+
+    def is_stale(self):
+        return any(shard.is_stale() for shard in list(self._shards.values()))
+
+    def replay_journal(self):
+        pass
+
+    def _visit_records(self, rows):
+        records = super()._visit_records(rows)
+        for number, record in enumerate(records, 1):
+            if not self._in_scope(record['Visit_department']):
+                raise ValueError(f"Row {number}: Visit_department {record['Visit_department']} "
+                                 f"is outside the {self.name} shards")
+        return records
+
+    def _new_patient(self, patient):
+        # The patient joins a shard with their first visit.
+        self._new[patient.patient_id] = patient
+        return patient
+
+    def _add_visit(self, patient, visit):
+        shard = self._shard(self._key(visit.visit_department, visit.visit_time))
+        with shard._lock.write():
+            target = shard.patients.get(patient.patient_id)
+            if target is None:
+                target = shard._new_patient(Patient(patient.patient_id, patient.gender, patient.race, patient.age,
+                                                    patient.ethnicity, patient.insurance, patient.zip_code))
+            shard._add_visit(target, visit)
+        self._new.pop(patient.patient_id, None)
+
+    def _update_patient(self, patient, gender, race, age, ethnicity, insurance, zip_code):
+        fields = (gender, race, age, ethnicity, insurance, zip_code)
+        for key, shard in self._loaded():
+            held = shard.patients.get(patient.patient_id)
+            if held is not None and (held.gender, held.race, held.age, held.ethnicity, held.insurance,
+                                     held.zip_code) != fields:
+                with shard._lock.write():
+                    shard._update_patient(held, *fields)
+                self._updated.setdefault(patient.patient_id, set()).add(key)
+        if patient.patient_id in self._new:
+            self._new[patient.patient_id] = Patient(patient.patient_id, *fields)
+
+    def _drop_patient(self, patient_id):
+        dropped = self._new.pop(patient_id, None)
+        for key, shard in self._loaded():
+            with shard._lock.write():
+                patient = shard._drop_patient(patient_id)
+            if patient is not None:
+                dropped = dropped or patient
+                self._dropped.setdefault(patient_id, []).append(key)
+        return dropped
+
+    def _append_journal(self, records):
+        # Each record is journaled in the shard it changed: an added visit in its shard, a
+        # removal in every loaded shard that held the patient, and changed patient fields as
+        # an 'update' record in the patient's other loaded shards. Shards not loaded here get
+        # every added patient's fields as an 'update' and every removal; both are no-ops in a
+        # shard without the patient.
+        batched = bool(records) and records[0].get('Op') == 'begin'
+        routed = {}
+        unloaded, latest = [], {}
+        for record in records:
+            op = record.get('Op')
+            if op == 'add':
+                key = self._key(record['Visit_department'], _parse_visit_time(record['Visit_time']))
+                routed.setdefault(key, []).append(record)
+                for other in self._updated.pop(record['Patient_ID'], ()):
+                    if other != key:
+                        routed.setdefault(other, []).append(dict(record, Op='update'))
+                # Only the patient's last fields since their last removal need to go out.
+                if record['Patient_ID'] in latest:
+                    unloaded[latest[record['Patient_ID']]] = None
+                latest[record['Patient_ID']] = len(unloaded)
+                unloaded.append(dict(record, Op='update'))
+            elif op == 'remove':
+                for key in self._dropped.pop(record['Patient_ID'], ()):
+                    routed.setdefault(key, []).append(record)
+                latest.pop(record['Patient_ID'], None)
+                unloaded.append(record)
+        for key, shard_records in routed.items():
+            if batched:
+                shard_records = [{'Op': 'begin'}] + shard_records + [{'Op': 'commit'}]
+            self._shard(key)._append_journal(shard_records)
+        unloaded = [record for record in unloaded if record is not None]
+        if unloaded:
+            if batched:
+                unloaded = [{'Op': 'begin'}] + unloaded + [{'Op': 'commit'}]
+            for key, name in list(self.shard_files.items()):
+                if key not in self._shards:
+                    _write_journal(os.path.join(self.shard_dir, name + ".journal"), unloaded)
+        # Visit_IDs given in the records may be above the mark; other coordinators on the
+        # directory may not load the shard holding them.
+        self.visit_ids.checkpoint()
+        self.note_ids.checkpoint()
+
+        if self.compact_threshold and any(shard.journal_entries >= self.compact_threshold
+                                          for shard in list(self._shards.values())):
+            self.compact_in_background()
+
+    def compact(self):
+        # Compacts the shards with journal records. The read side is held while a shard is
+        # compacted, so no coordinator edit can land between its shard change and its journal
+        # record while the shard is snapshotted; edits wait for the compaction.
+        def compact_shard(key, shard):
+            with self._lock.read():
+                shard.compact()
+
+        with self._compact_lock:
+            self._map(compact_shard, [key for key, shard in list(self._shards.items()) if shard.journal_entries])
+
+    def iter_rows(self, start=None, end=None, department=None, insurance=None, patient_ids=None):
+        if patient_ids is not None:
+            yield from super().iter_rows(start, end, department, insurance, patient_ids)
+            return
+        start_date = parse_date(start) if start is not None else None
+        end_date = parse_date(end) if end is not None else None
+        for key in self._route(department, start_date, end_date):
+            yield from self._shard(key).iter_rows(start, end, department, insurance)
+
+    @property
+    def aggregates(self):
+        # Summed over the shards; patients per insurance counts each patient once, with the
+        # fields of the first shard holding them.
+        with metrics.span("ShardedDepartment.aggregates"):
+            shards = self._loaded()
+            parts = self._map(lambda key, shard: shard.aggregates, [key for key, shard in shards])
+            aggregates = VisitAggregates()
+            for part in parts:
+                for name in ('monthly', 'insurance', 'gender', 'race', 'age_groups'):
+                    counts = getattr(aggregates, name)
+                    for group, count in getattr(part, name).items():
+                        aggregates._bump(counts, group, count)
+            seen = set()
+            for key, shard in shards:
+                for patient_id, patient in shard.patients.items():
+                    if patient_id not in seen:
+                        seen.add(patient_id)
+                        aggregates._bump(aggregates.patient_insurance, patient.insurance, 1)
+            for patient_id, patient in self._new.items():
+                if patient_id not in seen:
+                    aggregates._bump(aggregates.patient_insurance, patient.insurance, 1)
+            return aggregates
+
+    @metrics.timed()
+    def count_visits_on(self, date, department=None):
+        date = parse_date(date)
+        return sum(self._map(lambda key, shard: shard.count_visits_on(date, department),
+                             self._route(department, date, date)))
+
+    @metrics.timed(rows=len)
+    def visits_on(self, date, department=None):
+        date = parse_date(date)
+        return [entry for visits in self._map(lambda key, shard: shard.visits_on(date, department),
+                                              self._route(department, date, date)) for entry in visits]
+
+    @metrics.timed()
+    def count_visits_between(self, start, end, department=None):
+        start, end = parse_date(start), parse_date(end)
+        return sum(self._map(lambda key, shard: shard.count_visits_between(start, end, department),
+                             self._route(department, start, end)))
+
+    @metrics.timed()
+    def count_visits_by_department(self, start, end):
+        start, end = parse_date(start), parse_date(end)
+        counts = {}
+        for part in self._map(lambda key, shard: shard.count_visits_by_department(start, end),
+                              self._route(None, start, end)):
+            for department, count in part.items():
+                counts[department] = counts.get(department, 0) + count
+        return counts
+
+    def _cohort_ids(self, query):
+        predicates = parse_cohort_query(query)
+
+        def match(key, shard):
+            with shard._lock.read():
+                return shard.cohort_index.get(shard).match(predicates)
+
+        with self._lock.read():
+            parts = self._map(match, self._route())
+        seen = set()
+        return [patient_id for part in parts for patient_id in part
+                if patient_id not in seen and not seen.add(patient_id)]
+
+    @metrics.timed(rows=len)
+    def cohort(self, query):
+        patient_ids = self._cohort_ids(query)
+        with self._lock.read():
+            return [self.patients[patient_id] for patient_id in patient_ids]
+
+    @metrics.timed()
+    def count_cohort(self, query):
+        return len(self._cohort_ids(query))
+
+
+if __name__ == "__main__":
+    import sys
+
+    arguments = [argument for argument in sys.argv[1:] if argument != '--by-year']
+    if not arguments:
+        print("Usage: python shards.py Patient_data.csv [SHARD_DIR] [--by-year]")
+        sys.exit(1)
+    source = arguments[0]
+    target = arguments[1] if len(arguments) > 1 else os.path.splitext(source)[0] + ".shards"
+    visits = split_warehouse(source, target, by_year='--by-year' in sys.argv[1:])
+    print(f"Split {visits} visits from {source} into {len(read_manifest(target)['shards'])} shards in {target}")
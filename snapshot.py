@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_VERSION = 1
+# Longer strings (e.g. note text) are stored as one UTF-8 blob plus offsets instead of a
+# fixed-width unicode array.
+MAX_FIXED_WIDTH = 64
+
+
+def snapshot_path(source_path):
+    return source_path + ".snapshot.npz"
+
+
+def _source_meta(source_path):
+    stat = os.stat(source_path)
+    return np.array([SNAPSHOT_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def _encode(prefix, values, arrays):
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories.tolist()
+    else:
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        uniques = uniques.tolist()
+    dtype = np.int8 if len(uniques) < 2 ** 7 else np.int16 if len(uniques) < 2 ** 15 else np.int32
+    arrays[prefix + '.codes'] = codes.astype(dtype)
+
+    if all(len(value) <= MAX_FIXED_WIDTH for value in uniques):
+        arrays[prefix + '.values'] = np.array(uniques, dtype=str) if uniques else np.array([], dtype='U1')
+    else:
+        encoded = [value.encode('utf-8') for value in uniques]
+        arrays[prefix + '.blob'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        arrays[prefix + '.offsets'] = np.cumsum([0] + [len(value) for value in encoded], dtype=np.int64)
+
+
+def _decode(prefix, data):
+    codes = data[prefix + '.codes']
+    if prefix + '.values' in data:
+        return codes, data[prefix + '.values'].tolist()
+    blob = data[prefix + '.blob'].tobytes()
+    offsets = data[prefix + '.offsets'].tolist()
+    return codes, [blob[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+
+
+class SnapshotWriter:
+    # Collects chunks of string columns and writes them as a pickle-free .npz next to the
+    # source file, tagged with the source's size and mtime.
+    def __init__(self, source_path):
+        self.source_path = source_path
+        self.arrays = {}
+        self.chunks = 0
+
+    def add_chunk(self, columns):
+        self.arrays['columns'] = np.array(list(columns), dtype=str)
+        for name, values in columns.items():
+            _encode(f"{self.chunks}.{name}", values, self.arrays)
+        self.chunks += 1
+
+    def write(self):
+        path = snapshot_path(self.source_path)
+        tmp_path = path + ".tmp"
+        try:
+            self.arrays['meta'] = _source_meta(self.source_path)
+            self.arrays['chunks'] = np.array([self.chunks], dtype=np.int64)
+            with open(tmp_path, 'wb') as file:
+                np.savez(file, **self.arrays)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write snapshot {path}: {e}")
+
+
+def read_snapshot(source_path):
+    # Returns a list of chunks, each a dict of column name -> (codes, unique values), or
+    # None when there is no snapshot or the source file changed since it was written.
+    path = snapshot_path(source_path)
+    if not os.path.exists(path) or not os.path.exists(source_path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if not np.array_equal(data['meta'], _source_meta(source_path)):
+                return None
+            names = data['columns'].tolist() if 'columns' in data else []
+            return [{name: _decode(f"{i}.{name}", data) for name in names}
+                    for i in range(int(data['chunks'][0]))]
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
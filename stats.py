@@ -1,46 +1,213 @@
 # stats.py
 import pandas as pd
 
+import metrics
+
+# The warehouse writes ISO dates; older exports used US dates.
+VISIT_TIME_FORMATS = ('%Y-%m-%d', '%m/%d/%Y')
+
+def parse_visit_times(values):
+    # Each value is tried against every format in turn, so a file mixing formats parses the
+    # same whichever rows are read together. Unparseable values become NaT.
+    values = pd.Series(values, dtype=object)
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in VISIT_TIME_FORMATS:
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(values[missing], format=fmt, errors='coerce')
+    return parsed
+
+@metrics.timed("stats.load_patient_data", rows=len)
 def load_patient_data(file_path):
     try:
-        df = pd.read_csv(file_path, parse_dates=['Visit_time'], dayfirst=False)
-        df['Visit_time'] = pd.to_datetime(df['Visit_time'], errors='coerce')
+        df = pd.read_csv(file_path, dtype={'Visit_time': str})
+        df['Visit_time'] = parse_visit_times(df['Visit_time'])
         return df.dropna(subset=['Visit_time'])
     except Exception as e:
         print(f"Error loading data: {e}")
         return pd.DataFrame()
 
-def print_visit_trend(df):
+AGE_BINS = [0, 18, 35, 50, 65, 80, 100]
+AGE_LABELS = ['0-18', '19-35', '36-50', '51-65', '66-80', '81-100']
+
+def age_group(age):
+    # Same buckets as pd.cut(..., bins=AGE_BINS, labels=AGE_LABELS, right=False).
+    for label, low, high in zip(AGE_LABELS, AGE_BINS, AGE_BINS[1:]):
+        if low <= age < high:
+            return label
+    return None
+
+def by_count(counts):
+    # value_counts() order: most frequent first.
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)
+
+def by_age_group(counts):
+    return [(label, counts.get(label, 0)) for label in AGE_LABELS]
+
+class VisitAggregates:
+    # Materialized group counts over a Department's visits, kept current as visits are
+    # added and patients removed, so statistics are served in O(number of groups).
+    def __init__(self):
+        self.monthly = {}
+        self.insurance = {}
+        self.gender = {}
+        self.race = {}
+        self.age_groups = {}
+        self.patient_insurance = {}
+
+    @staticmethod
+    def _bump(counts, key, delta):
+        total = counts.get(key, 0) + delta
+        if total:
+            counts[key] = total
+        else:
+            counts.pop(key, None)
+
+    def add_patient(self, patient, visit_count=0, delta=1):
+        self._bump(self.patient_insurance, patient.insurance, delta)
+        self.add_demographics(patient, visit_count * delta)
+
+    def add_demographics(self, patient, visits):
+        # Per-visit demographic counts, matching the visit-level DataFrame in stats.py.
+        if not visits:
+            return
+        self._bump(self.insurance, patient.insurance, visits)
+        self._bump(self.gender, patient.gender, visits)
+        self._bump(self.race, patient.race, visits)
+        group = age_group(patient.age)
+        if group is not None:
+            self._bump(self.age_groups, group, visits)
+
+    def add_visit(self, patient, visit, delta=1):
+        self._bump(self.monthly, (visit.visit_time.year, visit.visit_time.month), delta)
+        self.add_demographics(patient, delta)
+
+    def add_date_counts(self, date_counts):
+        for date, count in date_counts.items():
+            self._bump(self.monthly, (date.year, date.month), count)
+
+    def monthly_visits(self):
+        return [(f"{year:04d}-{month:02d}", count) for (year, month), count in sorted(self.monthly.items())]
+
+def _print_visit_trend(monthly_visits):
     print("\n Monthly Visit Trends:")
-    visit_counts = df['Visit_time'].dt.to_period('M').value_counts().sort_index()
-    for period, count in visit_counts.items():
-        print(f" - {period.strftime('%Y-%m')}: {count} visits")
+    for month, count in monthly_visits:
+        print(f" - {month}: {count} visits")
 
-def print_insurance_trend(df):
+def _print_insurance_trend(insurance_counts):
     print("\n Visits by Insurance Type:")
-    insurance_counts = df['Insurance'].value_counts()
-    for insurance, count in insurance_counts.items():
+    for insurance, count in insurance_counts:
         print(f" - {insurance}: {count} visits")
 
-def print_demographics(df):
+def _print_demographics(gender_counts, race_counts, age_group_counts):
     print("\n Demographics Breakdown:")
 
     print("\n  ▪ Gender Distribution:")
-    for gender, count in df['Gender'].value_counts().items():
+    for gender, count in gender_counts:
         print(f"    - {gender}: {count}")
 
     print("\n  ▪ Race Distribution:")
-    for race, count in df['Race'].value_counts().items():
+    for race, count in race_counts:
         print(f"    - {race}: {count}")
 
     print("\n  ▪ Age Groups:")
-    bins = [0, 18, 35, 50, 65, 80, 100]
-    labels = ['0-18', '19-35', '36-50', '51-65', '66-80', '81-100']
-    df['Age_Group'] = pd.cut(df['Age'], bins=bins, labels=labels, right=False)
-    for group, count in df['Age_Group'].value_counts().sort_index().items():
+    for group, count in age_group_counts:
         print(f"    - {group}: {count}")
 
-def generate_all_statistics(data_file_path):
+@metrics.timed("stats.print_visit_trend")
+def print_visit_trend(df):
+    visit_counts = df['Visit_time'].dt.to_period('M').value_counts().sort_index()
+    _print_visit_trend((period.strftime('%Y-%m'), count) for period, count in visit_counts.items())
+
+@metrics.timed("stats.print_insurance_trend")
+def print_insurance_trend(df):
+    _print_insurance_trend(df['Insurance'].value_counts().items())
+
+@metrics.timed("stats.print_demographics")
+def print_demographics(df):
+    age_groups = pd.cut(df['Age'], bins=AGE_BINS, labels=AGE_LABELS, right=False)
+    _print_demographics(df['Gender'].value_counts().items(), df['Race'].value_counts().items(),
+                        age_groups.value_counts().sort_index().items())
+
+@metrics.timed("stats.print_aggregate_statistics")
+def print_aggregate_statistics(aggregates):
+    if not aggregates.monthly:
+        print(" No valid data available for statistics.")
+        return
+
+    _print_visit_trend(aggregates.monthly_visits())
+    _print_insurance_trend(by_count(aggregates.insurance))
+    _print_demographics(by_count(aggregates.gender), by_count(aggregates.race),
+                        by_age_group(aggregates.age_groups))
+    print("\n Summary statistics displayed successfully.")
+
+# Chunked statistics for files larger than memory: only the columns the statistics use
+# are read, strings as categoricals, and each chunk is folded into a VisitAggregates.
+STATISTICS_COLUMNS = ['Visit_time', 'Insurance', 'Gender', 'Race', 'Age']
+STATISTICS_DTYPES = {'Visit_time': 'category', 'Insurance': 'category', 'Gender': 'category',
+                     'Race': 'category', 'Age': 'float64'}
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+_SAMPLE_ROWS = 10000
+# Parsing a chunk briefly holds the raw strings alongside the parsed frame.
+_PARSE_OVERHEAD = 4
+
+def chunk_rows(file_path, memory_limit=DEFAULT_MEMORY_LIMIT):
+    # Rows per chunk that keep a parsed chunk under memory_limit bytes, estimated from
+    # the in-memory size of a sample of the file.
+    sample = pd.read_csv(file_path, usecols=STATISTICS_COLUMNS, dtype=str, nrows=_SAMPLE_ROWS)
+    if sample.empty:
+        return _SAMPLE_ROWS
+    row_bytes = sample.memory_usage(index=False, deep=True).sum() / len(sample)
+    return max(int(memory_limit // (row_bytes * _PARSE_OVERHEAD)), 1)
+
+def _add_counts(counts, column):
+    # Keys are added in order of first appearance so ties rank as value_counts() ranks them.
+    totals = column.value_counts(sort=False)
+    for value in column.dropna().unique():
+        VisitAggregates._bump(counts, value, int(totals[value]))
+
+@metrics.timed("stats.aggregate_patient_data")
+def aggregate_patient_data(file_path, memory_limit=DEFAULT_MEMORY_LIMIT):
+    # Same counts as load_patient_data() followed by the print_* functions, with at most
+    # one chunk of the file in memory at a time.
+    aggregates = VisitAggregates()
+    chunks = pd.read_csv(file_path, usecols=STATISTICS_COLUMNS, dtype=STATISTICS_DTYPES,
+                         chunksize=chunk_rows(file_path, memory_limit))
+    for chunk in metrics.iterate("stats.read_chunk", chunks):
+        # Parse each distinct timestamp once rather than once per row.
+        times = chunk['Visit_time'].cat.categories
+        parsed = pd.Series(parse_visit_times(times).to_numpy(), index=times)
+        visit_time = chunk['Visit_time'].map(parsed).astype('datetime64[ns]')
+        chunk = chunk[visit_time.notna()]
+        visit_time = visit_time[visit_time.notna()]
+        if chunk.empty:
+            continue
+
+        months = visit_time.dt.year * 100 + visit_time.dt.month
+        for month, count in months.value_counts(sort=False).items():
+            VisitAggregates._bump(aggregates.monthly, divmod(int(month), 100), int(count))
+        _add_counts(aggregates.insurance, chunk['Insurance'])
+        _add_counts(aggregates.gender, chunk['Gender'])
+        _add_counts(aggregates.race, chunk['Race'])
+        age_groups = pd.cut(chunk['Age'], bins=AGE_BINS, labels=AGE_LABELS, right=False)
+        for group, count in age_groups.value_counts(sort=False).items():
+            if count:
+                VisitAggregates._bump(aggregates.age_groups, group, int(count))
+    return aggregates
+
+@metrics.timed("stats.generate_all_statistics")
+def generate_all_statistics(data_file_path, memory_limit=None):
+    # With a memory_limit (bytes) the file is streamed in chunks instead of loaded whole.
+    if memory_limit is not None:
+        try:
+            aggregates = aggregate_patient_data(data_file_path, memory_limit)
+        except Exception as e:
+            print(f"Error loading data: {e}")
+            aggregates = VisitAggregates()
+        print_aggregate_statistics(aggregates)
+        return
+
     df = load_patient_data(data_file_path)
     if df.empty:
         print(" No valid data available for statistics.")
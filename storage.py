@@ -0,0 +1,560 @@
+import collections.abc
+import datetime
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+import metrics
+from cohort import parse_cohort_query
+from ids import get_allocator
+from indexes import parse_date
+from patients import FIELDNAMES, Department, Note, NotesDatabase, Patient, Visit, _new_notes, _parse_visit_time
+from shards import ShardedDepartment, is_shard_dir
+from stats import VisitAggregates
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+TABLES = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    gender TEXT, race TEXT, age INTEGER, ethnicity TEXT, insurance TEXT, zip_code TEXT
+);
+CREATE TABLE IF NOT EXISTS visits (
+    id INTEGER PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    visit_id TEXT, visit_time TEXT NOT NULL, visit_department TEXT,
+    chief_complaint TEXT, note_id TEXT, note_type TEXT
+);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    patient_id TEXT, visit_id TEXT, note_id TEXT, note_text TEXT
+);
+"""
+
+INDEXES = {
+    'visits': """
+        DROP INDEX IF EXISTS visits_patient;
+        CREATE INDEX IF NOT EXISTS visits_patient_time ON visits (patient_id, visit_time);
+        CREATE INDEX IF NOT EXISTS visits_visit_id ON visits (visit_id);
+        CREATE INDEX IF NOT EXISTS visits_time ON visits (visit_time, visit_department);
+        CREATE INDEX IF NOT EXISTS visits_note ON visits (note_id);
+    """,
+    'notes': """
+        CREATE INDEX IF NOT EXISTS notes_visit ON notes (patient_id, visit_id);
+        CREATE INDEX IF NOT EXISTS notes_note_id ON notes (note_id);
+    """,
+}
+
+# Visit_time is stored as ISO text so date filters are plain indexed string comparisons.
+ROW_QUERY = """
+    SELECT p.patient_id, v.visit_id, v.visit_time, v.visit_department, p.race, p.gender,
+           p.ethnicity, p.age, p.zip_code, p.insurance, v.chief_complaint, v.note_id, v.note_type
+    FROM visits v JOIN patients p ON p.patient_id = v.patient_id
+"""
+
+
+def is_sqlite_path(path):
+    return path.lower().endswith(SQLITE_EXTENSIONS)
+
+
+class SqliteStore:
+    # One SQLite database file in WAL mode: readers never block the writer or each other.
+    # sqlite3 connections must not be shared between threads, so each thread gets its own.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(TABLES)
+            for script in INDEXES.values():
+                conn.executescript(script)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @metrics.timed()
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    def commit(self):
+        self.connection().commit()
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @metrics.timed(rows=lambda count: count)
+    def bulk_load(self, table, insert):
+        # Inserts into an empty table run faster with its indexes dropped and rebuilt once.
+        conn = self.connection()
+        empty = conn.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {table})").fetchone()[0]
+        with conn:
+            if empty:
+                for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                            "AND tbl_name = ? AND sql IS NOT NULL", (table,)).fetchall():
+                    conn.execute(f"DROP INDEX {name}")
+            count = insert(conn)
+        conn.executescript(INDEXES.get(table, ""))
+        return count
+
+    def checkpoint(self):
+        self.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+class PatientMapping(collections.abc.Mapping):
+    # Dict-like view of the patients table; patients and their visits are read on access.
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, patient_id):
+        row = self.store.execute("SELECT patient_id, gender, race, age, ethnicity, insurance, zip_code "
+                                 "FROM patients WHERE patient_id = ?", (str(patient_id),)).fetchone()
+        if row is None:
+            raise KeyError(patient_id)
+        patient = Patient(*row)
+        patient.visits = [Visit(*visit) for visit in self.store.execute(
+            "SELECT visit_id, visit_time, visit_department, chief_complaint, note_id, note_type "
+            "FROM visits WHERE patient_id = ? ORDER BY visit_time, id", (patient.patient_id,))]
+        return patient
+
+    def __contains__(self, patient_id):
+        return self.store.execute("SELECT 1 FROM patients WHERE patient_id = ?",
+                                  (str(patient_id),)).fetchone() is not None
+
+    def __iter__(self):
+        return (patient_id for (patient_id,) in
+                self.store.execute("SELECT patient_id FROM patients ORDER BY rowid"))
+
+    def __len__(self):
+        return self.store.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+
+def _load_ids(store, name, sql, batch=100000):
+    # The allocator for a column, filled from the database on first use.
+    allocator = get_allocator(name, store.db_path)
+    cursor = store.execute(sql)
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            return allocator
+        allocator.add_many([row[0] for row in rows])
+
+
+class SqliteDepartment(Department):
+    # Department backed by SQLite. Nothing is loaded up front: patients are read on demand
+    # and counts and statistics are answered by indexed queries, so opening the database
+    # takes constant time. Edits go through the same hooks the CSV Department uses, with a
+    # commit where the CSV version appends to its journal, so the inherited editing,
+    # export and report methods work unchanged.
+    def __init__(self, name, db_path):
+        # SQLite commits every edit itself, so there is no journal to compact or snapshot to keep.
+        super().__init__(name, db_path, compact_threshold=0, use_snapshot=False)
+
+    def _init_storage(self):
+        self.store = SqliteStore(self.file_path)
+        self.patients = PatientMapping(self.store)
+        self._writes = 0
+        self._visit_ids = self._note_ids = None
+
+    @property
+    def visit_ids(self):
+        if self._visit_ids is None:
+            self._visit_ids = _load_ids(self.store, 'Visit_ID', "SELECT visit_id FROM visits WHERE visit_id != ''")
+        return self._visit_ids
+
+    @property
+    def note_ids(self):
+        if self._note_ids is None:
+            self._note_ids = _load_ids(self.store, 'Note_ID', "SELECT note_id FROM visits WHERE note_id != '' "
+                                                              "UNION ALL SELECT note_id FROM notes WHERE note_id != ''")
+        return self._note_ids
+
+    @property
+    def version(self):
+        # Changes on our own writes and when another connection commits.
+        return self._writes, self.store.execute("PRAGMA data_version").fetchone()[0]
+
+    def is_stale(self):
+        return False
+
+    def load_data(self, chunksize=250000):
+        pass
+
+    def import_csv(self, csv_path, chunksize=250000):
+        # Bulk import of a Patient_data.csv in one transaction per table. Any journal the file
+        # has is compacted into it first, so the file alone holds every edit. Visits whose
+        # Visit_ID is already in the database are skipped, so importing a file again adds
+        # only what is new in it.
+        if os.path.exists(csv_path + ".journal"):
+            Department(self.name, csv_path, use_snapshot=False).compact()
+        skip_known = self.store.execute("SELECT EXISTS (SELECT 1 FROM visits)").fetchone()[0]
+
+        def insert(conn):
+            count = 0
+            header = pd.read_csv(csv_path, nrows=0, encoding='utf-8').columns
+            chunks = pd.read_csv(csv_path, dtype={name: str for name in header}, keep_default_na=False,
+                                 na_filter=False, chunksize=chunksize, encoding='utf-8')
+            for chunk in chunks:
+                chunk = chunk.reindex(columns=FIELDNAMES, fill_value='')
+                ages = pd.to_numeric(chunk['Age'], errors='coerce')
+                chunk['Age'] = ages.where(ages % 1 == 0).fillna(0).astype('int64')
+                times = {value: _parse_visit_time(value).strftime('%Y-%m-%d')
+                         for value in chunk['Visit_time'].unique()}
+                chunk['Visit_time'] = chunk['Visit_time'].map(times)
+                conn.executemany(
+                    "INSERT OR IGNORE INTO patients VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    chunk[['Patient_ID', 'Gender', 'Race', 'Age', 'Ethnicity', 'Insurance',
+                           'Zip_code']].itertuples(index=False, name=None))
+                visits = chunk[['Patient_ID', 'Visit_ID', 'Visit_time', 'Visit_department', 'Chief_complaint',
+                                'Note_ID', 'Note_type']]
+                if skip_known:
+                    # An empty table has its indexes dropped for the load, and nothing to skip.
+                    visits = visits[~visits['Visit_ID'].isin(self._loaded_visit_ids(
+                        set(visits['Visit_ID']) - {''}))]
+                conn.executemany(
+                    "INSERT INTO visits (patient_id, visit_id, visit_time, visit_department, chief_complaint, "
+                    "note_id, note_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    visits.itertuples(index=False, name=None))
+                count += len(visits)
+            return count
+
+        with self._lock.write():
+            count = self.store.bulk_load('visits', insert)
+            self._writes += 1
+        return count
+
+    def _new_patient(self, patient):
+        self.store.execute("INSERT INTO patients VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (patient.patient_id, patient.gender, patient.race, patient.age,
+                            patient.ethnicity, patient.insurance, patient.zip_code))
+        self._writes += 1
+        return patient
+
+    def _add_visit(self, patient, visit):
+        self.store.execute(
+            "INSERT INTO visits (patient_id, visit_id, visit_time, visit_department, chief_complaint, "
+            "note_id, note_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (patient.patient_id, visit.visit_id, visit.visit_time.strftime('%Y-%m-%d'),
+             visit.visit_department, visit.chief_complaint, visit.note_id, visit.note_type))
+        self.visit_ids.add(visit.visit_id)
+        self.note_ids.add(visit.note_id)
+        self._writes += 1
+
+    def _update_patient(self, patient, gender, race, age, ethnicity, insurance, zip_code):
+        self.store.execute("UPDATE patients SET gender = ?, race = ?, age = ?, ethnicity = ?, insurance = ?, "
+                           "zip_code = ? WHERE patient_id = ?",
+                           (gender, race, age, ethnicity, insurance, zip_code, patient.patient_id))
+        self._writes += 1
+
+    def _drop_patient(self, patient_id):
+        patient = self.patients.get(patient_id)
+        if patient is not None:
+            self.store.execute("DELETE FROM visits WHERE patient_id = ?", (patient_id,))
+            self.store.execute("DELETE FROM patients WHERE patient_id = ?", (patient_id,))
+            self._writes += 1
+        return patient
+
+    def _loaded_visit_ids(self, visit_ids):
+        visit_ids, found = list(visit_ids), set()
+        for start in range(0, len(visit_ids), 500):
+            batch = visit_ids[start:start + 500]
+            found.update(row[0] for row in self.store.execute(
+                f"SELECT visit_id FROM visits WHERE visit_id IN ({', '.join('?' * len(batch))})", batch))
+        return found
+
+    def add_visits(self, rows):
+        # Same contract as Department.add_visits, as two batched statements in one transaction;
+        # a later row for a known patient updates the patient, as replaying the journal would.
+        records = self._visit_records(rows)
+        if not records:
+            return 0
+
+        def age(value):
+            try:
+                return int(value)
+            except ValueError:
+                return 0
+
+        with self._lock.write(), metrics.span("SqliteDepartment.add_visits") as span, \
+                self.store.connection() as conn:
+            conn.executemany(
+                "INSERT INTO patients VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (patient_id) DO UPDATE SET "
+                "gender = excluded.gender, race = excluded.race, age = excluded.age, "
+                "ethnicity = excluded.ethnicity, insurance = excluded.insurance, zip_code = excluded.zip_code",
+                ((r['Patient_ID'], r['Gender'], r['Race'], age(r['Age']), r['Ethnicity'], r['Insurance'],
+                  r['Zip_code']) for r in records))
+            conn.executemany(
+                "INSERT INTO visits (patient_id, visit_id, visit_time, visit_department, chief_complaint, "
+                "note_id, note_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((r['Patient_ID'], r['Visit_ID'], _parse_visit_time(r['Visit_time']).strftime('%Y-%m-%d'),
+                  r['Visit_department'], r['Chief_complaint'], r['Note_ID'], r['Note_type']) for r in records))
+            span.add(rows=len(records))
+        self.visit_ids.add_many([r['Visit_ID'] for r in records])
+        self.note_ids.add_many([r['Note_ID'] for r in records])
+        self._writes += 1
+        return len(records)
+
+    def _append_journal(self, records):
+        # SQLite is its own journal: committing makes the pending edits durable.
+        with self._lock.write():
+            self.store.commit()
+
+    def compact(self):
+        with self._lock.write():
+            self.store.commit()
+            self.store.checkpoint()
+
+    def compact_in_background(self):
+        return None
+
+    def _query_rows(self, start=None, end=None, department=None, insurance=None, patient_ids=None):
+        clauses, params = [], []
+        if start is not None:
+            clauses.append("v.visit_time >= ?")
+            params.append(parse_date(start).isoformat())
+        if end is not None:
+            clauses.append("v.visit_time <= ?")
+            params.append(parse_date(end).isoformat())
+        if department is not None:
+            clauses.append("v.visit_department = ?")
+            params.append(department)
+        if insurance is not None:
+            clauses.append("p.insurance = ?")
+            params.append(insurance)
+        if patient_ids is not None:
+            patient_ids = [str(pid) for pid in patient_ids]
+            clauses.append(f"v.patient_id IN ({', '.join('?' * len(patient_ids))})")
+            params.extend(patient_ids)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return ROW_QUERY + where + " ORDER BY p.rowid, v.visit_time, v.id", params
+
+    def iter_rows(self, start=None, end=None, department=None, insurance=None, patient_ids=None):
+        sql, params = self._query_rows(start, end, department, insurance, patient_ids)
+        for row in self.store.execute(sql, params):
+            yield dict(zip(FIELDNAMES, row))
+
+    @property
+    def aggregates(self):
+        # Built from GROUP BY queries on demand rather than maintained in memory. Groups come
+        # in order of first appearance, matching the key order of the in-memory aggregates.
+        aggregates = VisitAggregates()
+        for gender, race, age, insurance, patients, visits in self.store.execute(
+                "SELECT p.gender, p.race, p.age, p.insurance, COUNT(*), SUM(COALESCE(v.visits, 0)) "
+                "FROM patients p LEFT JOIN (SELECT patient_id, COUNT(*) AS visits FROM visits "
+                "GROUP BY patient_id) v ON v.patient_id = p.patient_id "
+                "GROUP BY p.gender, p.race, p.age, p.insurance ORDER BY MIN(p.rowid)"):
+            group = Patient('', gender, race, age, '', insurance, '')
+            aggregates.add_patient(group, delta=patients)
+            aggregates.add_demographics(group, visits)
+        aggregates.add_date_counts({
+            datetime.date(int(month[:4]), int(month[5:7]), 1): count for month, count in self.store.execute(
+                "SELECT substr(visit_time, 1, 7), COUNT(*) FROM visits GROUP BY 1")})
+        return aggregates
+
+    def _count(self, start, end, department=None):
+        sql = "SELECT COUNT(*) FROM visits WHERE visit_time BETWEEN ? AND ?"
+        params = [parse_date(start).isoformat(), parse_date(end).isoformat()]
+        if department is not None:
+            sql += " AND visit_department = ?"
+            params.append(department)
+        return self.store.execute(sql, params).fetchone()[0]
+
+    def count_visits_on(self, date, department=None):
+        return self._count(date, date, department)
+
+    def count_visits_between(self, start, end, department=None):
+        return self._count(start, end, department)
+
+    def count_visits_by_department(self, start, end):
+        counts = {department: 0 for (department,) in
+                  self.store.execute("SELECT DISTINCT visit_department FROM visits")}
+        counts.update(self.store.execute(
+            "SELECT visit_department, COUNT(*) FROM visits WHERE visit_time BETWEEN ? AND ? "
+            "GROUP BY visit_department", (parse_date(start).isoformat(), parse_date(end).isoformat())))
+        return counts
+
+    def latest_visit(self, patient_id):
+        row = self.store.execute(
+            "SELECT visit_id, visit_time, visit_department, chief_complaint, note_id, note_type FROM visits "
+            "WHERE patient_id = ? ORDER BY visit_time DESC, id DESC LIMIT 1", (str(patient_id),)).fetchone()
+        return Visit(*row) if row is not None else None
+
+    def visit_history(self, patient_id, page=0, per_page=20):
+        row = self.store.execute("SELECT patient_id, gender, race, age, ethnicity, insurance, zip_code "
+                                 "FROM patients WHERE patient_id = ?", (str(patient_id),)).fetchone()
+        if row is None:
+            return None
+        visits = [Visit(*visit) for visit in self.store.execute(
+            "SELECT visit_id, visit_time, visit_department, chief_complaint, note_id, note_type FROM visits "
+            "WHERE patient_id = ? ORDER BY visit_time DESC, id DESC LIMIT ? OFFSET ?",
+            (row[0], per_page, page * per_page))]
+        total = self.store.execute("SELECT COUNT(*) FROM visits WHERE patient_id = ?", (row[0],)).fetchone()[0]
+        return Patient(*row), visits, total
+
+    def _cohort_sql(self, query, select):
+        # Patient filters apply to the patients table; visit filters go together into one
+        # EXISTS, so they must all hold on the same visit, as in CohortIndex.
+        clauses = {False: [], True: []}
+        params = {False: [], True: []}
+        for predicate in parse_cohort_query(query):
+            column = predicate.field
+            if predicate.values is not None:
+                clause = f"{column} COLLATE NOCASE IN ({', '.join('?' * len(predicate.values))})"
+                values = sorted(predicate.values)
+            else:
+                bounds = [(">=", predicate.low), ("<=", predicate.high)]
+                bounds = [(op, value.isoformat() if column == 'visit_time' else value)
+                          for op, value in bounds if value is not None]
+                clause = " AND ".join(f"{column} {op} ?" for op, value in bounds) or "1"
+                values = [value for op, value in bounds]
+            clauses[predicate.on_visits].append(f"NOT ({clause})" if predicate.negate else f"({clause})")
+            params[predicate.on_visits].extend(values)
+        if clauses[True]:
+            clauses[False].append("EXISTS (SELECT 1 FROM visits WHERE visits.patient_id = patients.patient_id "
+                                  f"AND {' AND '.join(clauses[True])})")
+        return (f"SELECT {select} FROM patients WHERE {' AND '.join(clauses[False])}",
+                params[False] + params[True])
+
+    def cohort(self, query):
+        sql, params = self._cohort_sql(query, "patient_id")
+        return [self.patients[pid] for (pid,) in self.store.execute(sql + " ORDER BY rowid", params).fetchall()]
+
+    def count_cohort(self, query):
+        sql, params = self._cohort_sql(query, "COUNT(*)")
+        return self.store.execute(sql, params).fetchone()[0]
+
+    def visits_on(self, date, department=None):
+        sql = ("SELECT patient_id, visit_id, visit_time, visit_department, chief_complaint, note_id, note_type "
+               "FROM visits WHERE visit_time = ?")
+        params = [parse_date(date).isoformat()]
+        if department is not None:
+            sql += " AND visit_department = ?"
+            params.append(department)
+        return [(row[0], Visit(*row[1:])) for row in self.store.execute(sql + " ORDER BY id", params)]
+
+
+class SqliteNotesDatabase(NotesDatabase):
+    # Notes served straight from the notes table by indexed lookups.
+    def __init__(self, db_path):
+        self.notes_file_path = db_path
+        self.store = SqliteStore(db_path)
+        self._note_ids = None
+
+    @property
+    def note_ids(self):
+        if self._note_ids is None:
+            self._note_ids = _load_ids(self.store, 'Note_ID', "SELECT note_id FROM visits WHERE note_id != '' "
+                                                              "UNION ALL SELECT note_id FROM notes WHERE note_id != ''")
+        return self._note_ids
+
+    def load_notes(self):
+        pass
+
+    def import_csv(self, csv_path, chunksize=50000):
+        # As SqliteDepartment.import_csv, notes whose Note_ID is already stored are skipped.
+        skip_known = self.store.execute("SELECT EXISTS (SELECT 1 FROM notes)").fetchone()[0]
+
+        def insert(conn):
+            count = 0
+            for chunk in pd.read_csv(csv_path, usecols=['Patient_ID', 'Visit_ID', 'Note_ID', 'Note_text'],
+                                     dtype=str, keep_default_na=False, na_filter=False, chunksize=chunksize,
+                                     encoding='utf-8'):
+                if skip_known:
+                    chunk = chunk[[note_id == '' or not self._stored_note_id(note_id)
+                                   for note_id in chunk['Note_ID']]]
+                conn.executemany("INSERT INTO notes (patient_id, visit_id, note_id, note_text) VALUES (?, ?, ?, ?)",
+                                 chunk[['Patient_ID', 'Visit_ID', 'Note_ID', 'Note_text']].itertuples(
+                                     index=False, name=None))
+                count += len(chunk)
+            return count
+
+        return self.store.bulk_load('notes', insert)
+
+    def _notes(self, where, params):
+        return [Note(*row) for row in self.store.execute(
+            f"SELECT patient_id, visit_id, note_id, note_text FROM notes WHERE {where} ORDER BY id", params)]
+
+    def get_note(self, note_id):
+        notes = self._notes("note_id = ?", (str(note_id),))
+        return notes[0] if notes else None
+
+    def get_notes_for_visit(self, patient_id, visit_id):
+        return self._notes("patient_id = ? AND visit_id = ?", (str(patient_id), str(visit_id)))
+
+    def add_note(self, patient_id, visit_id, note_id, note_text):
+        if note_id is None or note_id == '':
+            note_id = self.note_ids.allocate()
+        note = Note(patient_id, visit_id, note_id, note_text)
+        with self.store.connection() as conn:
+            conn.execute("INSERT INTO notes (patient_id, visit_id, note_id, note_text) VALUES (?, ?, ?, ?)",
+                         (note.patient_id, note.visit_id, note.note_id, note.note_text))
+        self.note_ids.add(note.note_id)
+        return note
+
+    def _stored_note_id(self, note_id):
+        return self.store.execute("SELECT 1 FROM notes WHERE note_id = ? LIMIT 1", (note_id,)).fetchone() is not None
+
+    def add_notes(self, rows):
+        notes = _new_notes(rows, self.note_ids, self._stored_note_id)
+        with self.store.connection() as conn:
+            conn.executemany("INSERT INTO notes (patient_id, visit_id, note_id, note_text) VALUES (?, ?, ?, ?)",
+                             ((note.patient_id, note.visit_id, note.note_id, note.note_text) for note in notes))
+        self.note_ids.add_many([note.note_id for note in notes])
+        return notes
+
+    def get_notes_by_patient_and_date(self, patient_id, visit_date, patient_data):
+        try:
+            visit_date_obj = datetime.datetime.strptime(visit_date, '%Y-%m-%d').date()
+        except ValueError:
+            print("Invalid date format. Use YYYY-MM-DD.")
+            return []
+
+        patient = patient_data.patients.get(patient_id)
+        if patient is None:
+            print("Patient not found.")
+            return []
+
+        notes_found = []
+        for visit in patient.visits:
+            if visit.visit_time.date() == visit_date_obj:
+                notes_found.extend(self.get_notes_for_visit(patient_id, visit.visit_id))
+        return notes_found
+
+    def close(self):
+        self.store.close()
+
+
+def open_department(file_path, name="General", **kwargs):
+    # A shard directory (see shards.py) opens the shards of `name`, or all of them for "General".
+    if is_sqlite_path(file_path):
+        return SqliteDepartment(name, file_path)
+    if is_shard_dir(file_path):
+        return ShardedDepartment(name, file_path, **kwargs)
+    return Department(name, file_path, **kwargs)
+
+
+def open_notes(file_path, **kwargs):
+    if is_sqlite_path(file_path):
+        return SqliteNotesDatabase(file_path)
+    return NotesDatabase(file_path, **kwargs)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Usage: python storage.py DATABASE [Patient_data.csv] [Notes.csv]")
+        sys.exit(1)
+    db_path = sys.argv[1]
+    patients_csv = sys.argv[2] if len(sys.argv) > 2 else "Patient_data.csv"
+    notes_csv = sys.argv[3] if len(sys.argv) > 3 else "Notes.csv"
+    print(f"Imported {SqliteDepartment('General', db_path).import_csv(patients_csv)} visits from {patients_csv}")
+    print(f"Imported {SqliteNotesDatabase(db_path).import_csv(notes_csv)} notes from {notes_csv}")
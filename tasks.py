@@ -0,0 +1,160 @@
+import queue
+import threading
+import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import messagebox, ttk
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Task:
+    # Handle shared between the worker running a task and the Tk thread watching it.
+    # Workers call report() to publish progress; report() also raises TaskCancelled once
+    # the user has cancelled, so long-running work stops at its next checkpoint. Only
+    # cancellable tasks, whose workers call report(), offer Cancel.
+    def __init__(self, title, cancellable=False):
+        self.title = title
+        self.cancellable = cancellable
+        self.fraction = None
+        self.message = title
+        self.future = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def report(self, fraction=None, message=None):
+        if self.cancelled:
+            raise TaskCancelled(self.title)
+        if fraction is not None:
+            self.fraction = min(max(fraction, 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+
+class ProgressDialog:
+    def __init__(self, parent, task):
+        self.task = task
+        self.window = tk.Toplevel(parent)
+        self.window.title(task.title)
+        self.window.geometry("320x130")
+        self.window.resizable(False, False)
+        self.window.protocol("WM_DELETE_WINDOW", task.cancel if task.cancellable else lambda: None)
+
+        self.label = tk.Label(self.window, text=task.message, font=("Helvetica", 11))
+        self.label.pack(pady=(15, 5))
+        self.bar = ttk.Progressbar(self.window, length=260, maximum=1.0, mode='indeterminate')
+        self.bar.pack(pady=5)
+        self.bar.start(15)
+        if task.cancellable:
+            tk.Button(self.window, text="Cancel", command=task.cancel).pack(pady=5)
+
+    def update(self):
+        self.label.config(text=self.task.message)
+        if self.task.fraction is not None and self.bar['mode'] != 'determinate':
+            self.bar.stop()
+            self.bar.config(mode='determinate')
+        if self.task.fraction is not None:
+            self.bar['value'] = self.task.fraction
+
+    def close(self):
+        self.bar.stop()
+        self.window.destroy()
+
+
+class TaskRunner:
+    # Runs dashboard actions on a worker pool and hands their results back to the Tk thread.
+    # Tk is not thread-safe, so workers only touch a queue; the Tk side drains it from an
+    # after() poll while tasks are outstanding and runs the callbacks there. A progress
+    # dialog appears for tasks that take longer than progress_delay, with a Cancel button
+    # for those submitted as cancellable.
+    def __init__(self, root, max_workers=4, poll_interval=50, progress_delay=300):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.progress_delay = progress_delay
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dashboard")
+        self._results = queue.Queue()
+        self._tasks = {}
+        self._polling = False
+
+    def submit(self, title, func, *args, on_success=None, on_error=None, on_cancel=None, cancellable=False):
+        # func is called on a worker as func(task, *args). A cancellable func must call
+        # task.report() at the points where it can stop.
+        task = Task(title, cancellable)
+        self._tasks[task] = {'on_success': on_success, 'on_error': on_error,
+                             'on_cancel': on_cancel, 'dialog': None}
+        task.future = self._executor.submit(self._run, task, func, args)
+        self.root.after(self.progress_delay, self._show_progress, task)
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.poll_interval, self._poll)
+        return task
+
+    def cancel_all(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    def shutdown(self):
+        self.cancel_all()
+        self._executor.shutdown(wait=False)
+
+    def _run(self, task, func, args):
+        try:
+            result = func(task, *args)
+        except TaskCancelled:
+            self._results.put((task, 'cancelled', None))
+        except Exception as e:
+            self._results.put((task, 'error', e))
+        else:
+            self._results.put((task, 'cancelled' if task.cancelled else 'done', result))
+
+    def _show_progress(self, task):
+        entry = self._tasks.get(task)
+        if entry is not None and entry['dialog'] is None:
+            entry['dialog'] = ProgressDialog(self.root, task)
+
+    def _poll(self):
+        while True:
+            try:
+                task, outcome, value = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._finish(task, outcome, value)
+
+        for task, entry in list(self._tasks.items()):
+            if task.cancelled:
+                # Release the UI right away; a worker that ignores the cancel keeps running
+                # in the background and its result is dropped when it arrives.
+                self._finish(task, 'cancelled', None)
+            elif entry['dialog'] is not None:
+                entry['dialog'].update()
+
+        if self._tasks:
+            self.root.after(self.poll_interval, self._poll)
+        else:
+            self._polling = False
+
+    def _finish(self, task, outcome, value):
+        entry = self._tasks.pop(task, None)
+        if entry is None:
+            return
+        if entry['dialog'] is not None:
+            entry['dialog'].close()
+        if outcome == 'done':
+            if entry['on_success'] is not None:
+                entry['on_success'](value)
+        elif outcome == 'error':
+            if entry['on_error'] is not None:
+                entry['on_error'](value)
+            else:
+                messagebox.showerror("Error", f"{task.title} failed: {value}")
+        elif entry['on_cancel'] is not None:
+            entry['on_cancel']()
@@ -0,0 +1,29 @@
+import csv
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from patients import FIELDNAMES
+
+
+def visit_row(patient_id, visit_id, visit_time, department='Cardiology', age='40', insurance='Medicare'):
+    return {'Patient_ID': patient_id, 'Visit_ID': visit_id, 'Visit_time': visit_time,
+            'Visit_department': department, 'Race': 'White', 'Gender': 'Female',
+            'Ethnicity': 'Non-Hispanic', 'Age': age, 'Zip_code': '02139', 'Insurance': insurance,
+            'Chief_complaint': 'fatigue', 'Note_ID': f"N{visit_id}", 'Note_type': 'progress note'}
+
+
+@pytest.fixture
+def write_visits(tmp_path):
+    # Writes rows to a Patient_data.csv under tmp_path and returns its path.
+    def write(rows, name='Patient_data.csv'):
+        path = str(tmp_path / name)
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=FIELDNAMES, lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+    return write
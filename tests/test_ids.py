@@ -0,0 +1,46 @@
+import ids
+from conftest import visit_row
+from ids import FIRST_ID, IdAllocator, get_allocator
+from patients import Department
+
+
+def test_allocation_skips_loaded_ids(tmp_path):
+    allocator = IdAllocator('Visit_ID', str(tmp_path / 'ids.json'))
+    allocator.add_many(['100004', '100010', 'A-7', ''])
+    assert '100010' in allocator and '00100004' in allocator and 'A-7' in allocator
+    assert '100005' not in allocator and '' not in allocator
+    assert allocator.allocate() == '100011'
+    assert allocator.reserve(3) == ['100012', '100013', '100014']
+    assert '100014' in allocator
+
+
+def test_high_water_mark_survives_a_restart(tmp_path):
+    state_path = str(tmp_path / 'ids.json')
+    first = IdAllocator('Visit_ID', state_path)
+    assert first.allocate() == str(FIRST_ID)
+    first.add('100500')
+    first.checkpoint()
+
+    # A new process sees the mark without loading any of the IDs.
+    restarted = IdAllocator('Visit_ID', state_path)
+    assert restarted.allocate() == '100501'
+    # Allocators sharing the state file never hand out the same ID.
+    assert first.allocate() == '100502'
+    assert IdAllocator('Note_ID', state_path).allocate() == str(FIRST_ID)
+
+
+def test_ids_of_removed_visits_are_not_reused(tmp_path, write_visits, monkeypatch):
+    path = write_visits([visit_row('P1', '100001', '2023-01-15'), visit_row('P2', '100002', '2023-01-16')])
+    department = Department('General', path, use_snapshot=False)
+    assert department.visit_ids is get_allocator('Visit_ID', str(tmp_path / 'Notes.csv'))
+    department.add_visits([visit_row('P3', '', '2023-02-01')])
+    added = department.patients['P3'].visits[0].visit_id
+    assert added == '100003'
+    department.remove_patient('P3')
+    department.compact()
+
+    # A fresh process: only ids.json remembers the removed visit's ID.
+    monkeypatch.setattr(ids, '_allocators', {})
+    reloaded = Department('General', path, use_snapshot=False)
+    assert added not in reloaded.visit_ids
+    assert int(reloaded.visit_ids.allocate()) > int(added)
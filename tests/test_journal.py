@@ -0,0 +1,75 @@
+import os
+
+from conftest import visit_row
+from patients import Department
+
+
+def load(path):
+    return Department('General', path, use_snapshot=False)
+
+
+def visit_ids(department):
+    return sorted((patient_id, visit.visit_id) for patient_id, patient in department.patients.items()
+                  for visit in patient.visits)
+
+
+def base_rows():
+    return [visit_row('P1', 'V1', '2023-01-15'), visit_row('P1', 'V2', '2023-02-01'),
+            visit_row('P2', 'V3', '2023-01-20')]
+
+
+def test_edits_are_replayed_from_the_journal(write_visits):
+    path = write_visits(base_rows())
+    department = load(path)
+    department.add_visits([visit_row('P2', 'V4', '2023-03-05', age='41'), visit_row('P3', 'V5', '2023-03-06')])
+    department.remove_patient('P1')
+    assert os.path.exists(department.journal_path)
+
+    reloaded = load(path)
+    assert visit_ids(reloaded) == [('P2', 'V3'), ('P2', 'V4'), ('P3', 'V5')]
+    assert reloaded.patients['P2'].age == 41
+    assert reloaded.count_visits_between('2023-01-01', '2023-12-31') == 3
+
+
+def test_replay_after_interrupted_compaction_is_idempotent(write_visits):
+    path = write_visits(base_rows())
+    department = load(path)
+    department.add_visits([visit_row('P2', 'V4', '2023-03-05')])
+    department.remove_patient('P1')
+    department.add_visits([visit_row('P1', 'V6', '2023-04-01')])
+    # The base file is replaced but the journal is never truncated.
+    department._write_base(department._snapshot())
+
+    reloaded = load(path)
+    assert visit_ids(reloaded) == visit_ids(department) == [('P1', 'V6'), ('P2', 'V3'), ('P2', 'V4')]
+    assert reloaded.count_visits_between('2023-01-01', '2023-12-31') == 3
+
+
+def test_torn_and_uncommitted_records_are_dropped(write_visits):
+    path = write_visits(base_rows())
+    department = load(path)
+    department.add_visits([visit_row('P2', 'V4', '2023-03-05')])
+    with open(department.journal_path, 'a', encoding='utf-8') as file:
+        file.write("begin,,,,,,,,,,,,,\nadd,P9,V9,2023-05-01,Cardiology,White,Female,Non-Hispanic,"
+                   "40,02139,Medicare,fatigue,NV9,progress note\nremove,P2")
+
+    reloaded = load(path)
+    assert visit_ids(reloaded) == [('P1', 'V1'), ('P1', 'V2'), ('P2', 'V3'), ('P2', 'V4')]
+    reloaded.add_visits([visit_row('P3', 'V5', '2023-03-06')])
+    assert ('P3', 'V5') in visit_ids(load(path))
+
+
+def test_compaction_folds_the_journal_into_the_base_file(write_visits):
+    path = write_visits(base_rows())
+    department = load(path)
+    department.add_visits([visit_row('P2', 'V4', '2023-03-05')])
+    department.remove_patient('P1')
+    department.compact()
+
+    assert not os.path.exists(department.journal_path)
+    assert department.journal_entries == 0
+    assert not department.is_stale()
+    reloaded = load(path)
+    assert visit_ids(reloaded) == [('P2', 'V3'), ('P2', 'V4')]
+    assert reloaded.journal_entries == 0
+
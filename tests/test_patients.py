@@ -0,0 +1,47 @@
+from conftest import visit_row
+from patients import Department
+from storage import SqliteDepartment
+
+
+def test_latest_visit_follows_edits(tmp_path, write_visits):
+    path = write_visits([visit_row('P1', 'V1', '2023-02-01'), visit_row('P1', 'V2', '2023-01-15'),
+                         visit_row('P2', 'V3', '2023-01-20')])
+    department = Department('General', path, use_snapshot=False)
+    database = SqliteDepartment('General', str(tmp_path / 'warehouse.db'))
+    database.import_csv(path)
+    for suffix, backend in (('a', department), ('b', database)):
+        assert backend.latest_visit('P1').visit_id == 'V1'
+        backend.add_visits([visit_row('P1', f"V4{suffix}", '2023-01-01')])
+        assert backend.latest_visit('P1').visit_id == 'V1'
+        backend.add_visits([visit_row('P1', f"V5{suffix}", '2023-03-01')])
+        assert backend.latest_visit('P1').visit_id == f"V5{suffix}"
+        assert backend.latest_visit('P1').visit_id == backend.visit_history('P1')[1][0].visit_id
+        backend.remove_patient('P1')
+        assert backend.latest_visit('P1') is None
+    assert Department('General', path, use_snapshot=False).latest_visit('P2').visit_id == 'V3'
+
+
+def test_aggregates_built_after_edits_match_incremental_ones(tmp_path, write_visits):
+    # Visit_IDs are unique per data directory, so each Department gets its own prefix.
+    def base(prefix):
+        return [visit_row('P1', f"{prefix}1", '2023-02-01', age='30'), visit_row('P2', f"{prefix}2", '2023-01-15'),
+                visit_row('P2', f"{prefix}3", '2023-03-20', insurance='Medicaid')]
+
+    def edit(department, prefix):
+        department.add_visits([visit_row('P1', f"{prefix}4", '2023-02-11', age='70', insurance='Medicaid'),
+                               visit_row('P3', f"{prefix}5", '2023-04-01')])
+        department.remove_patient('P2')
+
+    def counts(aggregates):
+        return (aggregates.monthly_visits(), aggregates.insurance, aggregates.gender, aggregates.age_groups,
+                aggregates.patient_insurance)
+
+    built_late = Department('General', write_visits(base('A')), use_snapshot=False)
+    edit(built_late, 'A')
+    built_early = Department('General', str(tmp_path / 'empty.csv'), use_snapshot=False)
+    built_early.add_visits(base('B'))
+    assert counts(built_early.aggregates)[0] == [('2023-01', 1), ('2023-02', 1), ('2023-03', 1)]
+    edit(built_early, 'B')
+    assert counts(built_early.aggregates) == counts(built_late.aggregates)
+    assert counts(built_late.aggregates)[0] == [('2023-02', 2), ('2023-04', 1)]
+    assert counts(built_late.aggregates)[4] == {'Medicaid': 1, 'Medicare': 1}
@@ -0,0 +1,38 @@
+from conftest import visit_row
+from stats import aggregate_patient_data, load_patient_data, parse_visit_times
+
+
+def aggregate_counts(aggregates):
+    return (aggregates.monthly_visits(), aggregates.insurance, aggregates.gender, aggregates.race,
+            aggregates.age_groups)
+
+
+def mixed_format_rows():
+    # ISO dates first, then a US-format date, then ISO again, so every chunking of the file
+    # sees a different mix.
+    times = ['2023-01-15', '2023-01-20', '02/03/2023', '2023-02-10', '2023-03-01', '03/15/2023',
+             '2023-03-20', 'not a date']
+    return [visit_row(f"P{i % 3}", f"V{i}", time, age=str(20 + 10 * i),
+                      insurance=['Medicare', 'Medicaid'][i % 2]) for i, time in enumerate(times)]
+
+
+def test_parse_visit_times_accepts_both_formats():
+    parsed = parse_visit_times(['2023-02-03', '02/03/2023', 'garbage'])
+    assert parsed[0] == parsed[1]
+    assert parsed.isna().tolist() == [False, False, True]
+
+
+def test_chunked_statistics_match_unchunked(write_visits):
+    path = write_visits(mixed_format_rows())
+    whole = aggregate_patient_data(path)
+    assert whole.monthly_visits() == [('2023-01', 2), ('2023-02', 2), ('2023-03', 3)]
+    for memory_limit in (1, 2000, 4000):
+        assert aggregate_counts(aggregate_patient_data(path, memory_limit)) == aggregate_counts(whole)
+
+
+def test_loaded_frame_matches_aggregates(write_visits):
+    path = write_visits(mixed_format_rows())
+    df = load_patient_data(path)
+    monthly = df['Visit_time'].dt.to_period('M').value_counts().sort_index()
+    expected = [(period.strftime('%Y-%m'), count) for period, count in monthly.items()]
+    assert aggregate_patient_data(path, memory_limit=1).monthly_visits() == expected
@@ -0,0 +1,37 @@
+import os
+
+from conftest import visit_row
+from patients import Department
+from storage import SqliteDepartment
+
+
+def visit_count(department):
+    return department.store.execute("SELECT COUNT(*) FROM visits").fetchone()[0]
+
+
+def test_importing_twice_adds_each_visit_once(tmp_path, write_visits):
+    path = write_visits([visit_row('P1', 'V1', '2023-01-15'), visit_row('P1', 'V2', '02/01/2023'),
+                         visit_row('P2', 'V3', '2023-01-20')])
+    csv_department = Department('General', path, use_snapshot=False)
+    csv_department.add_visits([visit_row('P3', 'V4', '2023-03-05')])
+    csv_department.remove_patient('P2')
+
+    department = SqliteDepartment('General', str(tmp_path / 'warehouse.db'))
+    assert department.import_csv(path) == 3
+    # The journal was folded into the CSV, which still holds every edit.
+    assert not os.path.exists(path + ".journal")
+    assert sorted(Department('General', path, use_snapshot=False).patients) == ['P1', 'P3']
+
+    assert department.import_csv(path) == 0
+    assert visit_count(department) == 3
+    assert sorted(department.patients) == ['P1', 'P3']
+    assert department.count_visits_between('2023-01-01', '2023-12-31') == 3
+
+
+def test_reimport_adds_only_new_visits(tmp_path, write_visits):
+    rows = [visit_row('P1', 'V1', '2023-01-15')]
+    department = SqliteDepartment('General', str(tmp_path / 'warehouse.db'))
+    department.import_csv(write_visits(rows))
+    assert department.import_csv(write_visits(rows + [visit_row('P2', 'V2', '2023-02-01')])) == 1
+    assert visit_count(department) == 2
+    assert department.journal_entries == 0 and department.compact_threshold == 0
@@ -2,12 +2,141 @@ import tkinter as tk
 from tkinter import messagebox, font
 from users import authenticate_user
 from log_usage import log_event
-from patients import Department, NotesDatabase
-from stats import load_patient_data
+from storage import is_sqlite_path, open_notes
+from search import NoteSearchIndex, parse_query, snippet
+import data_cache
+import metrics
+from stats import by_age_group, by_count
+from tasks import TaskRunner
 import datetime
+import threading
 import pandas as pd
 import matplotlib.pyplot as plt
 
+# Point both at the same .db file to run on the SQLite backend (see storage.py).
+PATIENT_DATA_FILE = "Patient_data.csv"
+NOTES_FILE = "Notes.csv"
+# With PATIENT_DATA_FILE pointing at a shard directory (see shards.py), the clinician and
+# admin dashboards load only this department's shards; "General" loads them all. The
+# management dashboard always covers every department.
+DEPARTMENT = "General"
+
+def counts_series(counts):
+    return pd.Series(dict(counts), dtype='int64')
+
+class PerformancePanel:
+    # Shows the timings and counters collected by metrics.py, with controls to switch
+    # recording on or off, clear it and write it to a file.
+    def __init__(self, parent):
+        self.window = tk.Toplevel(parent)
+        self.window.title("Performance")
+        self.window.geometry("900x400")
+
+        controls = tk.Frame(self.window)
+        controls.pack(fill='x', pady=5)
+        self.enabled = tk.BooleanVar(value=metrics.is_enabled())
+        tk.Checkbutton(controls, text="Record metrics", variable=self.enabled,
+                       command=self.toggle).pack(side='left', padx=5)
+        tk.Button(controls, text="Refresh", command=self.refresh).pack(side='left', padx=5)
+        tk.Button(controls, text="Reset", command=self.reset).pack(side='left', padx=5)
+        tk.Button(controls, text="Save to File", command=self.save).pack(side='left', padx=5)
+
+        self.text = tk.Text(self.window, font=("Courier", 10), wrap='none')
+        self.text.pack(fill='both', expand=True)
+        self.refresh()
+
+    def toggle(self):
+        metrics.enable(self.enabled.get())
+        self.refresh()
+
+    def refresh(self):
+        self.text.config(state='normal')
+        self.text.delete('1.0', tk.END)
+        self.text.insert(tk.END, metrics.report())
+        self.text.config(state='disabled')
+
+    def reset(self):
+        metrics.reset()
+        self.refresh()
+
+    def save(self):
+        try:
+            path = metrics.dump()
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not save metrics: {e}", parent=self.window)
+            return
+        messagebox.showinfo("Saved", f"Metrics written to {path}", parent=self.window)
+
+
+class VisitHistoryWindow:
+    # A patient's details and latest visit, with their visit history a page at a time,
+    # newest first. Each page is fetched on the task runner.
+    PER_PAGE = 20
+
+    def __init__(self, parent, runner, department, history, latest):
+        self.runner = runner
+        self.department = department
+        patient, visits, self.total = history
+        self.patient_id = patient.patient_id
+        self.page = 0
+        self.pages = max((self.total + self.PER_PAGE - 1) // self.PER_PAGE, 1)
+
+        self.window = tk.Toplevel(parent)
+        self.window.title(f"Patient {patient.patient_id}")
+        self.window.geometry("700x500")
+
+        details = [
+            f"Patient ID: {patient.patient_id}",
+            f"Gender: {patient.gender}",
+            f"Race: {patient.race}",
+            f"Age: {patient.age}",
+            f"Ethnicity: {patient.ethnicity}",
+            f"Insurance: {patient.insurance}",
+            f"Zip Code: {patient.zip_code}",
+            f"Latest Visit: {latest.visit_id} on {latest.visit_time:%Y-%m-%d}, "
+            f"{latest.visit_department}, {latest.chief_complaint}",
+        ]
+        tk.Label(self.window, text="\n".join(details), justify='left', font=("Helvetica", 11)).pack(anchor='w',
+                                                                                                  padx=10, pady=10)
+
+        controls = tk.Frame(self.window)
+        controls.pack(fill='x', padx=10)
+        self.newer = tk.Button(controls, text="< Newer", command=lambda: self.load(self.page - 1))
+        self.newer.pack(side='left')
+        self.older = tk.Button(controls, text="Older >", command=lambda: self.load(self.page + 1))
+        self.older.pack(side='left', padx=5)
+        self.status = tk.Label(controls)
+        self.status.pack(side='left', padx=10)
+
+        self.text = tk.Text(self.window, font=("Courier", 10), wrap='none')
+        self.text.pack(fill='both', expand=True, padx=10, pady=10)
+        self.show(visits)
+
+    def load(self, page):
+        def fetch(task):
+            return self.department.visit_history(self.patient_id, page, self.PER_PAGE)
+
+        def done(history):
+            if history is None:
+                messagebox.showerror("Error", "Patient not found.", parent=self.window)
+                return
+            self.page = page
+            self.show(history[1])
+
+        self.runner.submit("Visit History", fetch, on_success=done)
+
+    def show(self, visits):
+        self.text.config(state='normal')
+        self.text.delete('1.0', tk.END)
+        self.text.insert(tk.END, f"{'Visit Time':<12} {'Visit ID':<10} {'Department':<28} {'Chief Complaint':<20} Note ID\n")
+        for visit in visits:
+            self.text.insert(tk.END, f"{visit.visit_time:%Y-%m-%d}   {visit.visit_id!s:<10} "
+                                     f"{visit.visit_department:<28} {visit.chief_complaint:<20} {visit.note_id}\n")
+        self.text.config(state='disabled')
+        self.status.config(text=f"Page {self.page + 1} of {self.pages} ({self.total} visits)")
+        self.newer.config(state='normal' if self.page > 0 else 'disabled')
+        self.older.config(state='normal' if self.page + 1 < self.pages else 'disabled')
+
 class LoginWindow:
     def __init__(self, root, on_login_success):
         self.root = root
@@ -57,11 +186,13 @@ class ClinicianDashboard:
         self.user = user
         self.root = tk.Tk()
         self.root.title(f"{user.role.capitalize()} Dashboard - Welcome {user.username}")
-        self.root.geometry("600x400")
+        self.root.geometry("600x520")
         self.root.configure(bg="#f9f9f9")
 
-        self.department = Department("General", "Patient_data.csv")
-        self.notes_db = NotesDatabase("Notes.csv")
+        self.runner = TaskRunner(self.root)
+        self._notes_db = None
+        self._search_index = None
+        self._notes_lock = threading.Lock()
 
         tk.Label(self.root, text="Clinician Dashboard", font=("Helvetica", 16, "bold"), bg="#f9f9f9").pack(pady=20)
         btn_frame = tk.Frame(self.root, bg="#f9f9f9")
@@ -73,13 +204,38 @@ class ClinicianDashboard:
             ("Remove Patient", self.remove_patient),
             ("Count Visits", self.count_visits),
             ("View Note", self.view_note),
+            ("Search Notes", self.search_notes),
+            ("Performance", lambda: PerformancePanel(self.root)),
             ("Exit", self.root.destroy)
         ]
 
         for text, command in actions:
             tk.Button(btn_frame, text=text, width=25, font=("Helvetica", 12), command=command).pack(pady=5)
 
+        # Warm the data in the background; actions submitted meanwhile wait on the same load.
+        self.runner.submit("Loading patient data", lambda task: self.department)
+        self.runner.submit("Loading notes", lambda task: self.notes_db)
         self.root.mainloop()
+        self.runner.shutdown()
+
+    @property
+    def department(self):
+        return data_cache.get_department(PATIENT_DATA_FILE, DEPARTMENT)
+
+    @property
+    def notes_db(self):
+        with self._notes_lock:
+            if self._notes_db is None:
+                self._notes_db = open_notes(NOTES_FILE, lazy=True)
+            return self._notes_db
+
+    @property
+    def search_index(self):
+        notes_db = self.notes_db
+        with self._notes_lock:
+            if self._search_index is None:
+                self._search_index = NoteSearchIndex(notes_db)
+            return self._search_index
 
     def add_patient_visit(self):
         def submit():
@@ -92,13 +248,18 @@ class ClinicianDashboard:
                 messagebox.showerror("Error", "All fields are required.")
                 return
 
-            success = self.department.add_visit_from_ui(patient_id, visit_time, visit_dept, complaint)
-            if success:
-                log_event(self.user.username, self.user.role, f"Added visit for {patient_id}")
-                messagebox.showinfo("Success", f"Visit for patient {patient_id} added.")
-                top.destroy()
-            else:
-                messagebox.showerror("Error", "Failed to add visit. Patient may not exist.")
+            def add(department):
+                # add_visit_from_ui asks for the remaining fields in dialogs, so it runs here on
+                # the Tk thread; only getting the (possibly reloading) Department is off it.
+                success = department.add_visit_from_ui(patient_id, visit_time, visit_dept, complaint)
+                if success:
+                    log_event(self.user.username, self.user.role, f"Added visit for {patient_id}", patient_id)
+                    messagebox.showinfo("Success", f"Visit for patient {patient_id} added.")
+                    top.destroy()
+                else:
+                    messagebox.showerror("Error", "Failed to add visit. Patient may not exist.")
+
+            self.runner.submit("Add Patient Visit", lambda task: self.department, on_success=add)
 
         top = tk.Toplevel(self.root)
         top.title("Add Patient Visit")
@@ -126,52 +287,86 @@ class ClinicianDashboard:
         patient_id = self.simple_prompt("Retrieve Patient", "Enter Patient ID:")
         if not patient_id:
             return
-        output = []
-        if patient_id in self.department.patients:
-            patient = self.department.patients[patient_id]
-            if patient.visits:
-                latest_visit = sorted(patient.visits, key=lambda v: v.visit_time)[-1]
-                output = [
-                    f"Patient ID: {patient.patient_id}",
-                    f"Gender: {patient.gender}",
-                    f"Race: {patient.race}",
-                    f"Age: {patient.age}",
-                    f"Ethnicity: {patient.ethnicity}",
-                    f"Insurance: {patient.insurance}",
-                    f"Zip Code: {patient.zip_code}",
-                    f"Visit ID: {latest_visit.visit_id}",
-                    f"Visit Time: {latest_visit.visit_time}",
-                    f"Department: {latest_visit.visit_department}",
-                    f"Chief Complaint: {latest_visit.chief_complaint}"
-                ]
-                messagebox.showinfo("Latest Visit Info", "\n".join(output))
+        log_event(self.user.username, self.user.role, f"Retrieved patient {patient_id}", patient_id)
+
+        def lookup(task):
+            # Only the first page of visits is read, however long the history.
+            department = self.department
+            with department.reading():
+                return (department, department.visit_history(patient_id, 0, VisitHistoryWindow.PER_PAGE),
+                        department.latest_visit(patient_id))
+
+        def show(result):
+            department, history, latest = result
+            if history is None:
+                messagebox.showerror("Error", "Patient not found.")
+            elif latest is not None:
+                VisitHistoryWindow(self.root, self.runner, department, history, latest)
             else:
                 messagebox.showinfo("Info", "No visits found for this patient.")
-        else:
-            messagebox.showerror("Error", "Patient not found.")
+
+        self.runner.submit("Retrieve Patient", lookup, on_success=show)
 
     def remove_patient(self):
         patient_id = self.simple_prompt("Remove Patient", "Enter Patient ID:")
         if patient_id:
-            self.department.remove_patient(patient_id)
-            log_event(self.user.username, self.user.role, f"Removed patient {patient_id}")
+            self.runner.submit("Remove Patient", lambda task: self.department.remove_patient(patient_id))
+            log_event(self.user.username, self.user.role, f"Removed patient {patient_id}", patient_id)
 
     def count_visits(self):
         date = self.simple_prompt("Count Visits", "Enter date (YYYY-MM-DD):")
         if date:
-            self.department.review_visits(date)
+            self.runner.submit("Count Visits", lambda task: self.department.review_visits(date))
             log_event(self.user.username, self.user.role, f"Counted visits on {date}")
 
     def view_note(self):
         pid = self.simple_prompt("View Note", "Enter Patient ID:")
         date = self.simple_prompt("View Note", "Enter Visit Date (YYYY-MM-DD):")
         if pid and date:
-            notes = self.notes_db.get_notes_by_patient_and_date(pid, date, self.department)
-            if notes:
-                content = "\n\n".join([f"Note ID: {n.note_id}\nText: {n.note_text}" for n in notes])
-                messagebox.showinfo("Notes", content)
+            log_event(self.user.username, self.user.role, f"Viewed notes for {pid}", pid)
+
+            def lookup(task):
+                department = self.department
+                with department.reading():
+                    notes = self.notes_db.get_notes_by_patient_and_date(pid, date, department)
+                # Lazy notes read their text from disk here, off the Tk thread.
+                return "\n\n".join([f"Note ID: {n.note_id}\nText: {n.note_text}" for n in notes])
+
+            def show(content):
+                if content:
+                    messagebox.showinfo("Notes", content)
+                else:
+                    messagebox.showinfo("No Notes", "No notes found for given date.")
+
+            self.runner.submit("View Note", lookup, on_success=show)
+
+    def search_notes(self):
+        # NoteSearchIndex is built over the CSV notes file; the SQLite backend has no index.
+        if is_sqlite_path(NOTES_FILE):
+            messagebox.showinfo("Search Notes", "Full-text search is not supported on the SQLite backend.")
+            return
+        query = self.simple_prompt("Search Notes", 'Search (e.g. "chest pain" patient:P001 from:2023-01-01):')
+        if not query:
+            return
+        patient_id = parse_query(query)[2].get('patient_id', "")
+        log_event(self.user.username, self.user.role, f"Searched notes for {query}", patient_id)
+
+        def lookup(task):
+            department = self.department
+            task.report(message="Searching notes...")
+            with department.reading():
+                results = self.search_index.search(query, limit=10, patient_data=department)
+            return "\n\n".join([f"Note ID: {note.note_id} (Patient {note.patient_id}, Visit {note.visit_id}, "
+                                 f"score {score:.2f})\n{snippet(note.note_text, query)}"
+                                 for note, score in results])
+
+        def show(content):
+            if content:
+                messagebox.showinfo("Search Results", content)
             else:
-                messagebox.showinfo("No Notes", "No notes found for given date.")
+                messagebox.showinfo("No Notes", "No notes match the search.")
+
+        self.runner.submit("Search Notes", lookup, on_success=show, cancellable=True)
 
     def simple_prompt(self, title, prompt):
         prompt_win = tk.Toplevel(self.root)
@@ -196,18 +391,26 @@ class AdminDashboard:
         self.user = user
         self.root = tk.Tk()
         self.root.title(f"Admin Dashboard - {user.username}")
-        self.root.geometry("400x250")
+        self.root.geometry("400x310")
         self.root.configure(bg="#f2f2f2")
 
-        self.department = Department("General", "Patient_data.csv")
+        self.runner = TaskRunner(self.root)
 
         tk.Label(self.root, text="Admin Dashboard", font=("Helvetica", 16, "bold"), bg="#f2f2f2").pack(pady=20)
         tk.Button(self.root, text="Count Visits on Date", font=("Helvetica", 12),
                   command=self.count_visits).pack(pady=10)
+        tk.Button(self.root, text="Performance", font=("Helvetica", 12),
+                  command=lambda: PerformancePanel(self.root)).pack(pady=10)
 
         tk.Button(self.root, text="Exit", font=("Helvetica", 12), command=self.root.destroy).pack(pady=10)
 
+        self.runner.submit("Loading patient data", lambda task: self.department)
         self.root.mainloop()
+        self.runner.shutdown()
+
+    @property
+    def department(self):
+        return data_cache.get_department(PATIENT_DATA_FILE, DEPARTMENT)
 
     def count_visits(self):
         date_input = self.simple_prompt("Count Visits", "Enter Date (YYYY-MM-DD):")
@@ -219,23 +422,10 @@ class AdminDashboard:
             messagebox.showerror("Invalid Date", "Please enter date in YYYY-MM-DD format.")
             return
 
-        count = 0
-        for patient in self.department.patients.values():
-            for visit in patient.visits:
-                visit_date = visit.visit_time.date() if hasattr(visit.visit_time, 'date') else visit.visit_time
-                if isinstance(visit_date, str):
-                    try:
-                        visit_date = datetime.datetime.strptime(visit_date, "%m/%d/%Y").date()
-                    except ValueError:
-                        try:
-                            visit_date = datetime.datetime.strptime(visit_date, "%Y-%m-%d").date()
-                        except ValueError:
-                            continue
-                if visit_date == parsed_date:
-                    count += 1
-
         log_event(self.user.username, self.user.role, f"Counted visits on {date_input}")
-        messagebox.showinfo("Visit Count", f"Total visits on {date_input}: {count}")
+        self.runner.submit("Count Visits", lambda task: self.department.count_visits_on(parsed_date),
+                           on_success=lambda count: messagebox.showinfo(
+                               "Visit Count", f"Total visits on {date_input}: {count}"))
 
     def simple_prompt(self, title, prompt):
         win = tk.Toplevel(self.root)
@@ -261,7 +451,7 @@ class ManagementDashboard:
         self.user = user
         self.root = tk.Tk()
         self.root.title(f"Management Dashboard - {user.username}")
-        self.root.geometry("400x250")
+        self.root.geometry("400x370")
         self.root.configure(bg="#e9f0f4")
 
         tk.Label(self.root, text="Management Dashboard", font=("Helvetica", 16, "bold"), bg="#e9f0f4").pack(pady=20)
@@ -270,21 +460,34 @@ class ManagementDashboard:
                   command=self.show_statistics).pack(pady=10)
         tk.Button(self.root, text="Export Statistics Summary", font=("Helvetica", 12),
                   command=self.export_summary).pack(pady=10)
+        tk.Button(self.root, text="Performance", font=("Helvetica", 12),
+                  command=lambda: PerformancePanel(self.root)).pack(pady=10)
 
         tk.Button(self.root, text="Exit", font=("Helvetica", 12), command=self.root.destroy).pack(pady=10)
 
+        self.runner = TaskRunner(self.root)
+        self.runner.submit("Loading patient data", lambda task: data_cache.get_department(PATIENT_DATA_FILE))
         self.root.mainloop()
+        self.runner.shutdown()
 
     def show_statistics(self):
-        df = load_patient_data("Patient_data.csv")
-        if df.empty:
+        self.runner.submit("Generate Key Statistics", self._collect_statistics, on_success=self._plot_statistics)
+
+    def _collect_statistics(self, task):
+        department = data_cache.get_department(PATIENT_DATA_FILE)
+        with department.reading():
+            aggregates = department.aggregates
+            return (aggregates.monthly_visits(), by_count(aggregates.insurance), by_count(aggregates.gender),
+                    by_count(aggregates.race), by_age_group(aggregates.age_groups))
+
+    def _plot_statistics(self, statistics):
+        # Plotting stays on the Tk thread; matplotlib's Tk backend is not thread-safe.
+        monthly_visits, insurance_counts, gender_counts, race_counts, age_group_counts = statistics
+        if not monthly_visits:
             messagebox.showerror("Error", "No data available to generate statistics.")
             return
 
-        df['Month_Year'] = df['Visit_time'].dt.to_period('M')
-        monthly_visits = df.groupby('Month_Year').size().sort_index()
-
-        monthly_visits = monthly_visits[-12:]
+        monthly_visits = counts_series(monthly_visits[-12:])
 
         plt.figure(figsize=(10, 5))
         monthly_visits.plot(kind='bar', color='steelblue', width=0.6)
@@ -297,7 +500,7 @@ class ManagementDashboard:
 
         # Insurance Distribution
         plt.figure(figsize=(6, 4))
-        df['Insurance'].value_counts().plot(kind='bar', color='skyblue')
+        counts_series(insurance_counts).plot(kind='bar', color='skyblue')
         plt.title('Visits by Insurance Type')
         plt.xlabel('Insurance')
         plt.ylabel('Count')
@@ -306,7 +509,7 @@ class ManagementDashboard:
 
         # Gender Distribution
         plt.figure(figsize=(6, 4))
-        df['Gender'].value_counts().plot(kind='bar', color='salmon')
+        counts_series(gender_counts).plot(kind='bar', color='salmon')
         plt.title('Gender Distribution')
         plt.xlabel('Gender')
         plt.ylabel('Count')
@@ -315,7 +518,7 @@ class ManagementDashboard:
 
         # Race Distribution
         plt.figure(figsize=(6, 4))
-        df['Race'].value_counts().plot(kind='bar', color='orange')
+        counts_series(race_counts).plot(kind='bar', color='orange')
         plt.title('Race Distribution')
         plt.xlabel('Race')
         plt.ylabel('Count')
@@ -323,11 +526,8 @@ class ManagementDashboard:
         plt.show()
 
         # Age Group Distribution
-        bins = [0, 18, 35, 50, 65, 80, 100]
-        labels = ['0-18', '19-35', '36-50', '51-65', '66-80', '81-100']
-        df['Age_Group'] = pd.cut(df['Age'], bins=bins, labels=labels, right=False)
         plt.figure(figsize=(6, 4))
-        df['Age_Group'].value_counts().sort_index().plot(kind='bar', color='green')
+        counts_series(age_group_counts).plot(kind='bar', color='green')
         plt.title('Age Group Distribution')
         plt.xlabel('Age Group')
         plt.ylabel('Count')
@@ -337,11 +537,16 @@ class ManagementDashboard:
         log_event(self.user.username, self.user.role, "Generated key statistics")
 
     def export_summary(self):
-        dept = Department("General", "Patient_data.csv")
-        success = dept.export_statistics_report("summary_report.csv")
-        if success:
-            messagebox.showinfo("Exported", "Summary statistics exported to 'summary_report.csv'")
-        else:
-            messagebox.showwarning("No Data", "No records found to export.")
+        def export(task):
+            dept = data_cache.get_department(PATIENT_DATA_FILE)
+            return dept.export_statistics_report("summary_report.csv")
+
+        def show(success):
+            if success:
+                messagebox.showinfo("Exported", "Summary statistics exported to 'summary_report.csv'")
+            else:
+                messagebox.showwarning("No Data", "No records found to export.")
+
+        self.runner.submit("Export Statistics Summary", export, on_success=show)
 
 
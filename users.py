@@ -1,4 +1,12 @@
 import csv
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
 
 class User:
     def __init__(self, username, role):
@@ -27,31 +35,123 @@ class User:
         return self.role == 'admin'
 
 
-def authenticate_user(credentials_file, input_username, input_password):
-    input_username = input_username.strip()
-    input_password = input_password.strip()
+HASH_ALGORITHM = 'pbkdf2_sha256'
+HASH_ITERATIONS = 100000
+
+
+def hash_password(password, salt=None, iterations=HASH_ITERATIONS):
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), iterations)
+    return f"{HASH_ALGORITHM}${iterations}${salt}${digest.hex()}"
 
+
+def is_password_hash(value):
+    return value.startswith(HASH_ALGORITHM + '$')
+
+
+def verify_password(password, stored):
+    if not is_password_hash(stored):
+        # Plaintext entry that has not been migrated yet.
+        return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
     try:
-        with open(credentials_file, newline='', encoding='utf-8') as file:
+        _, iterations, salt, _ = stored.split('$')
+        expected = hash_password(password, salt, int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected, stored)
+
+
+class CredentialStore:
+    def __init__(self, credentials_file):
+        self.credentials_file = credentials_file
+        self.users = {}
+        self.signature = None
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        stat = os.stat(self.credentials_file)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def reload_if_changed(self):
+        signature = self._file_signature()
+        if signature != self.signature:
+            with self._lock:
+                if signature != self.signature:
+                    self.load()
+
+    def load(self):
+        signature = self._file_signature()
+        users = {}
+        with open(self.credentials_file, newline='', encoding='utf-8') as file:
             reader = csv.DictReader(file)
             for row in reader:
-                file_username = row['username'].strip()
-                file_password = row['password'].strip()
-                file_role = row['role'].strip()
+                # A username may appear more than once; any of its rows can match.
+                users.setdefault(row['username'].strip(), []).append(
+                    (row['password'].strip(), row['role'].strip()))
+        self.users = users
+        self.signature = signature
+
+    def authenticate(self, username, password):
+        self.reload_if_changed()
+        for stored, role in self.users.get(username, ()):
+            if verify_password(password, stored):
+                return User(username, role)
+        return None
+
 
-                
-                if file_username == input_username and file_password == input_password:
-                    
-                    return User(file_username, file_role)
+_stores = {}
+_stores_lock = threading.Lock()
 
+
+def get_credential_store(credentials_file):
+    with _stores_lock:
+        store = _stores.get(credentials_file)
+        if store is None:
+            store = _stores[credentials_file] = CredentialStore(credentials_file)
+        return store
+
+
+@metrics.timed("users.authenticate_user")
+def authenticate_user(credentials_file, input_username, input_password):
+    input_username = input_username.strip()
+    input_password = input_password.strip()
+
+    try:
+        return get_credential_store(credentials_file).authenticate(input_username, input_password)
     except FileNotFoundError:
         print("Credentials file not found.")
     except Exception as e:
         print(f"Error reading credentials file: {e}")
 
-   
     return None
 
 
+def migrate_credentials(credentials_file, iterations=HASH_ITERATIONS):
+    # Rewrites plaintext passwords in place as salted hashes; already hashed rows are kept.
+    with open(credentials_file, newline='', encoding='utf-8') as file:
+        reader = csv.DictReader(file)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+
+    # hashlib releases the GIL while hashing, so threads spread the work across cores.
+    pending = [row for row in rows if not is_password_hash(row['password'].strip())]
+    with ThreadPoolExecutor() as pool:
+        hashes = pool.map(lambda row: hash_password(row['password'].strip(), iterations=iterations), pending)
+        for row, hashed in zip(pending, hashes):
+            row['password'] = hashed
+    migrated = len(pending)
+
+    tmp_path = credentials_file + ".tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, credentials_file)
+    return migrated
+
 
+if __name__ == "__main__":
+    import sys
 
+    path = sys.argv[1] if len(sys.argv) > 1 else "Credentials.csv"
+    print(f"Migrated {migrate_credentials(path)} plaintext passwords in {path}")